@@ -0,0 +1,83 @@
+"""
+Compare cold and warm rendering of a project with many templates using the
+library macros.
+
+    python benchmarks/render_benchmark.py --templates 200
+
+- cold: new process, nothing cached.
+- bytecode: new process, compiled templates loaded from the disk cache.
+- warm: same process, environment and compiled templates already in memory.
+"""
+from sqlbucket.project import Project
+from sqlbucket.templating import clear_jinja_envs
+from pathlib import Path
+from timeit import default_timer
+import argparse
+import tempfile
+
+
+TEMPLATE = """
+{% import 'common.jinja2' as common %}
+{% import 'aggregations.jinja2' as aggregations %}
+{% for column in ['a', 'b', 'c', 'd'] %}
+{{ common.is_unique('table_' ~ n, column) }}
+union all
+{{ aggregations.column_max_to_be_between('table_' ~ n, column, 0, 100) }}
+{{ "union all" if not loop.last }}
+{% endfor %}
+"""
+
+
+def create_project(folder: Path, templates: int) -> Path:
+    queries = folder / 'queries'
+    queries.mkdir(parents=True)
+    order = list()
+    for n in range(templates):
+        name = f'query_{n}.sql'
+        (queries / name).write_text(f"{{% set n = {n} %}}{TEMPLATE}")
+        order.append(name)
+    (folder / 'config.yaml').write_text(
+        'order:\n' + ''.join(f'  - {name}\n' for name in order)
+    )
+    return folder
+
+
+def render(project_path: Path, bytecode_cache_path: str) -> float:
+    start = default_timer()
+    project = Project(
+        project_path=str(project_path),
+        connection_url='something://database',
+        context={'c': {'name': 'db'}, 'e': {'name': 'dev'}},
+        bytecode_cache_path=bytecode_cache_path
+    )
+    configuration = project.configure()
+    for query in configuration["order"]:
+        configuration["queries"][query]
+    return default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--templates', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        project_path = create_project(Path(tmp) / 'project', args.templates)
+        bytecode_cache_path = str(Path(tmp) / 'bytecode')
+
+        cold = render(project_path, bytecode_cache_path)
+
+        # simulating a new process reusing the bytecode stored on disk
+        clear_jinja_envs()
+        bytecode = render(project_path, bytecode_cache_path)
+
+        warm = render(project_path, bytecode_cache_path)
+
+    print(f'{args.templates} templates')
+    print(f'cold:     {cold:.3f}s')
+    print(f'bytecode: {bytecode:.3f}s')
+    print(f'warm:     {warm:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
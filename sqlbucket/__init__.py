@@ -1,2 +1,2 @@
 from sqlbucket.core import SQLBucket
-from sqlbucket.project import Project
+from sqlbucket.project import Project, CompiledProject
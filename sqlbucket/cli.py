@@ -1,5 +1,16 @@
 import click
-from sqlbucket.utils import logger, n_days_ago, cli_variables_parser, success
+from click.core import ParameterSource
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlbucket.explain import COST_THRESHOLD
+from sqlbucket.integrity import SAMPLE_SIZE, APPROXIMATE_RATE
+from sqlbucket.metrics import step_statistics
+from sqlbucket.profiling import profiled, profile_thread, PROFILE_TOP
+from sqlbucket.runners import check_transaction_options
+from sqlbucket.tracing import span, in_current_context
+from sqlbucket.utils import logger, n_days_ago, cli_variables_parser, \
+    log_prefix, date_partitions, success
+from tabulate import tabulate
 import sys
 import yaml
 
@@ -9,6 +20,10 @@ def load_cli(sqlbucket_object):
     @click.pass_context
     def cli(ctx):
         ctx.obj = sqlbucket_object
+        # root span of the command, loading the project included
+        ctx.with_resource(
+            span('command', {'sqlbucket.command': ctx.invoked_subcommand})
+        )
 
     @cli.command()
     @click.option('--name', '-n')
@@ -31,20 +46,84 @@ def load_cli(sqlbucket_object):
     @click.option('--to_days', '-td', required=False, default=None, type=str)
     @click.option('--group', '-g', required=False, type=str)
     @click.option('--isolation', '-i', required=False, default=None, type=str)
+    @click.option('--workers', '-w', required=False, default=1, type=int,
+                  help="Number of steps run concurrently")
     @click.option('--verbose', '-v', is_flag=True, help="Print queries")
     @click.option('--rendering', '-r', is_flag=True, help="Only render queries")
+    @click.option('--explain', '-E', is_flag=True,
+                  help="Only explain queries and compare with previous plans")
+    @click.option('--cost-threshold', '-ct', required=False,
+                  default=COST_THRESHOLD, type=float,
+                  help="Estimated cost increase flagged as a plan regression")
+    @click.option('--update-plans', '-up', is_flag=True,
+                  help="Replace the baseline plans with the explained ones")
     @click.option('--all', '-all', is_flag=True, help="All dbs")
     @click.option('--edb', '-x', required=False, type=str, help="Excluded dbs")
+    @click.option('--parallel', '-P', required=False, default=None, type=int,
+                  help="Number of dbs (or partitions) run concurrently")
+    @click.option('--split', '-S', required=False, default=None,
+                  type=click.Choice(['day', 'week', 'month']),
+                  help="Run the date range as one partition per day, week "
+                       "or month, skipping partitions already completed")
+    @click.option('--resume', '-R', is_flag=True,
+                  help="Skip steps completed by the previous failed run")
+    @click.option('--incremental', '-I', is_flag=True,
+                  help="Skip steps whose query and watermark are unchanged")
+    @click.option('--select', '-sel', required=False, default=None, type=str,
+                  help="Only steps upstream (+table) or downstream (table+) "
+                       "of tables")
+    @click.option('--transaction', '-T', is_flag=True,
+                  help="Run the steps in one transaction committed at the end")
+    @click.option('--savepoints', '-sv', is_flag=True,
+                  help="Run each step in a savepoint within the transaction")
+    @click.option('--retries', '-rt', required=False, default=0, type=int,
+                  help="Times a failed step is retried from its savepoint")
+    @click.option('--metrics', '-M', required=False, default=None, type=str,
+                  help="JSON lines file the timings of the run are added to")
+    @click.option('--prometheus', '-pm', required=False, default=None,
+                  type=str, help="Folder of the Prometheus textfile collector")
+    @click.option('--profile', '-pf', required=False, default=None, type=str,
+                  help="pstats file the profile of the run is written to")
+    @click.option('--profile-top', '-pt', required=False, default=PROFILE_TOP,
+                  type=int, help="Number of functions in the profile summary")
     @click.option('--silent', '-s', required=False, is_flag=True, default=False,
                   help="Do not notify execution status.")
     @click.pass_obj
     @click.argument('args', nargs=-1)
     def run_job(sqlbucket, name, db, fstep, tstep, to_date, from_date,
-                from_days, to_days, group, isolation, verbose, rendering,
-                all, edb, silent, args):
+                from_days, to_days, group, isolation, workers, verbose,
+                rendering, explain, cost_threshold, update_plans, all, edb,
+                parallel, split, resume, incremental, select, transaction,
+                savepoints, retries, metrics, prometheus, profile,
+                profile_top, silent, args):
+        # invalid options fail before any connection or partition starts
+        try:
+            check_transaction_options(
+                transaction, savepoints, retries, workers, isolation
+            )
+        except ValueError as e:
+            raise click.BadParameter(
+                str(e), param_hint="'--transaction' / '--savepoints' / "
+                                   "'--retries'"
+            )
+
+        # profiled until the command exits, sys.exit included
+        click.get_current_context().with_resource(
+            profiled(profile, top=profile_top)
+        )
 
         submitted_variables = cli_variables_parser(args)
 
+        # dates relative to today are left out of the key of the run to
+        # resume, so a failed run can be resumed the next day
+        context = click.get_current_context()
+        resume_exclude = list()
+        for variable, option, days in (('from', 'from_date', from_days),
+                                       ('to', 'to_date', to_days)):
+            if days is not None or context.get_parameter_source(option) == \
+                    ParameterSource.DEFAULT:
+                resume_exclude.append(variable)
+
         if from_days is not None:
             from_date = n_days_ago(int(from_days))
 
@@ -71,39 +150,158 @@ def load_cli(sqlbucket_object):
             ex_dbs = edb.split(',')
             dbs = [item for item in dbs if item not in ex_dbs]
 
-        for dbi in dbs:
-            connection_variables = sqlbucket.connection_variables[dbi]
-            if 'isolation_level' in connection_variables and isolation is None:
-                isolation = connection_variables['isolation_level']
+        # steps whose plan regressed, when explaining
+        regressions = list()
 
-            etl = sqlbucket.load_project(
-                project_name=name,
-                connection_name=dbi,
-                variables=submitted_variables
+        def run_db(etl):
+            # the isolation level of a connection never leaks to the next one
+            connection_variables = sqlbucket.connection_variables.get(
+                etl.connection_name, dict()
             )
+            isolation_level = isolation
+            if isolation_level is None:
+                isolation_level = connection_variables.get('isolation_level')
+
             if rendering:
-                etl.render(from_step=fstep, to_step=tstep, group=group)
+                etl.render(from_step=fstep, to_step=tstep, group=group,
+                           select=select)
+            elif explain:
+                plans = etl.explain(
+                    from_step=fstep, to_step=tstep, group=group,
+                    select=select, threshold=cost_threshold,
+                    verbose=verbose, update_plans=update_plans
+                )
+                regressions.extend(
+                    plan['step'] for plan in plans if plan['regressions']
+                )
             else:
-                if isolation:
-                    isolation = isolation.upper()
+                if isolation_level:
+                    isolation_level = isolation_level.upper()
 
                 etl.run(
                     from_step=fstep,
                     to_step=tstep,
                     group=group,
                     verbose=verbose,
-                    isolation_level=isolation,
+                    isolation_level=isolation_level,
+                    workers=workers,
+                    resume=resume,
+                    incremental=incremental,
+                    select=select,
+                    transaction=transaction,
+                    savepoints=savepoints,
+                    retries=retries,
+                    concurrency=concurrency,
+                    resume_exclude=resume_exclude,
+                    metrics_file=metrics,
+                    prometheus_folder=prometheus,
                     silent=silent
                 )
 
+        # backfill: one run per date partition, each one recorded when
+        # completed so it is skipped when running the backfill again.
+        partitions = [(from_date, to_date)]
+        if split:
+            try:
+                partitions = date_partitions(from_date, to_date, split)
+            except ValueError as e:
+                raise click.BadParameter(
+                    str(e), param_hint="'--from_date' / '--to_date'"
+                )
+        # partitions running in parallel share the pool of their connection
+        concurrency = workers * min(parallel or 1, len(partitions))
+        other_variables = {
+            key: value for key, value in submitted_variables.items()
+            if key not in ('from', 'to')
+        }
+        record_partitions = split is not None and not rendering \
+            and not explain
+        steps = {'from_step': fstep, 'to_step': tstep, 'select': select}
+        today = n_days_ago(0)
+
+        jobs = list()
+        for partition_from, partition_to in partitions:
+            variables = dict(submitted_variables)
+            variables['from'] = partition_from
+            variables['to'] = partition_to
+
+            # the project is compiled once and bound to each connection
+            etls = sqlbucket.load_projects(
+                project_name=name,
+                connection_names=dbs,
+                variables=variables
+            )
+            for etl in etls:
+                label = etl.connection_name
+                if split:
+                    label += f' {partition_from}/{partition_to}'
+
+                partition = (name, etl.connection_name, group, steps,
+                             other_variables, partition_from, partition_to)
+                if record_partitions and \
+                        sqlbucket.state.is_partition_completed(*partition):
+                    logger.info(f'Skipping {label}, already completed.')
+                    continue
+                jobs.append((label, (etl, partition)))
+
+        def run_job_partition(job):
+            etl, partition = job
+            run_db(etl)
+            # partitions ending today or later may still receive data, they
+            # are run again by the next backfill
+            partition_to = partition[-1]
+            if record_partitions and partition_to < today:
+                sqlbucket.state.complete_partition(*partition)
+
+        if parallel is None:
+            for _, job in jobs:
+                run_job_partition(job)
+        else:
+            statuses = run_in_parallel(run_job_partition, jobs, parallel)
+            if any(status['error'] for status in statuses):
+                sys.exit(1)
+
+        if regressions:
+            logger.error(f'{len(regressions)} plan(s) regressed.')
+            sys.exit(3)
+
     @cli.command(context_settings=dict(ignore_unknown_options=True))
     @click.option('--name', '-n', required=True, type=str)
     @click.option('--db', '-b', required=True, type=str)
     @click.option('--prefix', '-p', required=False, default='', type=str)
     @click.option('--verbose', '-v', is_flag=True, help="Print queries")
+    @click.option('--batch', '-B', is_flag=True,
+                  help="Run checks with the macros fields in one statement")
+    @click.option('--parallel', '-P', required=False, default=1, type=int,
+                  help="Number of checks run concurrently")
+    @click.option('--sample', '-sa', required=False, default=SAMPLE_SIZE,
+                  type=int, help="Number of failing rows displayed per check")
+    @click.option('--spill', '-sp', required=False, default=None, type=str,
+                  help="Folder where all failing rows are written as CSV")
+    @click.option('--incremental', '-I', is_flag=True,
+                  help="Only check rows from the last watermark passed")
+    @click.option('--approximate', '-A', is_flag=True,
+                  help="Run approximate checks on a sample of the rows")
+    @click.option('--approximate-rate', '-ar', required=False,
+                  default=APPROXIMATE_RATE, type=float,
+                  help="Share of the rows sampled by approximate checks")
+    @click.option('--fail-fast', '-F', is_flag=True,
+                  help="Stop at the first failed check")
+    @click.option('--schedule', '-sc', is_flag=True,
+                  help="Order checks by the duration of their last run")
+    @click.option('--profile', '-pf', required=False, default=None, type=str,
+                  help="pstats file the profile of the run is written to")
+    @click.option('--profile-top', '-pt', required=False, default=PROFILE_TOP,
+                  type=int, help="Number of functions in the profile summary")
     @click.pass_obj
     @click.argument('args', nargs=-1)
-    def run_integrity(sqlbucket, name, db, prefix, verbose, args):
+    def run_integrity(sqlbucket, name, db, prefix, verbose, batch, parallel,
+                      sample, spill, incremental, approximate,
+                      approximate_rate, fail_fast, schedule, profile,
+                      profile_top, args):
+        click.get_current_context().with_resource(
+            profiled(profile, top=profile_top)
+        )
 
         submitted_variables = cli_variables_parser(args)
 
@@ -115,9 +313,109 @@ def load_cli(sqlbucket_object):
             connection_name=db,
             variables=submitted_variables
         )
-        errors = etl.run_integrity(prefix=prefix, verbose=verbose)
+        approximate = approximate_rate if approximate else None
+        if approximate:
+            try:
+                etl.configure_integrity(approximate)
+            except ValueError as e:
+                raise click.BadParameter(
+                    str(e), param_hint="'--approximate' / '--approximate-rate'"
+                )
+        errors = etl.run_integrity(
+            prefix=prefix, verbose=verbose, batch=batch, workers=parallel,
+            sample_size=sample, spill_folder=spill, incremental=incremental,
+            approximate=approximate, fail_fast=fail_fast, scheduled=schedule
+        )
 
         if errors:
             sys.exit(3)
 
+    @cli.command()
+    @click.option('--name', '-n', required=True, type=str)
+    @click.option('--db', '-b', required=False, type=str)
+    @click.option('--group', '-g', required=False, type=str)
+    @click.option('--threshold', '-t', required=False, default=1.5,
+                  type=float, help="Last run slower than threshold x median "
+                                   "of the previous runs is a regression")
+    @click.pass_obj
+    def stats(sqlbucket, name, db, group, threshold):
+        history = sqlbucket.state.step_history(
+            project=name, connection=db, group=group
+        )
+        statistics = step_statistics(history, threshold=threshold)
+        if not statistics:
+            logger.info(f'No run recorded for project "{name}".')
+            return
+        log_statistics(statistics)
+
     return cli
+
+
+def log_statistics(statistics: list):
+    tabulator = [['connection', 'step', 'runs', 'p50', 'p95', 'last', '']]
+    for item in statistics:
+        tabulator.append([
+            item['connection'], item['step'], item['runs'],
+            f'{item["p50"]:.3f}s', f'{item["p95"]:.3f}s',
+            f'{item["last"]:.3f}s', 'REGRESSED' if item['regressed'] else ''
+        ])
+    logger.info('\n\n' + tabulate(tabulator, headers='firstrow',
+                                  tablefmt='pipe') + '\n')
+
+    regressed = [item for item in statistics if item['regressed']]
+    if regressed:
+        logger.warning(f'{len(regressed)} step(s) regressed: '
+                       f'{", ".join(item["step"] for item in regressed)}')
+
+
+def run_in_parallel(run_func, jobs: list, workers: int) -> list:
+    """
+    Run `run_func` for each job in its own thread, at most `workers` at a
+    time. Logs of each thread are prefixed with the label of the job,
+    typically the connection name. An exception in one job does not stop the
+    other ones.
+    :param run_func
+    :param jobs: list of (label, job) tuples, job being passed to run_func.
+    :param workers
+    :return: list of statuses with label, duration and error if any.
+    """
+
+    def run_one(labelled_job):
+        label, job = labelled_job
+        start = datetime.now()
+        status = {'connection': label, 'error': None}
+        with log_prefix(label):
+            try:
+                run_func(job)
+            except Exception as e:
+                logger.exception(e)
+                status['error'] = f'{type(e).__name__}: {e}'
+        status['duration'] = datetime.now() - start
+        return status
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [
+            executor.submit(profile_thread(in_current_context(run_one)), job)
+            for job in jobs
+        ]
+        statuses = [future.result() for future in futures]
+
+    log_statuses(statuses)
+    return statuses
+
+
+def log_statuses(statuses: list):
+    tabulator = [['connection', 'status', 'duration', 'error']]
+    for status in statuses:
+        tabulator.append([
+            status['connection'],
+            'FAILED' if status['error'] else 'success',
+            str(status['duration']),
+            status['error'] or ''
+        ])
+    logger.info('\n\n' + tabulate(tabulator, headers='firstrow',
+                                  tablefmt='pipe') + '\n')
+
+    failed = len([status for status in statuses if status['error']])
+    if failed:
+        logger.error(f'{failed}/{len(statuses)} connection(s) FAILED')
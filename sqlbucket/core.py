@@ -1,7 +1,10 @@
-from sqlbucket.project import Project
+from sqlbucket.project import Project, CompiledProject, LayeredContext
+from sqlbucket.templating import RenderCache
+from sqlbucket.state import StateStore
 from sqlbucket.exceptions import ProjectNotFound, ConnectionNotFound, \
     ReservedVariableNameError
 from sqlbucket.cli import load_cli
+from sqlbucket.tracing import span
 from pathlib import Path
 from distutils.dir_util import copy_tree
 import os
@@ -18,7 +21,12 @@ class SQLBucket:
         env_name: str = None,       # todo: see if we can remove
         environment_variables: dict = None,
         macro_folder: str = None,
-        functions_registry: List[Callable] = None
+        functions_registry: List[Callable] = None,
+        pool_options: dict = None,
+        bytecode_cache_folder: str = None,
+        render_cache: bool = False,
+        render_cache_folder: str = None,
+        state_folder: str = '.sqlbucket'
     ):
 
         self.projects_path = Path.cwd() / Path(projects_folder)
@@ -28,6 +36,12 @@ class SQLBucket:
         self.environment_variables = environment_variables or dict()
         self.env_name = env_name
         self.functions_registry = functions_registry or list()
+        self.pool_options = pool_options
+        self.bytecode_cache_path = str(Path(bytecode_cache_folder).resolve()) \
+            if bytecode_cache_folder is not None else None
+        self.render_cache = RenderCache(folder=render_cache_folder) \
+            if render_cache or render_cache_folder else None
+        self.state = StateStore(folder=str(Path.cwd() / Path(state_folder)))
 
     def load_project(self, project_name: str, connection_name: str,
                      variables: dict = None) -> Project:
@@ -38,27 +52,71 @@ class SQLBucket:
         :param variables: Typically variables submitted via CLI
         :return: Project instance
         """
-
-        if not self.connection_exists(connection_name):
-            raise ConnectionNotFound(
-                f'Connection "{connection_name}" not found.'
+        return self.load_projects(
+            project_name=project_name,
+            connection_names=[connection_name],
+            variables=variables
+        )[0]
+
+    def load_projects(self, project_name: str, connection_names: List[str],
+                      variables: dict = None) -> List[Project]:
+        """
+        Load a project for many connections. The project config is parsed
+        once, and then bound to each connection.
+        :param project_name
+        :param connection_names
+        :param variables: Typically variables submitted via CLI
+        :return: list of Project instances, in the connection names order.
+        """
+        with span('load_project', {
+            'sqlbucket.project': project_name,
+            'sqlbucket.connections': ','.join(connection_names)
+        }):
+            for connection_name in connection_names:
+                self.check_connection(connection_name)
+
+            compiled = self.compile_project(
+                project_name=project_name, variables=variables
             )
+            return [
+                self.bind_project(compiled, connection_name)
+                for connection_name in connection_names
+            ]
 
+    def compile_project(self, project_name: str,
+                        variables: dict = None) -> CompiledProject:
+        """
+        Parse the config of a project, for it to be bound to connections
+        afterwards. Its templates are compiled once, when first rendered.
+        :param project_name
+        :param variables: Typically variables submitted via CLI
+        :return: CompiledProject instance
+        """
         project_path = (self.projects_path / project_name).resolve()
         if not project_path.exists() or not project_path.is_dir():
             raise ProjectNotFound(
                 f'Project "{project_name}" does not exist.'
             )
 
-        context = self.build_context(
-            connection_name=connection_name, variables=variables
+        return CompiledProject(
+            project_path=str(project_path),
+            context=self.build_project_context(variables=variables),
+            macros_path=self.macro_path,
+            pool_options=self.pool_options,
+            bytecode_cache_path=self.bytecode_cache_path,
+            render_cache=self.render_cache,
+            state=self.state
         )
 
-        return Project(
-            project_path=str(project_path),
-            connection_url=self.connections[connection_name],
-            context=context,
-            macros_path=self.macro_path
+    def bind_project(self, compiled: CompiledProject,
+                     connection_name: str) -> Project:
+        self.check_connection(connection_name)
+        return compiled.bind(
+            connection_name=connection_name,
+            connection_url=self.get_connection_url(connection_name),
+            connection_variables=self.connection_variables.get(
+                connection_name
+            )
         )
 
     def create_project(self, project_name: str):
@@ -76,36 +134,56 @@ class SQLBucket:
             return True
         return False
 
+    def check_connection(self, connection_name: str) -> None:
+        if not self.connection_exists(connection_name):
+            raise ConnectionNotFound(
+                f'Connection "{connection_name}" not found.'
+            )
+
+    def get_connection_url(self, connection_name: str) -> str:
+        if connection_name in self.connections:
+            return self.connections[connection_name]
+        return os.environ[connection_name]
+
     def cli(self):
         command_line = load_cli(self)
         return command_line()
 
-    def build_context(self, connection_name: str, variables: dict):
-        etl_context = dict()
+    def build_context(self, connection_name: str,
+                      variables: dict = None) -> LayeredContext:
+        return LayeredContext(
+            {'c': LayeredContext(
+                {'name': connection_name},
+                self.connection_variables.get(connection_name, dict())
+            )},
+            self.build_project_context(variables=variables)
+        )
 
-        # first we add connection variables
-        etl_context['c'] = self.connection_variables.get(connection_name, dict())
-        etl_context['c']['name'] = connection_name
+    def build_project_context(self, variables: dict = None) -> LayeredContext:
+        """
+        Build the context of a project, without the connection variables.
+        Registered variables are used as layers of the context, they are never
+        modified.
+        """
+        etl_context = dict()
 
-        # then we add global variables
-        etl_context['e'] = self.environment_variables or dict()
-        etl_context['e']['name'] = self.env_name
+        # we add global variables
+        etl_context['e'] = LayeredContext(
+            {'name': self.env_name}, self.environment_variables
+        )
 
         if self.functions_registry:
-            etl_context['f'] = dict()
-            for func in self.functions_registry:
-                etl_context['f'][func.__name__] = func
-
-        if not variables:
-            return etl_context
+            etl_context['f'] = {
+                func.__name__: func for func in self.functions_registry
+            }
 
-        for key, value in variables.items():
+        variables = dict(variables or dict())
+        for key in variables:
             if key in ('c', 'e', 'f'):
                 raise ReservedVariableNameError(f'{key} is a reserved name'
                                                 f'Use another key name')
-            etl_context[key] = value
 
-        return etl_context
+        return LayeredContext(etl_context, variables)
 
     def register_function(self, func: Callable):
         self.functions_registry.append(func)
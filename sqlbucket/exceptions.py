@@ -20,3 +20,15 @@ class ReservedVariableNameError(Exception):
 
 class PassedFieldNotInQuery(Exception):
     pass
+
+
+class CircularDependency(Exception):
+    pass
+
+
+class TableNotFound(KeyError):
+    pass
+
+
+class DependencyNotFound(KeyError):
+    pass
@@ -0,0 +1,293 @@
+from sqlbucket.runners import create_connection, connection_query
+from sqlbucket.state import StateStore
+from sqlbucket.tracing import span
+from sqlbucket.utils import logger
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from tabulate import tabulate
+import difflib
+import re
+
+
+COST_THRESHOLD = 2.0
+
+# statement returning the plan of a query, per dialect
+EXPLAIN_STATEMENTS = {
+    'sqlite': 'explain query plan {query}',
+}
+DEFAULT_EXPLAIN_STATEMENT = 'explain {query}'
+
+# parts of a query: string literals, quoted names and comments are kept whole,
+# so a semicolon within them does not end the statement.
+STATEMENT_PARTS = re.compile(
+    r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|--[^\n]*|/\*.*?\*/|;"
+    r"|[^;'\"`\-/]+|.",
+    re.DOTALL
+)
+# statements the databases can explain, as opposed to plain DDL like drop
+EXPLAINABLE = re.compile(
+    r'^(select|with|insert|update|delete|merge|values)\b', re.IGNORECASE
+)
+# create table as: the query is explained, as the table usually exists already
+CREATE_AS = re.compile(
+    r'^create\b.*?\bas\s*(\(\s*(?:select|with)\b.*\)|(?:select|with)\b.*)$',
+    re.IGNORECASE | re.DOTALL
+)
+POSTGRES_COST = re.compile(r'cost=[\d.]+\.\.([\d.]+) rows=(\d+)')
+POSTGRES_FULL_SCAN = re.compile(r'\bSeq Scan on (\S+)')
+SQLITE_FULL_SCAN = re.compile(
+    r'^SCAN (?:TABLE )?(?!CONSTANT ROW|SUBQUERY\b)(\S+)(.*)$'
+)
+
+
+def explain_steps(configuration: dict, steps: list, state: StateStore = None,
+                  threshold: float = COST_THRESHOLD, verbose: bool = False,
+                  update: bool = False) -> list:
+    """
+    Explain the rendered query of each step instead of running it, and compare
+    the plans with the baseline plans stored in the state. A step regressed
+    when its plan has a full scan the baseline plan did not have, or when its
+    estimated cost is more than `threshold` times the baseline one. The plan
+    of a step is stored as its baseline when it has none yet, so a regression
+    does not silently become the new baseline.
+    :param configuration
+    :param steps: list of (index, query) tuples to explain.
+    :param state: store of the plans, plans are not compared without it.
+    :param threshold
+    :param verbose: print the plans.
+    :param update: replace the baseline plans with the current ones.
+    :return: list of dicts with step, cost, rows, full_scans, plan, previous
+    plan if any, regressions and error if the step could not be explained.
+    """
+    with span('explain', {
+        'sqlbucket.project': configuration["project_name"],
+        'sqlbucket.connection': configuration["connection_name"],
+    }):
+        connection = create_connection(configuration)
+        try:
+            results = [
+                explain_step(configuration, connection, i, query, state,
+                             threshold, verbose, update)
+                for i, query in steps
+            ]
+        finally:
+            connection.close()
+
+    log_plans(results)
+    return results
+
+
+def explain_step(configuration: dict, connection, i: int, query: str,
+                 state: StateStore = None, threshold: float = COST_THRESHOLD,
+                 verbose: bool = False, update: bool = False) -> dict:
+    result = {'step': query, 'cost': None, 'rows': None, 'full_scans': [],
+              'plan': '', 'previous': None, 'regressions': [], 'error': None}
+    rendered_query = configuration["queries"][query]
+    logger.info(f"Explaining query {str(i + 1)}: '{query}'...")
+
+    with span('explain_step', {'sqlbucket.step': query}):
+        try:
+            plans = [
+                explain_statement(connection, statement)
+                for statement in explainable_statements(rendered_query)
+            ]
+        except SQLAlchemyError as e:
+            logger.warning(f"Query '{query}' could not be explained: {e}")
+            connection_query(configuration, connection, force=True)
+            result['error'] = f'{type(e).__name__}: {e}'
+            return result
+
+    result.update(combine_plans(plans))
+    if verbose:
+        logger.info(f'\n\n{result["plan"]}\n')
+    if state is None:
+        return result
+
+    key = (configuration["project_name"], configuration["connection_name"],
+           configuration.get("group"), query)
+    result['previous'] = state.get_plan(*key)
+    if result['previous'] is not None:
+        result['regressions'] = compare_plans(
+            result['previous'], result, threshold
+        )
+        log_plan_diff(query, result['previous']['plan'], result['plan'])
+    if result['previous'] is None or update:
+        state.set_plan(*key, sql=rendered_query, plan=result)
+    return result
+
+
+def explainable_statements(query: str) -> list:
+    """
+    :return: statements of a query which can be explained, the query of a
+    `create table ... as` statement instead of the statement itself.
+    """
+    statements = list()
+    for statement in split_statements(query):
+        statement = statement.strip()
+        match = CREATE_AS.match(statement)
+        if match:
+            statement = match.group(1)
+            if statement.startswith('('):
+                statement = statement[1:-1].strip()
+        if EXPLAINABLE.match(statement):
+            statements.append(statement)
+    return statements
+
+
+def split_statements(query: str) -> list:
+    """
+    Split a query on the semicolons ending its statements, leaving out the
+    comments.
+    """
+    statements = list()
+    statement = list()
+    for part in STATEMENT_PARTS.findall(query):
+        if part == ';':
+            statements.append(''.join(statement))
+            statement = list()
+        elif part.startswith(('--', '/*')):
+            statement.append(' ')
+        else:
+            statement.append(part)
+    statements.append(''.join(statement))
+    return statements
+
+
+def explain_statement(connection, statement: str) -> dict:
+    """
+    :return: dict with plan (text), cost and rows estimated (None when the
+    database does not estimate them) and the tables fully scanned.
+    """
+    dialect = connection.dialect.name
+    explain = EXPLAIN_STATEMENTS.get(dialect, DEFAULT_EXPLAIN_STATEMENT)
+    rows = connection.execute(text(explain.format(query=statement))).fetchall()
+    if dialect == 'sqlite':
+        return parse_sqlite_plan(rows)
+    if dialect in ('mysql', 'mariadb'):
+        return parse_mysql_plan(rows)
+    return parse_text_plan(rows)
+
+
+def parse_text_plan(rows: list) -> dict:
+    """
+    Plan of PostgreSQL, Redshift and the databases returning the plan as text,
+    the first line estimating the cost and rows of the whole query.
+    """
+    lines = [str(row[0]) for row in rows]
+    plan = {'plan': '\n'.join(lines), 'cost': None, 'rows': None,
+            'full_scans': list()}
+    for line in lines:
+        match = POSTGRES_COST.search(line)
+        if match and plan['cost'] is None:
+            plan['cost'] = float(match.group(1))
+            plan['rows'] = float(match.group(2))
+        plan['full_scans'] += POSTGRES_FULL_SCAN.findall(line)
+    return plan
+
+
+def parse_sqlite_plan(rows: list) -> dict:
+    """
+    SQLite does not estimate costs, only the full scans are found.
+    """
+    details = [str(row[-1]) for row in rows]
+    full_scans = list()
+    for detail in details:
+        match = SQLITE_FULL_SCAN.match(detail)
+        if match and 'USING' not in match.group(2):
+            full_scans.append(match.group(1))
+    return {'plan': '\n'.join(details), 'cost': None, 'rows': None,
+            'full_scans': full_scans}
+
+
+def parse_mysql_plan(rows: list) -> dict:
+    """
+    MySQL estimates the rows examined per table, an access type ALL being a
+    full scan.
+    """
+    rows = [dict(row) for row in rows]
+    lines = [
+        f'{row.get("table")}: type={row.get("type")} key={row.get("key")} '
+        f'rows={row.get("rows")} {row.get("Extra") or ""}'.strip()
+        for row in rows
+    ]
+    estimates = [row['rows'] for row in rows if row.get('rows') is not None]
+    return {
+        'plan': '\n'.join(lines),
+        'cost': None,
+        'rows': float(sum(estimates)) if estimates else None,
+        'full_scans': [row['table'] for row in rows
+                       if row.get('type') == 'ALL']
+    }
+
+
+def combine_plans(plans: list) -> dict:
+    """
+    Plan of a step running several statements.
+    """
+    def total(key):
+        values = [plan[key] for plan in plans if plan[key] is not None]
+        return sum(values) if values else None
+
+    full_scans = list()
+    for plan in plans:
+        full_scans += [table for table in plan['full_scans']
+                       if table not in full_scans]
+    return {
+        'plan': '\n\n'.join(plan['plan'] for plan in plans),
+        'cost': total('cost'),
+        'rows': total('rows'),
+        'full_scans': full_scans,
+    }
+
+
+def compare_plans(previous: dict, current: dict,
+                  threshold: float = COST_THRESHOLD) -> list:
+    """
+    :return: list of the regressions of the current plan, as messages.
+    """
+    regressions = list()
+    new_scans = [table for table in current['full_scans']
+                 if table not in previous['full_scans']]
+    if new_scans:
+        regressions.append(f'new full scan of {", ".join(new_scans)}')
+
+    if previous['cost'] and current['cost'] is not None and \
+            current['cost'] > threshold * previous['cost']:
+        regressions.append(
+            f'cost x{current["cost"] / previous["cost"]:.1f} '
+            f'({previous["cost"]:g} -> {current["cost"]:g})'
+        )
+    return regressions
+
+
+def log_plan_diff(query: str, previous: str, current: str):
+    if previous == current:
+        return
+    diff = difflib.unified_diff(
+        previous.splitlines(), current.splitlines(),
+        fromfile=f'{query} (previous)', tofile=query, lineterm=''
+    )
+    logger.info(f"Plan of '{query}' changed:\n\n" + '\n'.join(diff) + '\n')
+
+
+def log_plans(results: list):
+    def number(value):
+        return '' if value is None else f'{value:g}'
+
+    tabulator = [['step', 'cost', 'previous cost', 'rows', 'full scans', '']]
+    for result in results:
+        previous = result['previous'] or dict()
+        tabulator.append([
+            result['step'], number(result['cost']),
+            number(previous.get('cost')), number(result['rows']),
+            ', '.join(result['full_scans']),
+            'ERROR' if result['error']
+            else 'REGRESSED' if result['regressions'] else ''
+        ])
+    logger.info('\n\n' + tabulate(tabulator, headers='firstrow',
+                                  tablefmt='pipe') + '\n')
+
+    for result in results:
+        if result['regressions']:
+            logger.warning(f"Plan of '{result['step']}' regressed: "
+                           f"{'; '.join(result['regressions'])}")
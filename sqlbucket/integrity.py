@@ -5,73 +5,711 @@ from sqlbucket.utils import integrity_logo, success
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlbucket.exceptions import PassedFieldNotInQuery
+from sqlbucket.state import StateStore, sql_hash
+from sqlbucket.profiling import profile_thread
+from sqlbucket.tracing import span, in_current_context
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable
+import csv
+import json
+import re
 
 
-def run_integrity(configuration: dict, prefix: str = '', verbose: bool = False):
+# Checks returning these fields, like the ones from the library macros, can be
+# combined in a single statement.
+UNIFORM_FIELDS = ('integrity_check', 'expected', 'calculated', 'passed')
+
+# Tokens of a statement, enough to find its select lists: string literals,
+# quoted identifiers and comments are kept whole.
+SQL_TOKENS = re.compile(
+    r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|--[^\n]*|/\*.*?\*/|\w+|\S",
+    re.DOTALL
+)
+# Keywords ending a select list.
+SELECT_LIST_END = {
+    'from', 'where', 'group', 'having', 'order', 'limit', 'union',
+    'intersect', 'except', 'window', 'qualify'
+}
+
+# Number of rows of a check kept in memory to be displayed.
+SAMPLE_SIZE = 100
+
+# How the approximate checks sample a table, and count distinct values with
+# the relative standard error of the approximation, per dialect. Dialects
+# without TABLESAMPLE filter rows at random instead, other dialects cannot run
+# approximate checks.
+SAMPLING_CLAUSES = {
+    'postgresql': '{table} tablesample system ({percent})',
+    'snowflake': '{table} sample system ({percent})',
+    'bigquery': '{table} tablesample system ({percent} percent)',
+    'mssql': '{table} tablesample ({percent} percent)',
+}
+RANDOM_FILTERS = {
+    'sqlite': 'abs(random()) % 1000000 < {rate} * 1000000',
+    'mysql': 'rand() < {rate}',
+    'mariadb': 'rand() < {rate}',
+    'redshift': 'random() < {rate}',
+    'trino': 'random() < {rate}',
+    'presto': 'random() < {rate}',
+    'databricks': 'rand() < {rate}',
+    'oracle': 'dbms_random.value < {rate}',
+}
+APPROXIMATE_RATE = 0.01
+APPROXIMATE_COUNT_DISTINCT = {
+    'snowflake': ('approx_count_distinct({column})', 0.0162),
+    'redshift': ('approximate count(distinct {column})', 0.02),
+    'mssql': ('approx_count_distinct({column})', 0.02),
+    'trino': ('approx_distinct({column})', 0.023),
+    'presto': ('approx_distinct({column})', 0.023),
+    'databricks': ('approx_count_distinct({column})', 0.05),
+}
+
+
+def run_integrity(configuration: dict, prefix: str = '', verbose: bool = False,
+                  batch: bool = False, workers: int = 1,
+                  sample_size: int = SAMPLE_SIZE, spill_folder: str = None,
+                  incremental: bool = False, state: StateStore = None,
+                  fail_fast: bool = False, scheduled: bool = False):
+    with span('integrity', {
+        'sqlbucket.project': configuration["project_name"],
+        'sqlbucket.connection': configuration["connection_name"],
+    }) as integrity_span:
+        errors = run_checks(
+            configuration, prefix, verbose, batch, workers, sample_size,
+            spill_folder, incremental, state, fail_fast, scheduled
+        )
+        integrity_span.set_attribute('sqlbucket.errors', errors)
+    return errors
+
+
+def run_checks(configuration: dict, prefix: str = '', verbose: bool = False,
+               batch: bool = False, workers: int = 1,
+               sample_size: int = SAMPLE_SIZE, spill_folder: str = None,
+               incremental: bool = False, state: StateStore = None,
+               fail_fast: bool = False, scheduled: bool = False) -> int:
+    """
+    :param state: store of the watermarks of the incremental checks and of the
+    durations of the checks.
+    :param scheduled: order the checks by the duration of their last run, and
+    record their durations for the next runs.
+    :return: number of errors
+    """
     errors = 0
     logger.info(integrity_logo)
     logger.info(
         f'Starting integrity checks for {configuration["project_name"]} '
         f'with connection {configuration["connection_name"]}'
     )
-    number_of_tests_ran = 0
-    connection = create_connection(configuration)
-    for query_name in configuration["order"]:
+    approximate = configuration.get("approximate")
+    if approximate:
+        log_approximation(approximate)
+    order = [
+        query_name for query_name in configuration["order"]
+        if query_name.startswith(prefix)
+    ]
+    skipped = 0
+    connection = create_connection(configuration, concurrency=workers)
+    try:
+        pending_watermarks = dict()
+        if incremental and state is not None:
+            queries, carried_forward, pending_watermarks = plan_incremental(
+                configuration, connection, order, state
+            )
+            order = [
+                query_name for query_name in order
+                if query_name not in carried_forward
+            ]
+            skipped = len(carried_forward)
+            configuration = dict(configuration, queries=queries)
 
-        if not query_name.startswith(prefix):
-            continue
-        number_of_tests_ran += 1
-        query = configuration["queries"][query_name]
-        if verbose:
-            logger.info(f'Now running:\n\n{query}')
+        if scheduled and state is not None:
+            order = schedule(
+                order,
+                state.check_durations(configuration["project_name"],
+                                      configuration["connection_name"]),
+                longest_first=workers > 1
+            )
 
-        try:
+        checks = dict()
+
+        def new_check(query_name, rows=()):
+            spill_path = None
+            if spill_folder is not None:
+                spill_path = spill_file(
+                    spill_folder, configuration["connection_name"], query_name
+                )
             integrity = IntegrityCheck(
-                rows=[dict(row) for row in connection.execute(text(query))],
-                query_name=query_name
+                rows=rows, query_name=query_name, sample_size=sample_size,
+                spill_path=spill_path
             )
-            integrity.log_summary(query_name)
-            if not integrity.has_passed():
-                errors += 1
-                logger.info(
-                    f"Showing integrity report for {query_name.upper()}: \n")
-                integrity.log_rows()
-                logger.info(query + '\n')
+            checks[query_name] = integrity
+            return integrity
 
-        except SQLAlchemyError as e:
-            errors += 1
-            logger.info(f'Query {query_name} encountered an error:')
-            logger.error(e)
-            connection_query(configuration, connection)
-            continue
+        batched_checks = dict()
+        if batch:
+            batched_checks = run_batch(
+                configuration, connection, order, verbose, new_check
+            )
+
+        if workers > 1:
+            connection.close()
+            errors += run_parallel(
+                configuration, order, batched_checks, workers, verbose,
+                new_check, fail_fast
+            )
+        else:
+            for i, query_name in enumerate(order):
+                if fail_fast and errors:
+                    logger.error(f'Stopping at first failure, '
+                                 f'{len(order) - i} check(s) not run.')
+                    break
+
+                query = configuration["queries"][query_name]
+                if verbose and query_name not in batched_checks:
+                    logger.info(f'Now running:\n\n{query}')
+
+                try:
+                    integrity = batched_checks.get(query_name)
+                    if integrity is None:
+                        with span('integrity_check',
+                                  {'sqlbucket.check': query_name}):
+                            start = datetime.now()
+                            integrity = new_check(
+                                query_name, stream_rows(connection, query)
+                            )
+                            integrity.duration = \
+                                (datetime.now() - start).total_seconds()
+                    errors += evaluate_check(
+                        query_name, query, integrity, approximate
+                    )
 
-    # logging summary
+                except SQLAlchemyError as e:
+                    errors += 1
+                    logger.info(f'Query {query_name} encountered an error:')
+                    logger.error(e)
+                    connection_query(configuration, connection, force=True)
+                    continue
+    finally:
+        connection.close()
+
+    if scheduled and state is not None:
+        state.set_check_durations(
+            configuration["project_name"], configuration["connection_name"],
+            {
+                query_name: integrity.duration
+                for query_name, integrity in checks.items()
+                if integrity.duration is not None
+            }
+        )
+
+    # watermarks only move forward when the new rows passed the check
+    for query_name, (full_query, watermark) in pending_watermarks.items():
+        integrity = checks.get(query_name)
+        if integrity is not None and integrity.has_passed():
+            state.set_integrity_watermark(
+                configuration["project_name"],
+                configuration["connection_name"],
+                query_name, full_query, watermark
+            )
+            logger.info(f'Watermark of {query_name} moved to {watermark}.')
+
+    # logging summary, skipped checks are neither passed nor failed
+    number_of_tests_ran = len(order)
+    skipped_summary = f', {skipped} skipped' if skipped else ''
     if not errors:
         logger.info(f'ALL PASSED - '
-                    f'({str(number_of_tests_ran)}/{str(number_of_tests_ran)})')
+                    f'({str(number_of_tests_ran)}/{str(number_of_tests_ran)})'
+                    f'{skipped_summary}')
         logger.info(success)
 
+    elif fail_fast:
+        logger.error(f'\n\n########## {str(errors)} ERROR(S) ##########'
+                     f'\nINTEGRITY FAILURE - stopped at first failure\n\n')
+
     else:
         logger.error(f'\n\n########## {str(errors)} ERROR(S) ##########'
                      f'\nINTEGRITY FAILURE - '
                      f'({str(number_of_tests_ran - errors)}/'
-                     f'{str(number_of_tests_ran)})\n\n')
+                     f'{str(number_of_tests_ran)}){skipped_summary}\n\n')
     return errors
 
 
+def schedule(order: list, durations: dict,
+             longest_first: bool = False) -> list:
+    """
+    Order the checks by the duration of their last run. Cheapest checks run
+    first, so that a broken load is reported early. When running checks in
+    parallel, longest checks start first instead, so that they do not end up
+    running alone at the end (longest processing time scheduling). Checks
+    never timed keep their order, after the timed ones when cheapest run first
+    and before them otherwise.
+    :param order: names of the checks.
+    :param durations: dict of check -> duration in seconds.
+    :param longest_first
+    """
+    timed = sorted(
+        [query_name for query_name in order if query_name in durations],
+        key=lambda query_name: durations[query_name],
+        reverse=longest_first
+    )
+    untimed = [
+        query_name for query_name in order if query_name not in durations
+    ]
+    if longest_first:
+        return untimed + timed
+    return timed + untimed
+
+
+def approximate_globals(dialect: str, rate: float) -> dict:
+    """
+    Settings of the approximate checks, given to the templates, library macros
+    included, as the `approximate` global variable.
+    :param dialect: name of the database backend, like postgresql.
+    :param rate: share of the rows sampled, between 0 and 1.
+    """
+    if not 0 < rate <= 1:
+        raise ValueError(f'Sampling rate must be between 0 and 1, got {rate}')
+
+    sample = SAMPLING_CLAUSES.get(dialect)
+    if sample is not None:
+        sample = sample.replace('{percent}', f'{rate * 100:g}')
+    else:
+        random_filter = RANDOM_FILTERS.get(dialect)
+        if random_filter is None:
+            raise ValueError(f'Approximate checks are not supported on '
+                             f'{dialect}, tables cannot be sampled')
+        sample = (
+            '(select * from {table} where '
+            + random_filter.replace('{rate}', f'{rate:g}')
+            + ') as sqlbucket_sample'
+        )
+
+    count_distinct, distinct_error = APPROXIMATE_COUNT_DISTINCT.get(
+        dialect, (None, None)
+    )
+    return {
+        'rate': rate,
+        'dialect': dialect,
+        'sample': sample,
+        'suffix': f'_sampled_{rate * 100:g}pct',
+        'count_distinct': count_distinct,
+        'distinct_error': distinct_error,
+    }
+
+
+def log_approximation(approximate: dict):
+    method = 'tablesample' if approximate['dialect'] in SAMPLING_CLAUSES \
+        else 'random filter'
+    logger.info(f'Approximate checks on a {approximate["rate"]:.2%} sample of '
+                f'the rows ({method} on {approximate["dialect"]}).')
+    if approximate['count_distinct']:
+        logger.info(f'Distinct values are approximated on all the rows, with '
+                    f'a relative error within '
+                    f'{3 * approximate["distinct_error"]:.2%}.')
+
+
+def log_error_bounds(integrity: 'IntegrityCheck', approximate: dict):
+    """
+    Log the error bounds of approximate rows. For a check on a sample, the
+    ratio between calculated and expected is known within
+    1.5 * sqrt((1 - rate) / n) with 99.7% confidence, n being the number of
+    rows sampled.
+    """
+    correction = (1 - approximate['rate']) ** 0.5
+    for row in integrity.rows:
+        name = str(row.get('integrity_check', ''))
+        if name.endswith('_approx'):
+            logger.info(f'{name}: relative error within '
+                        f'{3 * approximate["distinct_error"]:.2%}')
+            continue
+        if not name.endswith(approximate['suffix']):
+            continue
+        try:
+            counts = sorted([float(row['expected']), float(row['calculated'])])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not counts[1]:
+            continue
+        logger.info(f'{name}: ratio {counts[0] / counts[1]:.2%} '
+                    f'± {1.5 * correction / counts[1] ** 0.5:.2%} over '
+                    f'{counts[1]:g} sampled rows '
+                    f'({approximate["rate"]:.2%} sampling rate)')
+
+
+def plan_incremental(configuration: dict, connection, order: list,
+                     state: StateStore) -> tuple:
+    """
+    Resolve the checks to run incrementally. For a check with a watermark
+    query declared in config.yaml, only the rows from the watermark of the
+    last time it passed are checked: this watermark is given to its template
+    as the `watermark` variable. If the watermark did not move since, the
+    check does not run and is reported as skipped. Checks without watermark
+    query, or whose query changed, check all the rows.
+    :return: tuple of the queries to run, the checks skipped, and a
+    dict of check -> (query checking all the rows, new watermark) to record
+    once the check passed.
+    """
+    queries = configuration["queries"]
+    watermarks = configuration.get("watermarks") or dict()
+    incremental_queries = dict()
+    carried_forward = list()
+    pending_watermarks = dict()
+
+    for query_name in order:
+        full_query = queries[query_name]
+        incremental_queries[query_name] = full_query
+        if query_name not in watermarks:
+            continue
+
+        try:
+            watermark = json.dumps(
+                connection.execute(text(watermarks[query_name])).scalar(),
+                default=str
+            )
+        except SQLAlchemyError as e:
+            logger.warning(f'Watermark query of {query_name} failed, all rows '
+                           f'will be checked: {e}')
+            connection_query(configuration, connection, force=True)
+            continue
+
+        previous = state.get_integrity_watermark(
+            configuration["project_name"], configuration["connection_name"],
+            query_name
+        )
+        if previous is not None and previous[0] != sql_hash(full_query):
+            logger.info(f'Check {query_name} changed since last time it '
+                        f'passed, all rows will be checked.')
+            previous = None
+
+        if previous is not None and previous[1] == watermark:
+            logger.info(f'No new rows for {query_name} since watermark '
+                        f'{watermark}, skipped.')
+            carried_forward.append(query_name)
+            continue
+
+        if previous is not None:
+            logger.info(f'Checking rows of {query_name} from watermark '
+                        f'{previous[1]}.')
+            incremental_queries[query_name] = queries.render(
+                query_name, {'watermark': json.loads(previous[1])}
+            )
+        pending_watermarks[query_name] = (full_query, watermark)
+
+    return incremental_queries, carried_forward, pending_watermarks
+
+
+def stream_rows(connection, query: str):
+    """
+    Execute a check, fetching its rows by chunks from a server side cursor
+    when the dialect supports it, instead of loading them all at once.
+    """
+    return connection.execution_options(stream_results=True).execute(
+        text(query)
+    )
+
+
+def spill_file(spill_folder: str, connection_name: str,
+               query_name: str) -> str:
+    """
+    Path of the CSV file failing rows of a check are written to, as
+    <spill_folder>/<connection_name>/<query_name>.csv
+    """
+    return str(
+        Path(spill_folder) / connection_name / f'{query_name}.csv'
+    )
+
+
+def evaluate_check(query_name: str, query: str, integrity: 'IntegrityCheck',
+                   approximate: dict = None) -> int:
+    """
+    Log the result of a check.
+    :param approximate: settings of the approximate checks, if any.
+    :return: number of errors, 1 if the check failed, 0 otherwise.
+    """
+    integrity.log_summary(query_name)
+    if approximate:
+        log_error_bounds(integrity, approximate)
+    if integrity.has_passed():
+        return 0
+
+    logger.info(f"Showing integrity report for {query_name.upper()}: \n")
+    integrity.log_rows()
+    logger.info(query + '\n')
+    return 1
+
+
+def run_parallel(configuration: dict, order: list, batched_checks: dict,
+                 workers: int, verbose: bool = False,
+                 new_check=None, fail_fast: bool = False) -> int:
+    """
+    Run the checks on at most `workers` threads. Each check checks out its own
+    pooled connection, on which the connection query was run once. A
+    connection on which a check failed is discarded from the pool, so a
+    failure never affects the other checks. Results are logged from the
+    calling thread, as checks complete. Rows are consumed in the worker
+    thread, while its connection is checked out. Checks are submitted in the
+    order given, and with `fail_fast`, checks not started yet are cancelled at
+    the first failure.
+    :return: number of errors
+    """
+    new_check = new_check or IntegrityCheck
+
+    def fetch_check(query_name):
+        query = configuration["queries"][query_name]
+        if verbose:
+            logger.info(f'Now running {query_name}:\n\n{query}')
+        with span('integrity_check', {'sqlbucket.check': query_name}):
+            connection = create_connection(configuration, concurrency=workers)
+            try:
+                start = datetime.now()
+                integrity = new_check(
+                    query_name=query_name, rows=stream_rows(connection, query)
+                )
+                integrity.duration = (datetime.now() - start).total_seconds()
+                return integrity
+            except SQLAlchemyError:
+                connection.invalidate()
+                raise
+            finally:
+                connection.close()
+
+    errors = 0
+    for query_name, integrity in batched_checks.items():
+        if query_name in order:
+            errors += evaluate_check(
+                query_name, configuration["queries"][query_name], integrity,
+                configuration.get("approximate")
+            )
+    if fail_fast and errors:
+        logger.error('Stopping at first failure, remaining checks not run.')
+        return errors
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                profile_thread(in_current_context(fetch_check)), query_name
+            ): query_name
+            for query_name in order if query_name not in batched_checks
+        }
+        for future in as_completed(futures):
+            query_name = futures[future]
+            try:
+                errors += evaluate_check(
+                    query_name, configuration["queries"][query_name],
+                    future.result(), configuration.get("approximate")
+                )
+            except SQLAlchemyError as e:
+                errors += 1
+                logger.info(f'Query {query_name} encountered an error:')
+                logger.error(e)
+
+            if fail_fast and errors:
+                cancelled = [future for future in futures if future.cancel()]
+                logger.error(f'Stopping at first failure, {len(cancelled)} '
+                             f'check(s) not run.')
+                break
+
+    return errors
+
+
+def is_batchable(query: str) -> bool:
+    """
+    A check can be batched if it is a single statement returning exactly the
+    uniform fields of the library macros, as any other column would be lost
+    in the batch.
+    """
+    statement = query.strip().rstrip(';')
+    if ';' in statement:
+        return False
+    select_lists = top_level_select_lists(statement)
+    return bool(select_lists) and all(
+        len(columns) == len(UNIFORM_FIELDS)
+        and {column_alias(column) for column in columns} ==
+        set(UNIFORM_FIELDS)
+        for columns in select_lists
+    )
+
+
+def top_level_select_lists(statement: str) -> list:
+    """
+    Columns of the selects of a statement outside of any parenthesis, the
+    ones giving the columns of its result, the selects of common table
+    expressions and subqueries being ignored.
+    :return: list of select lists, each of them a list of columns, each
+    column being a list of tokens.
+    """
+    select_lists = list()
+    columns = None
+    depth = 0
+    for token in SQL_TOKENS.findall(statement):
+        if token.startswith(('--', '/*')):
+            continue
+        if token == ')':
+            depth -= 1
+        keyword = token.lower()
+        if depth == 0 and keyword == 'select':
+            columns = [[]]
+            select_lists.append(columns)
+        elif depth == 0 and keyword in SELECT_LIST_END:
+            columns = None
+        elif columns is not None:
+            if depth == 0 and token == ',':
+                columns.append([])
+            else:
+                columns[-1].append(token)
+        if token == '(':
+            depth += 1
+    return select_lists
+
+
+def column_alias(column: list) -> str:
+    """
+    :return: alias of a column given as tokens, in lower case, if given with
+    `as`.
+    """
+    if len(column) >= 3 and column[-2].lower() == 'as':
+        return column[-1].strip('"`').lower()
+    return None
+
+
+def batch_query(queries: dict) -> str:
+    """
+    Combine checks in a single statement, each row being tagged with the name
+    of the check it comes from.
+    :param queries: dict of query name -> rendered query.
+    """
+    selects = list()
+    for i, (query_name, query) in enumerate(queries.items()):
+        name = query_name.replace("'", "''")
+        selects.append(
+            f"select '{name}' as sqlbucket_check, "
+            f"{', '.join(UNIFORM_FIELDS)}\n"
+            f"from (\n{query.strip().rstrip(';')}\n) as sqlbucket_check_{i}"
+        )
+    return '\nunion all\n'.join(selects)
+
+
+def run_batch(configuration: dict, connection, order: list,
+              verbose: bool = False, new_check=None) -> dict:
+    """
+    Run all the batchable checks in one round trip. If the batch fails, for
+    instance because of incompatible types between checks, an empty result is
+    returned and the checks run one by one. The duration of the batch is split
+    evenly between its checks, so they can be scheduled when run one by one.
+    :return: dict of query name -> IntegrityCheck
+    """
+    new_check = new_check or IntegrityCheck
+    queries = {
+        query_name: configuration["queries"][query_name]
+        for query_name in order
+        if is_batchable(configuration["queries"][query_name])
+    }
+    if len(queries) < 2:
+        return dict()
+
+    query = batch_query(queries)
+    logger.info(f'Running {len(queries)} integrity checks in one batch.')
+    if verbose:
+        logger.info(f'Now running:\n\n{query}')
+
+    with span('integrity_batch', {'sqlbucket.checks': len(queries)}):
+        start = datetime.now()
+        try:
+            result = stream_rows(connection, query)
+        except SQLAlchemyError as e:
+            logger.warning(f'Batch of integrity checks failed, running them '
+                           f'one by one instead: {e}')
+            connection_query(configuration, connection, force=True)
+            return dict()
+
+        checks = {query_name: new_check(query_name=query_name)
+                  for query_name in queries}
+        try:
+            for row in result:
+                row = dict(row)
+                checks[row.pop('sqlbucket_check')].add(row)
+        finally:
+            duration = (datetime.now() - start).total_seconds() / len(checks)
+            for integrity in checks.values():
+                integrity.close()
+                integrity.duration = duration
+    return checks
+
+
 class IntegrityCheck:
+    """
+    Result of an integrity check. Rows are consumed in a single pass, so they
+    can come straight from a cursor: only the counts of passed and failed
+    rows, the first rows and a sample of the failing rows are kept in memory.
+    :param rows: iterable of rows, typically the result of the check query.
+    :param query_name
+    :param sample_size: maximum number of rows kept to be displayed.
+    :param spill_path: CSV file all the failing rows are written to, if any.
+    """
 
-    def __init__(self, rows: list, query_name: str):
-        self.rows = rows
+    def __init__(self, rows: Iterable = (), query_name: str = None,
+                 sample_size: int = SAMPLE_SIZE, spill_path: str = None):
         self.query_name = query_name
+        self.sample_size = sample_size
+        self.spill_path = spill_path
+        self.count = 0
+        self.succeeded = 0
+        self.keys = None
+        self.rows = list()
+        self.failed_rows = list()
+        self.spill_stream = None
+        self.spill_writer = None
+        self.duration = None
+        self.consume(rows)
+
+    @property
+    def failed(self) -> int:
+        return self.count - self.succeeded
+
+    def consume(self, rows: Iterable):
+        try:
+            for row in rows:
+                self.add(row)
+        finally:
+            self.close()
+
+    def add(self, row):
+        row = row if isinstance(row, dict) else dict(row)
+        if self.keys is None:
+            self.keys = list(row.keys())
+
+        self.count += 1
+        if len(self.rows) < self.sample_size:
+            self.rows.append(row)
+        if row.get("passed"):
+            self.succeeded += 1
+            return
+
+        if len(self.failed_rows) < self.sample_size:
+            self.failed_rows.append(row)
+        if self.spill_path is not None:
+            self.spill(row)
+
+    def spill(self, row: dict):
+        if self.spill_writer is None:
+            Path(self.spill_path).parent.mkdir(parents=True, exist_ok=True)
+            self.spill_stream = open(self.spill_path, 'w', newline='')
+            self.spill_writer = csv.DictWriter(
+                self.spill_stream, fieldnames=self.keys, extrasaction='ignore'
+            )
+            self.spill_writer.writeheader()
+        self.spill_writer.writerow(row)
+
+    def close(self):
+        if self.spill_stream is not None:
+            self.spill_stream.close()
+            self.spill_stream = None
+            self.spill_writer = None
 
     def has_passed(self) -> bool:
-        if not self.rows:
-            return True
-        for item in self.rows:
-            if not item["passed"]:
-                return False
-        return True
+        return self.failed == 0
 
     def log_summary(self, query_name: str) -> str:
 
@@ -80,36 +718,41 @@ class IntegrityCheck:
                                         'Make sure you add it as an alias '
                                         'and that it returns a boolean')
 
-        succeeded = len([item for item in self.rows if item["passed"]])
         status = "success" if self.has_passed() else "FAILED"
         logger.info(
-            f'Integrity {status}, ({succeeded}/{len(self.rows)}) '
+            f'Integrity {status}, ({self.succeeded}/{self.count}) '
             f'for {query_name}'
         )
-        if not self.rows:
+        if not self.count:
             logger.warning(f'No rows returned from {self.query_name} integrity'
                            f' check. We make it pass, but makes sure this is'
                            f' expected behavior.')
         return status
 
     def log_rows(self) -> print:
-        if not self.rows:
+        if not self.count:
             print('No rows to display')
             return
-        keys = self.rows[0].keys()
-        tabulator = [list(keys)]
-        for item in self.rows:
+
+        # all the rows when they fit in the sample, the failing ones otherwise
+        rows = self.rows
+        if self.count > self.sample_size:
+            rows = self.failed_rows
+            logger.info(f'Showing {len(rows)} of {self.failed} failing rows.')
+        if self.spill_path is not None and self.failed:
+            logger.info(f'All failing rows written to {self.spill_path}')
+
+        tabulator = [list(self.keys)]
+        for item in rows:
             array_item = list()
-            for k in keys:
+            for k in self.keys:
                 array_item.append(item[k])
             tabulator.append(array_item)
         print(tabulate(tabulator, headers="firstrow", tablefmt="pipe") + '\n')
 
     def is_passed_field_missing(self):
-        if not self.rows:
+        if self.keys is None:
             return False
-        first_item = self.rows[0]
-        if 'passed' in first_item:
+        if 'passed' in self.keys:
             return False
         return True
-
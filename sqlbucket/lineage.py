@@ -0,0 +1,197 @@
+from sqlbucket.exceptions import TableNotFound
+from sqlbucket.state import sql_hash
+import re
+
+
+# Parsing is based on regular expressions. It covers the usual statements of
+# an ETL and is not meant to be a full SQL parser.
+NAME = r'((?:[\w$]+|"[^"]+"|`[^`]+`|\[[^\]]+\])' \
+       r'(?:\s*\.\s*(?:[\w$]+|"[^"]+"|`[^`]+`|\[[^\]]+\]))*)'
+
+WRITE_PATTERNS = [
+    r'\binsert\s+(?:into|overwrite)\s+(?:table\s+)?' + NAME,
+    r'\bcreate\s+(?:or\s+replace\s+)?(?:(?:local\s+|global\s+)?'
+    r'(?:temp|temporary)\s+)?(?:table|view|materialized\s+view)\s+'
+    r'(?:if\s+not\s+exists\s+)?' + NAME,
+    r'\bupdate\s+' + NAME + r'\s+set\b',
+    r'\bdelete\s+from\s+' + NAME,
+    r'\bmerge\s+into\s+' + NAME,
+    r'\btruncate\s+(?:table\s+)?' + NAME,
+    r'\bdrop\s+(?:table|view|materialized\s+view)\s+(?:if\s+exists\s+)?' + NAME,
+    r'\balter\s+table\s+(?:if\s+exists\s+)?' + NAME,
+    r'\bcopy\s+' + NAME + r'\s+from\b',
+]
+
+READ_PATTERNS = [
+    r'\b(?:from|join|using)\s+' + NAME,
+]
+
+CTE_PATTERN = r'(?:\bwith|,)\s*(?:recursive\s+)?([\w$]+)\s*(?:\([^)]*\)\s*)?' \
+              r'as\s*\('
+
+KEYWORDS = {'select', 'lateral', 'unnest', 'values', 'table', 'only'}
+
+# opening parenthesis, with the word before it if any: a function call when
+# the word is not a keyword, like extract(day from created_at).
+PARENTHESIS = r'(?:([\w$]+)\s*)?\(|\)'
+NOT_CALLS = {
+    'in', 'exists', 'as', 'from', 'join', 'lateral', 'any', 'all', 'some',
+    'on', 'and', 'or', 'not', 'where', 'select', 'union', 'intersect',
+    'except', 'values', 'when', 'then', 'else', 'by', 'with', 'is', 'using',
+    'into', 'table', 'recursive'
+}
+
+# tables found per rendered query hash, shared by all the projects
+_tables_cache = dict()
+
+
+def normalize(name: str) -> str:
+    parts = re.split(r'\s*\.\s*', name.strip())
+    return '.'.join(part.strip('"`[]').lower() for part in parts)
+
+
+def clean(sql: str) -> str:
+    sql = re.sub(r'--[^\n]*', ' ', sql)
+    sql = re.sub(r'/\*.*?\*/', ' ', sql, flags=re.DOTALL)
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def query_tables(sql: str) -> tuple:
+    """
+    Find the tables read and written by a rendered query.
+    :param sql: rendered query, possibly made of several statements.
+    :return: tuple of the set of tables read and the set of tables written.
+    """
+    key = sql_hash(sql)
+    if key in _tables_cache:
+        return _tables_cache[key]
+
+    sql = clean(sql)
+    flags = re.IGNORECASE | re.DOTALL
+
+    writes = set()
+    for pattern in WRITE_PATTERNS:
+        for match in re.finditer(pattern, sql, flags):
+            writes.add(normalize(match.group(1)))
+        # a table written is not read by the same clause (delete from ...)
+        sql = re.sub(pattern, ' ', sql, flags=flags)
+
+    ctes = {
+        match.group(1).lower() for match in re.finditer(CTE_PATTERN, sql, flags)
+    }
+
+    calls = function_calls(sql)
+    reads = set()
+    for pattern in READ_PATTERNS:
+        for match in re.finditer(pattern, sql, flags):
+            # from within a function call, like substring(x from 2)
+            if any(start <= match.start() < end for start, end in calls):
+                continue
+            name = normalize(match.group(1))
+            if name not in ctes and name not in KEYWORDS:
+                reads.add(name)
+
+    _tables_cache[key] = (reads, writes)
+    return reads, writes
+
+
+def function_calls(sql: str) -> list:
+    """
+    :return: list of (start, end) positions of a cleaned query directly within
+    the parenthesis of a function call, a subquery given as argument, like in
+    coalesce((select ...), 0), being left out.
+    """
+    calls = list()
+    opened = list()
+    start = None
+    for match in re.finditer(PARENTHESIS, sql):
+        if start is not None:
+            calls.append((start, match.start()))
+            start = None
+        if match.group(0) == ')':
+            if opened:
+                opened.pop()
+        else:
+            word = match.group(1)
+            opened.append(word is not None and word.lower() not in NOT_CALLS)
+        if opened and opened[-1]:
+            start = match.end()
+    if start is not None:
+        calls.append((start, len(sql)))
+    return calls
+
+
+class LineageIndex:
+    """
+    Tables read and written by each query of a configuration, used to select
+    the queries upstream or downstream of a table.
+    """
+    def __init__(self, configuration: dict):
+        self.order = configuration["order"]
+        self.tables = {
+            query: query_tables(configuration["queries"][query])
+            for query in self.order
+        }
+
+    def readers(self, tables: set) -> set:
+        return {q for q in self.order if self.tables[q][0] & tables}
+
+    def writers(self, tables: set) -> set:
+        return {q for q in self.order if self.tables[q][1] & tables}
+
+    def downstream(self, table: str) -> set:
+        """
+        :return: queries writing the table, and every query depending on it
+        directly or through other tables.
+        """
+        queries = self.writers({table})
+        tables = {table}
+        while True:
+            readers = self.readers(tables) - queries
+            if not readers:
+                return queries
+            queries |= readers
+            for query in readers:
+                tables |= self.tables[query][1]
+
+    def upstream(self, table: str) -> set:
+        """
+        :return: queries writing the table, and every query it depends on
+        directly or through other tables.
+        """
+        queries = set()
+        tables = {table}
+        while True:
+            writers = self.writers(tables) - queries
+            if not writers:
+                return queries
+            queries |= writers
+            for query in writers:
+                tables |= self.tables[query][0]
+
+    def select(self, selector: str) -> list:
+        """
+        Select queries from table selectors, separated by commas:
+            - `table+`: queries writing the table and all queries downstream.
+            - `+table`: queries writing the table and all queries upstream.
+            - `+table+`: both.
+            - `table`: queries writing the table.
+        :return: selected queries, in the order of the configuration.
+        """
+        selected = set()
+        for item in selector.split(','):
+            item = item.strip()
+            table = normalize(item.strip('+'))
+            if not any(table in reads | writes
+                       for reads, writes in self.tables.values()):
+                raise TableNotFound(
+                    f'Table "{table}" is not used by any query.'
+                )
+
+            selected |= self.writers({table})
+            if item.endswith('+'):
+                selected |= self.downstream(table)
+            if item.startswith('+'):
+                selected |= self.upstream(table)
+
+        return [query for query in self.order if query in selected]
@@ -0,0 +1,186 @@
+from datetime import datetime
+from pathlib import Path
+import json
+import math
+import os
+import threading
+import uuid
+
+
+_file_lock = threading.Lock()
+
+
+class RunMetrics:
+    """
+    Timings of a run: connect time, total time, and for each step its render
+    time, execute time and rowcount. Steps can be recorded from several
+    threads.
+    """
+    def __init__(self, project: str, connection: str, group: str = None):
+        self.run_id = uuid.uuid4().hex
+        self.project = project
+        self.connection = connection
+        self.group = group or ''
+        self.started_at = datetime.now()
+        self.status = 'running'
+        self.total_seconds = None
+        self.connect_seconds = 0.0
+        self.steps = list()
+        self._lock = threading.Lock()
+
+    def record_connect(self, seconds: float) -> None:
+        with self._lock:
+            self.connect_seconds += seconds
+
+    def record_step(self, step: str, status: str, render_seconds: float = None,
+                    execute_seconds: float = None,
+                    rowcount: int = None) -> None:
+        """
+        :param status: success, skipped or failed.
+        :param rowcount: rows affected as reported by the driver, None if the
+        driver does not report it.
+        """
+        if rowcount is not None and rowcount < 0:
+            rowcount = None
+        with self._lock:
+            self.steps.append({
+                'step': step,
+                'status': status,
+                'render_seconds': render_seconds,
+                'execute_seconds': execute_seconds,
+                'rowcount': rowcount,
+            })
+
+    def finish(self, status: str) -> None:
+        self.status = status
+        self.total_seconds = (datetime.now() - self.started_at).total_seconds()
+
+    def to_record(self) -> dict:
+        return {
+            'run_id': self.run_id,
+            'project': self.project,
+            'connection': self.connection,
+            'group': self.group,
+            'started_at': self.started_at.isoformat(),
+            'status': self.status,
+            'total_seconds': self.total_seconds,
+            'connect_seconds': self.connect_seconds,
+            'steps': list(self.steps),
+        }
+
+    def write_jsonl(self, path: str) -> None:
+        """
+        Append the record of the run as one JSON line.
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps(self.to_record(), default=str)
+        with _file_lock, open(path, 'a') as f:
+            f.write(line + '\n')
+
+    def write_prometheus(self, folder: str) -> str:
+        """
+        Write the metrics of the run in the Prometheus text format, in a file
+        per project and connection, to be collected by the textfile collector
+        of the node exporter. The file is named after the project, connection
+        and group, so runs of different groups do not replace each other. The
+        file is replaced atomically.
+        :return: path of the file.
+        """
+        labels = {'project': self.project, 'connection': self.connection,
+                  'group': self.group}
+        lines = list()
+
+        def gauge(name, help_text, samples):
+            lines.append(f'# HELP sqlbucket_{name} {help_text}')
+            lines.append(f'# TYPE sqlbucket_{name} gauge')
+            for sample_labels, value in samples:
+                if value is not None:
+                    lines.append(
+                        f'sqlbucket_{name}{{{format_labels(sample_labels)}}} '
+                        f'{value}'
+                    )
+
+        gauge('run_total_seconds', 'Duration of the last run.',
+              [(labels, self.total_seconds)])
+        gauge('run_connect_seconds', 'Time spent connecting in the last run.',
+              [(labels, self.connect_seconds)])
+        gauge('run_success', 'Whether the last run succeeded.',
+              [(labels, int(self.status == 'success'))])
+        gauge('run_timestamp_seconds', 'Start time of the last run.',
+              [(labels, self.started_at.timestamp())])
+        for metric, help_text in (
+            ('render_seconds', 'Render time of the step in the last run.'),
+            ('execute_seconds', 'Execute time of the step in the last run.'),
+            ('rowcount', 'Rows affected by the step in the last run.'),
+        ):
+            gauge(f'step_{metric}', help_text, [
+                (dict(labels, step=step['step']), step[metric])
+                for step in self.steps
+            ])
+
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        name = '_'.join(
+            part for part in ('sqlbucket', self.project, self.connection,
+                              self.group) if part
+        )
+        path = folder / f'{name}.prom'
+        temporary_path = path.with_suffix(f'.prom.{uuid.uuid4().hex}.tmp')
+        temporary_path.write_text('\n'.join(lines) + '\n')
+        os.replace(temporary_path, path)
+        return str(path)
+
+
+def format_labels(labels: dict) -> str:
+    escaped = {
+        key: str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')
+        for key, value in labels.items()
+    }
+    return ','.join(f'{key}="{value}"' for key, value in escaped.items())
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Nearest-rank percentile.
+    :param values: list of numbers.
+    :param q: percentile, between 0 and 100.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def step_statistics(history: list, threshold: float = 1.5,
+                    min_runs: int = 3) -> list:
+    """
+    Summarize the history of the steps. The last run of a step regressed when
+    it took more than `threshold` times the median of its previous runs.
+    :param history: list of (connection, step, execute seconds) tuples, from
+    the oldest run to the latest.
+    :param threshold
+    :param min_runs: number of previous runs needed to flag a regression.
+    :return: list of dicts with connection, step, runs, p50, p95, last and
+    regressed, per connection and step.
+    """
+    durations = dict()
+    for connection, step, seconds in history:
+        durations.setdefault((connection, step), list()).append(seconds)
+
+    statistics = list()
+    for (connection, step), values in durations.items():
+        previous = values[:-1]
+        regressed = len(previous) >= min_runs and \
+            values[-1] > threshold * percentile(previous, 50)
+        statistics.append({
+            'connection': connection,
+            'step': step,
+            'runs': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'last': values[-1],
+            'regressed': regressed,
+        })
+    return statistics
@@ -0,0 +1,149 @@
+from contextlib import contextmanager
+from functools import wraps
+from io import StringIO
+from pathlib import Path
+from typing import Callable
+from sqlbucket.utils import logger
+from tabulate import tabulate
+import cProfile
+import pstats
+import threading
+
+
+PROFILE_TOP = 20
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class ProfileSession:
+    """
+    Profiles of a run: one for the thread which started the session, and one
+    per call run in a thread pool through `profile_thread`.
+    """
+    def __init__(self):
+        self.profiles = list()
+        self._lock = threading.Lock()
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            self.profiles.append(profile)
+
+    def stats(self) -> pstats.Stats:
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+@contextmanager
+def profiled(path: str = None, top: int = PROFILE_TOP):
+    """
+    Profile the Python side of the code run within, then write the profile to
+    `path` in the pstats format and log the top functions and the time spent
+    per template. Nothing is profiled when path is None.
+    :param path: pstats file to write, readable with `python -m pstats`.
+    :param top: number of functions in the summary.
+    """
+    global _session
+    if path is None:
+        yield None
+        return
+
+    session = ProfileSession()
+    profile = cProfile.Profile()
+    session.add(profile)
+    with _session_lock:
+        _session = session
+    profile.enable()
+    try:
+        yield session
+    finally:
+        profile.disable()
+        with _session_lock:
+            _session = None
+        write_report(session.stats(), path, top)
+
+
+def profile_thread(func: Callable) -> Callable:
+    """
+    Wrap a function submitted to a thread pool, so it is profiled too when
+    a profiling session is running. Without session, func is returned as is.
+    """
+    session = _session
+    if session is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler at a time on interpreters where profiling
+            # is process wide, which then covers this thread already.
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            session.add(profile)
+    return wrapper
+
+
+def write_report(stats: pstats.Stats, path: str, top: int = PROFILE_TOP):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    stats.dump_stats(path)
+
+    summary = StringIO()
+    stats.stream = summary
+    stats.sort_stats('cumulative').print_stats(top)
+    logger.info(f'Top {top} functions by cumulative time:\n'
+                f'{summary.getvalue()}')
+
+    templates = template_statistics(stats)
+    if templates:
+        tabulator = [['template', 'total', 'own']]
+        for item in templates:
+            tabulator.append([
+                item['template'], f'{item["total_seconds"]:.3f}s',
+                f'{item["own_seconds"]:.3f}s'
+            ])
+        logger.info('Time spent per template:\n\n' +
+                    tabulate(tabulator, headers='firstrow', tablefmt='pipe') +
+                    '\n')
+    logger.info(f'Profile written to {path}.')
+
+
+def is_template(filename: str) -> bool:
+    """
+    Code compiled by Jinja keeps the path of its template as filename.
+    """
+    return not filename.endswith('.py') and not filename.startswith(('<', '~'))
+
+
+def template_statistics(stats: pstats.Stats) -> list:
+    """
+    Time spent in each template. The total time of a template is the time
+    spent rendering it, including the macros and functions (`f`) it calls,
+    its own time is the time spent in its code only, including the code of
+    the macros it defines when they are called from other templates.
+    :return: list of dicts with template, total_seconds and own_seconds,
+    slowest first.
+    """
+    templates = dict()
+    for (filename, _, function), (_, _, own, total, _) in stats.stats.items():
+        if not is_template(filename):
+            continue
+        item = templates.setdefault(filename, {
+            'template': filename, 'total_seconds': 0.0, 'own_seconds': 0.0
+        })
+        item['own_seconds'] += own
+        # renders are generators: each resumption counts as a call
+        if function == 'root':
+            item['total_seconds'] += total
+    return sorted(
+        templates.values(),
+        key=lambda item: (item['total_seconds'], item['own_seconds']),
+        reverse=True
+    )
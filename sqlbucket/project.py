@@ -1,11 +1,33 @@
 from sqlbucket.exceptions import GroupNotFound, OrderNotInRightFormat
 from sqlbucket.runners import ProjectRunner
-from sqlbucket.integrity import run_integrity
-from jinja2 import Environment, FileSystemLoader
+from sqlbucket.lineage import LineageIndex
+from sqlbucket.integrity import run_integrity, approximate_globals, \
+    SAMPLE_SIZE
+from sqlbucket.explain import explain_steps, COST_THRESHOLD
+from sqlbucket.templating import get_jinja_env, RenderCache
+from sqlbucket.state import StateStore
+from sqlbucket.tracing import span, current_span
+from sqlbucket.utils import logger
+from jinja2 import Environment
+from sqlalchemy.engine.url import make_url
+from collections import ChainMap
+from collections.abc import Mapping
+from datetime import datetime
 from pathlib import Path
 from typing import Optional
+import threading
 import yaml
 
+try:
+    from yaml import CSafeLoader as ConfigLoader
+except ImportError:
+    from yaml import SafeLoader as ConfigLoader
+
+
+# parsed config.yaml files, keyed by path, along with their modification time
+_project_configs = dict()
+_project_configs_lock = threading.Lock()
+
 
 class Project:
 
@@ -14,11 +36,16 @@ class Project:
         project_path: str,
         connection_url: str,
         context: dict = None,
-        macros_path: str = None
+        macros_path: str = None,
+        pool_options: dict = None,
+        bytecode_cache_path: str = None,
+        project_config: dict = None,
+        render_cache: RenderCache = None,
+        state: StateStore = None
     ):
 
         self.project_path = Path(project_path)
-        self.project_config = self.get_project_config()
+        self.project_config = project_config or self.get_project_config()
 
         self.context = ContextMerger(
             context=context, context_from_config=self.project_config
@@ -29,8 +56,23 @@ class Project:
         self.connection_name = self.context['c']['name']
 
         self.macros_path = macros_path
+        self.pool_options = pool_options
+        self.bytecode_cache_path = bytecode_cache_path
+        self.render_cache = render_cache
+        self.state = state
+
+        # configurations are built once per group and reused by the
+        # notifications and the runner.
+        self._configurations = dict()
+        self._integrity_configurations = dict()
 
     def configure(self, group: str = None) -> dict:
+        if group not in self._configurations:
+            with span('configure', {'sqlbucket.group': group}):
+                self._configurations[group] = self.build_configuration(group)
+        return self._configurations[group]
+
+    def build_configuration(self, group: str = None) -> dict:
         # Setting up the jinja environment
         jinja_env = self.create_jinja_env(folder='queries')
 
@@ -53,37 +95,77 @@ class Project:
                 )
             query_order = query_order[group]
 
-        # Now rendering the queries.
-        queries = dict()
-        for query in query_order:
-            template = jinja_env.get_template(query)
-            queries[query] = template.render(**self.context)
+        # Queries are only rendered when accessed, typically by the runner
+        # right before running them.
+        queries = LazyQueries(
+            order=query_order, jinja_env=jinja_env, context=self.context,
+            render_cache=self.render_cache
+        )
 
         return {
             "order": query_order,
             "queries": queries,
+            "group": group,
+            "dependencies": self.project_config.get("dependencies"),
+            "project_order": self.project_order(),
+            "watermarks": self.get_watermarks(jinja_env, query_order),
             "context": self.context,
             "connection_url": self.connection_url,
+            "pool_options": self.pool_options,
             "connection_name": self.connection_name,
             "project_name": str(self.project_path).split('/')[-1],
             "connection_query": self.get_connection_query()
         }
 
-    def configure_integrity(self) -> dict:
-        # Setting up the jinja environment
-        jinja_env = self.create_jinja_env(folder='integrity')
+    def project_order(self) -> list:
+        """
+        :return: the queries of all the groups of the project.
+        """
+        query_order = self.project_config["order"]
+        if type(query_order) == dict:
+            return [query for group_order in query_order.values()
+                    for query in group_order]
+        return list(query_order)
+
+    def configure_integrity(self, approximate: float = None) -> dict:
+        if approximate not in self._integrity_configurations:
+            with span('configure_integrity',
+                      {'sqlbucket.approximate': approximate}):
+                self._integrity_configurations[approximate] = \
+                    self.build_integrity_configuration(approximate)
+        return self._integrity_configurations[approximate]
+
+    def build_integrity_configuration(self, approximate: float = None) -> dict:
+        # Setting up the jinja environment, approximate checks having their
+        # own one so the library macros see the sampling settings.
+        approximate_settings = None
+        env_globals = None
+        if approximate:
+            approximate_settings = approximate_globals(
+                dialect=make_url(self.connection_url).get_backend_name(),
+                rate=approximate
+            )
+            env_globals = {'approximate': approximate_settings}
+        jinja_env = self.create_jinja_env(
+            folder='integrity', env_globals=env_globals
+        )
 
         order = jinja_env.list_templates('sql')
-        queries = dict()
-        for query in order:
-            template = jinja_env.get_template(query)
-            queries[query] = template.render(**self.context)
+        queries = LazyQueries(
+            order=order, jinja_env=jinja_env, context=self.context,
+            render_cache=self.render_cache
+        )
 
         return {
             "order": order,
             "queries": queries,
+            "watermarks": self.get_watermarks(
+                jinja_env, order, key="integrity_watermarks"
+            ),
+            "approximate": approximate_settings,
             "context": self.context,
             "connection_url": self.connection_url,
+            "pool_options": self.pool_options,
             "connection_name": self.connection_name,
             "project_name": str(self.project_path).split('/')[-1],
             "connection_query": self.get_connection_query()
@@ -94,70 +176,196 @@ class Project:
         def wrapper(self, *args, **kwargs):
 
             silent = kwargs.pop("silent", False)
-
-            if silent:
-                run_func(self, *args, **kwargs)
-            else:
+            funcs_reg = self.context.get('f')
+
+            # configuring the run and sending its messages are part of its
+            # trace, the span is completed by the run with its group.
+            with span('run', {
+                'sqlbucket.project': self.project_path.name,
+                'sqlbucket.connection': self.connection_name
+            }):
+                if silent or not funcs_reg:
+                    run_func(self, *args, **kwargs)
+                    return
+
+                # configuration is memoized, so the run itself reuses it
                 group = kwargs.get("group")
                 config = self.configure(group)
 
-                if 'context' in config and 'f' in config['context']:
-                    funcs_reg = config['context']['f']
-                    start_msg = funcs_reg.get('start_msg')
-                    end_msg = funcs_reg.get('end_msg')
+                start_msg = funcs_reg.get('start_msg')
+                end_msg = funcs_reg.get('end_msg')
 
-                    try:
-                        if start_msg: start_msg(**config)
-                        run_func(self, *args, **kwargs)
-                        if end_msg: end_msg(**config)
-                    except:
-                        exception_msg = funcs_reg.get('exception_msg')
-                        if exception_msg: exception_msg(**config)
-                        raise
+                try:
+                    if start_msg: start_msg(**config)
+                    run_func(self, *args, **kwargs)
+                    if end_msg: end_msg(**config)
+                except:
+                    exception_msg = funcs_reg.get('exception_msg')
+                    if exception_msg: exception_msg(**config)
+                    raise
 
         return wrapper
 
     @send_msg
     def run(self, group: str = None, from_step: int = 1, to_step: int = None,
-            verbose: bool = False, isolation_level: str = None) -> None:
+            verbose: bool = False, isolation_level: str = None,
+            workers: int = 1, resume: bool = False,
+            incremental: bool = False, select: str = None,
+            metrics_file: str = None, prometheus_folder: str = None,
+            transaction: bool = False, savepoints: bool = False,
+            retries: int = 0, concurrency: int = None,
+            resume_exclude: list = None) -> None:
+        """
+        :param metrics_file: JSON lines file the timings of the run are
+        appended to.
+        :param prometheus_folder: folder the timings of the run are written
+        to, for the textfile collector of the Prometheus node exporter.
+        :param transaction: run the steps in a single transaction, committed
+        at the end of the run.
+        :param savepoints: in transaction mode, run each step in a savepoint.
+        :param retries: number of times a failed step is retried from its
+        savepoint.
+        :param concurrency: number of connections used at the same time on
+        the connection, across the runs done in parallel, to size its pool.
+        Defaults to the number of workers.
+        :param resume_exclude: variables left out of the key of the run to
+        resume, typically dates relative to today.
+        """
         configuration = self.configure(group)
+        run_span = current_span()
+        run_span.set_attribute('sqlbucket.group', configuration["group"])
+        run_span.set_attribute('sqlbucket.workers', workers)
         runner = ProjectRunner(
             configuration=configuration,
             from_step=from_step,
             to_step=to_step,
             verbose=verbose,
-            isolation_level=isolation_level
+            isolation_level=isolation_level,
+            workers=workers,
+            state=self.state,
+            resume=resume,
+            incremental=incremental,
+            selection=self.select(configuration, select),
+            metrics_file=metrics_file,
+            prometheus_folder=prometheus_folder,
+            transaction=transaction,
+            savepoints=savepoints,
+            retries=retries,
+            concurrency=concurrency,
+            resume_exclude=resume_exclude
         )
         runner.run_project()
 
     def render(self, group: str = None, from_step: int = 1,
-               to_step: int = None) -> None:
+               to_step: int = None, select: str = None) -> None:
         configuration = self.configure(group)
         runner = ProjectRunner(
             configuration=configuration,
             from_step=from_step,
             to_step=to_step,
+            selection=self.select(configuration, select)
         )
         runner.render_queries()
 
-    def run_integrity(self, prefix: str = '', verbose: bool = False):
-        integrity_configuration = self.configure_integrity()
+    def explain(self, group: str = None, from_step: int = 1,
+                to_step: int = None, select: str = None,
+                threshold: float = COST_THRESHOLD, verbose: bool = False,
+                update_plans: bool = False) -> list:
+        """
+        Explain the queries instead of running them, and compare their plans
+        with their baseline plans, the first plans stored.
+        :param threshold: a plan regressed when its estimated cost is more
+        than threshold times the baseline one.
+        :param update_plans: replace the baseline plans with the current ones.
+        :return: list of the plans, see explain_steps.
+        """
+        configuration = self.configure(group)
+        runner = ProjectRunner(
+            configuration=configuration,
+            from_step=from_step,
+            to_step=to_step,
+            selection=self.select(configuration, select)
+        )
+        return explain_steps(
+            configuration, runner.selected_steps(), state=self.state,
+            threshold=threshold, verbose=verbose, update=update_plans
+        )
+
+    def lineage(self, group: str = None) -> LineageIndex:
+        """
+        :return: tables read and written by each query of the group.
+        """
+        return LineageIndex(self.configure(group))
+
+    @staticmethod
+    def select(configuration: dict, select: str = None) -> Optional[list]:
+        """
+        :param configuration
+        :param select: table selectors, like `table+` for the queries
+        downstream of a table, or `+table` for the queries upstream of it.
+        :return: selected queries, None if no selector.
+        """
+        if not select:
+            return None
+        selection = LineageIndex(configuration).select(select)
+        logger.info(f'Selected queries for {select}: {", ".join(selection)}')
+        return selection
+
+    def run_integrity(self, prefix: str = '', verbose: bool = False,
+                      batch: bool = False, workers: int = 1,
+                      sample_size: int = SAMPLE_SIZE,
+                      spill_folder: str = None, incremental: bool = False,
+                      approximate: float = None, fail_fast: bool = False,
+                      scheduled: bool = False):
+        """
+        :param approximate: sampling rate of the approximate checks, between 0
+        and 1. Checks are exact if not set.
+        :param fail_fast: stop at the first failed check.
+        :param scheduled: order the checks by the duration of their last run,
+        recorded in the state folder.
+        """
+        integrity_configuration = self.configure_integrity(approximate)
         return run_integrity(
             configuration=integrity_configuration,
             prefix=prefix,
-            verbose=verbose
+            verbose=verbose,
+            batch=batch,
+            workers=workers,
+            sample_size=sample_size,
+            spill_folder=spill_folder,
+            incremental=incremental,
+            state=self.state,
+            fail_fast=fail_fast,
+            scheduled=scheduled
         )
 
     def get_project_config(self) -> dict:
         config_path = (self.project_path / 'config.yaml').resolve()
-        return yaml.load(open(config_path, 'r').read(), Loader=yaml.FullLoader)
+        return load_project_config(config_path)
+
+    def get_watermarks(self, jinja_env: Environment, order: list,
+                       key: str = "watermarks") -> dict:
+        """
+        Render the watermark queries declared in config.yaml for the queries
+        of the order. A watermark query returns a single value that changes
+        when the upstream tables of the query change, like max(updated_at).
+        :param key: attribute of config.yaml the watermark queries are
+        declared in, `integrity_watermarks` for the integrity checks.
+        :return: dict of query -> rendered watermark query.
+        """
+        watermarks = self.project_config.get(key) or dict()
+        return {
+            query: jinja_env.from_string(watermarks[query]).render(
+                **self.context
+            )
+            for query in order if query in watermarks
+        }
 
     def get_connection_query(self) -> Optional[str]:
         """
-        We create the jinja env from scratch again from the queries folder.
-        This is done in case we run the integrity, which will need the
-        connection script too. Not really clean, as we create the same
-        environment twice.
+        The connection query lives in the queries folder, also when we run the
+        integrity. The jinja environment of the queries folder is shared, so
+        this does not compile anything twice.
         :return: the connection query if any.
         """
 
@@ -165,21 +373,240 @@ class Project:
             return None
 
         jinja_env = self.create_jinja_env(folder='queries')
+        if self.render_cache is not None:
+            return self.render_cache.render(
+                jinja_env, self.project_config['connection_query'], self.context
+            )
         template = jinja_env.get_template(
             self.project_config['connection_query']
         )
         return template.render(**self.context)
 
-    def create_jinja_env(self, folder: str) -> Environment:
-        macro_folder_from_lib = Path(__file__).parent / 'macros'
+    def create_jinja_env(self, folder: str,
+                         env_globals: dict = None) -> Environment:
         queries_path = (Path(self.project_path) / folder).resolve()
-        search_path = [str(queries_path), str(macro_folder_from_lib)]
-        if self.macros_path:
-            search_path.append(str(self.macros_path))
-        jinja_env = Environment(loader=FileSystemLoader(
-            searchpath=search_path
-        ))
-        return jinja_env
+        return get_jinja_env(
+            folder=str(queries_path),
+            macros_path=self.macros_path,
+            bytecode_cache_path=self.bytecode_cache_path,
+            env_globals=env_globals
+        )
+
+
+class CompiledProject:
+    """
+    Connection independent part of a project: its path, its parsed config and
+    its templates. It is built once, and then bound to as many connections as
+    needed, each binding giving a Project. Templates are compiled the first
+    time one of the bound projects renders them, in the shared jinja
+    environments, so a template a run does not need is never compiled.
+    """
+    def __init__(
+        self,
+        project_path: str,
+        context: dict = None,
+        macros_path: str = None,
+        pool_options: dict = None,
+        bytecode_cache_path: str = None,
+        render_cache: RenderCache = None,
+        state: StateStore = None
+    ):
+        """
+        :param project_path
+        :param context: variables without the connection variables ('c').
+        :param macros_path
+        :param pool_options
+        :param bytecode_cache_path
+        :param render_cache: shared by all the bound projects.
+        :param state: store of the state of the runs.
+        """
+        self.project_path = Path(project_path)
+        with span('parse_config'):
+            self.project_config = load_project_config(
+                (self.project_path / 'config.yaml').resolve()
+            )
+        self.context = context or dict()
+        self.macros_path = macros_path
+        self.pool_options = pool_options
+        self.bytecode_cache_path = bytecode_cache_path
+        self.render_cache = render_cache
+        self.state = state
+
+    def compile(self, group: str = None, integrity: bool = False) -> None:
+        """
+        Compile ahead of time the templates of a group, typically to check
+        them, so they are in cache in the shared jinja environments when the
+        bound projects render them.
+        :param group: group of queries, all the groups if None.
+        :param integrity: compile the integrity checks as well.
+        """
+        with span('compile', {'sqlbucket.group': group}):
+            queries_env = self.create_jinja_env(folder='queries')
+            query_order = self.project_config.get("order") or list()
+            if type(query_order) == dict:
+                if group is not None:
+                    if group not in query_order:
+                        raise GroupNotFound(
+                            f'Group "{group}" not found in order config.'
+                        )
+                    query_order = query_order[group]
+                else:
+                    query_order = [
+                        q for queries in query_order.values() for q in queries
+                    ]
+            query_order = list(query_order)
+            if "connection_query" in self.project_config:
+                query_order.append(self.project_config["connection_query"])
+            for query in query_order:
+                queries_env.get_template(query)
+
+            if integrity and (self.project_path / 'integrity').is_dir():
+                integrity_env = self.create_jinja_env(folder='integrity')
+                for query in integrity_env.list_templates('sql'):
+                    integrity_env.get_template(query)
+
+    def create_jinja_env(self, folder: str) -> Environment:
+        return get_jinja_env(
+            folder=str((self.project_path / folder).resolve()),
+            macros_path=self.macros_path,
+            bytecode_cache_path=self.bytecode_cache_path
+        )
+
+    def bind(self, connection_name: str, connection_url: str,
+             connection_variables: dict = None) -> Project:
+        """
+        Bind the project to a connection.
+        :param connection_name
+        :param connection_url
+        :param connection_variables: variables rendered as {{ c.foo }}.
+        :return: Project instance
+        """
+        context = LayeredContext(
+            {'c': LayeredContext(
+                {'name': connection_name}, connection_variables or dict()
+            )},
+            self.context
+        )
+
+        return Project(
+            project_path=str(self.project_path),
+            connection_url=connection_url,
+            context=context,
+            macros_path=self.macros_path,
+            pool_options=self.pool_options,
+            bytecode_cache_path=self.bytecode_cache_path,
+            project_config=self.project_config,
+            render_cache=self.render_cache,
+            state=self.state
+        )
+
+
+def load_project_config(config_path: Path) -> dict:
+    """
+    Parse a config.yaml, only once as long as the file is not modified. The
+    returned dict is shared between projects and must not be mutated.
+    """
+    stat = config_path.stat()
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _project_configs_lock:
+        cached = _project_configs.get(config_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    with open(config_path, 'r') as config_file:
+        config = yaml.load(config_file, Loader=ConfigLoader)
+
+    with _project_configs_lock:
+        _project_configs[config_path] = (version, config)
+    return config
+
+
+class LazyQueries(Mapping):
+    """
+    Read-only mapping of query name to rendered query. A query is rendered the
+    first time it is accessed, and then kept. This way, running a subset of
+    the steps only renders the queries of these steps. The time spent
+    rendering each kept query is in `render_seconds`.
+    """
+    def __init__(self, order: list, jinja_env: Environment, context: dict,
+                 render_cache: RenderCache = None):
+        self.order = order
+        self.names = set(order)
+        self.jinja_env = jinja_env
+        self.context = context
+        self.render_cache = render_cache
+        self.rendered = dict()
+        self.render_seconds = dict()
+
+    def __getitem__(self, query: str) -> str:
+        if query not in self.rendered:
+            if query not in self.names:
+                raise KeyError(query)
+            start = datetime.now()
+            self.rendered[query] = self.render(query)
+            self.render_seconds[query] = \
+                (datetime.now() - start).total_seconds()
+        return self.rendered[query]
+
+    def render(self, query: str, variables: dict = None) -> str:
+        """
+        :param variables: variables rendered on top of the context, the result
+        is then not kept.
+        """
+        context = self.context
+        if variables:
+            context = LayeredContext(variables, self.context)
+        with span('render', {'sqlbucket.query': query}):
+            if self.render_cache is not None:
+                return self.render_cache.render(
+                    self.jinja_env, query, context
+                )
+            template = self.jinja_env.get_template(query)
+            return template.render(**context)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+
+class LayeredContext(ChainMap):
+    """
+    Read-only view over layers of variables, the first layer having priority.
+    Layers are never copied nor modified, so the same registry of variables can
+    be shared by all the projects loaded in a process, including from several
+    threads.
+    """
+    def __setitem__(self, key, value):
+        raise TypeError(f'Context is read-only, cannot set "{key}"')
+
+    def __delitem__(self, key):
+        raise TypeError(f'Context is read-only, cannot delete "{key}"')
+
+    # ChainMap implements these on its first layer directly, which may be a
+    # shared dict such as the cached config of a project.
+    def pop(self, key, *default):
+        raise TypeError(f'Context is read-only, cannot pop "{key}"')
+
+    def popitem(self):
+        raise TypeError('Context is read-only, cannot pop items')
+
+    def clear(self):
+        raise TypeError('Context is read-only, cannot be cleared')
+
+    def __ior__(self, other):
+        raise TypeError('Context is read-only, cannot be updated')
+
+    def to_dict(self) -> dict:
+        return {
+            key: value.to_dict() if isinstance(value, LayeredContext) else value
+            for key, value in self.items()
+        }
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
 
 
 class ContextMerger:
@@ -188,17 +615,12 @@ class ContextMerger:
     submitted when loading a project. It must be merged with the one found in
     config.
 
-    In case of duplicate keys between the 2 context, we only keep one. The
-    context that has priority depends on the variable types.
-
-    Environment and connection variables from the config.yaml of a project will
-    overwrite the key/value matching pairs of the one submitted by SQLBucket.
-
-    For project variables, this is opposite, we give priority to the ones submitted
-    by the SQLBucket, typically the one submitted in Python or via CLI. The
-    logic behind it is that we prefer to give priority to the more dynamic
-    approach.
+    In case of duplicate keys between the 2 context, we only keep one. Variables
+    from the config.yaml of a project (environment, connection and project
+    variables) take priority over the matching keys submitted by SQLBucket.
 
+    Merging does not modify any of the 2 contexts: the result is a
+    LayeredContext with the variables from config.yaml as first layers.
     """
     def __init__(self, context: dict, context_from_config: dict):
         """
@@ -208,39 +630,31 @@ class ContextMerger:
         self.context = context
         self.context_from_config = context_from_config
 
-    def overwrite_environment_variables(self):
+    def environment_variables(self) -> LayeredContext:
         config_env_vars = self.context_from_config.get('environment_variables')
-        if not config_env_vars:
-            return
-
         env_name = self.context['e']['name']
-        if env_name not in config_env_vars:
-            return
-
-        for key, value in config_env_vars[env_name].items():
-            self.context['e'][key] = value
+        return LayeredContext(
+            (config_env_vars or dict()).get(env_name) or dict(),
+            self.context['e']
+        )
 
-    def overwrite_connection_variables(self):
+    def connection_variables(self) -> LayeredContext:
         connections_vars = self.context_from_config.get('connection_variables')
-        if not connections_vars:
-            return
-
         connection_name = self.context['c']['name']
-        if connection_name not in connections_vars:
-            return
-
-        for key, value in connections_vars[connection_name].items():
-            self.context['c'][key] = value
-
-    def overwrite_project_variables(self):
-        project_vars = self.context_from_config.get('project_variables')
-        if not project_vars:
-            return
-        for key, value in project_vars.items():
-            self.context[key] = value
-
-    def merge(self):
-        self.overwrite_environment_variables()
-        self.overwrite_connection_variables()
-        self.overwrite_project_variables()
-        return self.context
+        return LayeredContext(
+            (connections_vars or dict()).get(connection_name) or dict(),
+            self.context['c']
+        )
+
+    def project_variables(self) -> dict:
+        return self.context_from_config.get('project_variables') or dict()
+
+    def merge(self) -> LayeredContext:
+        return LayeredContext(
+            {
+                'e': self.environment_variables(),
+                'c': self.connection_variables()
+            },
+            self.project_variables(),
+            self.context
+        )
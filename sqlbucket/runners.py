@@ -1,7 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Iterator
+import threading
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Connection
-from sqlalchemy.pool import NullPool
+from sqlalchemy.engine import Connection, Engine, Transaction, make_url
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlbucket.exceptions import CircularDependency, DependencyNotFound
+from sqlbucket.metrics import RunMetrics
+from sqlbucket.profiling import profile_thread
+from sqlbucket.tracing import span, in_current_context
+from sqlbucket.state import StateStore, run_key, sql_hash
 from sqlbucket.utils import logger, sqlbucket_logo
 
 
@@ -13,7 +23,19 @@ class ProjectRunner:
         from_step: int = 1,
         to_step: int = None,
         verbose: bool = False,
-        isolation_level: str = None
+        isolation_level: str = None,
+        workers: int = 1,
+        state: StateStore = None,
+        resume: bool = False,
+        incremental: bool = False,
+        selection: list = None,
+        metrics_file: str = None,
+        prometheus_folder: str = None,
+        transaction: bool = False,
+        savepoints: bool = False,
+        retries: int = 0,
+        concurrency: int = None,
+        resume_exclude: list = None
     ):
         self.configuration = configuration
         self.from_step_index = from_step - 1
@@ -25,45 +47,384 @@ class ProjectRunner:
 
         self.isolation_level = isolation_level
         self.verbose = verbose
+        self.workers = max(workers, 1)
+        # connections used at the same time on the connection url, possibly
+        # by other runners, to size the pool of the engine.
+        self.concurrency = max(concurrency or 1, self.workers)
 
-    def render_queries(self) -> None:
-        for i, query in enumerate(self.configuration["order"]):
+        # optional subset of the queries to run, typically from the lineage
+        self.selection = set(selection) if selection is not None else None
+
+        # in resume mode, completed steps are recorded in the state store, if
+        # any, so a failed run can be resumed. The store is only used when
+        # asked for, with resume, incremental or metrics.
+        self.state = state
+        self.resume = resume
+        self.resume_exclude = set(resume_exclude or list())
+        self.completed_steps = dict()
+        self._run_key = None
+
+        # in incremental mode, steps whose rendered query and upstream
+        # watermark did not change since their last successful run are skipped
+        self.incremental = incremental
 
-            # we skip the queries out of index
-            if i < self.from_step_index or i > self.to_step_index:
-                continue
+        # timings of the run, kept in the history of the state store and
+        # optionally written as JSON lines and for Prometheus.
+        self.metrics = self.new_metrics()
+        self.metrics_file = metrics_file
+        self.prometheus_folder = prometheus_folder
+
+        # in transaction mode, the steps run in a single transaction committed
+        # at the end of the run. With savepoints, a failed step is rolled back
+        # to its savepoint and retried, without running the previous steps
+        # again. What is recorded in the state store waits for the commit.
+        check_transaction_options(
+            transaction, savepoints, retries, self.workers, isolation_level
+        )
+        self.transaction = transaction
+        self.savepoints = savepoints
+        self.retries = retries
+        self.uncommitted = list()
+
+    def selected_steps(self) -> list:
+        """
+        :return: list of (index, query) tuples within the from/to step range,
+        and within the selection if any.
+        """
+        return [
+            (i, query) for i, query in enumerate(self.configuration["order"])
+            if self.from_step_index <= i <= self.to_step_index
+            and (self.selection is None or query in self.selection)
+        ]
+
+    def render_queries(self) -> None:
+        for i, query in self.selected_steps():
             rendered_query = self.configuration["queries"][query]
             logger.info(f'\n##### Query {str(i + 1)}: {query} #####\n'
                         f'\n{rendered_query}\n')
 
     def run_project(self) -> None:
+        """
+        Run the selected steps, within the `run` span opened by Project.run.
+        """
+        self.run_steps()
+
+    def run_steps(self) -> None:
         self.starting_logs()
 
+        start = datetime.now()
+        self.metrics = self.new_metrics()
+        if self.state is not None and self.resume:
+            self.completed_steps = self.state.completed_steps(self.run_key())
+
+        try:
+            if self.workers > 1:
+                self.run_parallel()
+            else:
+                self.run_sequential()
+        except Exception:
+            self.write_metrics('failed')
+            raise
+
+        # the run is complete, nothing to resume anymore, also when the
+        # steps of a failed run were recorded by a previous run with resume
+        if self.state is not None and (self.resume or self.state.exists()):
+            self.state.clear_steps(self.run_key())
+
+        end = datetime.now()
+        self.write_metrics('success')
+        self.ending_logs(start, end)
+
+    def new_metrics(self) -> RunMetrics:
+        return RunMetrics(
+            project=self.configuration.get('project_name'),
+            connection=self.configuration.get('connection_name'),
+            group=self.configuration.get('group')
+        )
+
+    def write_metrics(self, status: str) -> None:
+        self.metrics.finish(status)
+        if self.metrics_file is None and self.prometheus_folder is None:
+            return
+        record = self.metrics.to_record()
+        if self.state is not None:
+            self.state.record_run_metrics(record)
+        if self.metrics_file is not None:
+            self.metrics.write_jsonl(self.metrics_file)
+        if self.prometheus_folder is not None:
+            self.metrics.write_prometheus(self.prometheus_folder)
+
+    def connect(self) -> Connection:
         start = datetime.now()
         connection = create_connection(
-            self.configuration, isolation_level=self.isolation_level
+            self.configuration, isolation_level=self.isolation_level,
+            concurrency=self.concurrency
+        )
+        self.metrics.record_connect((datetime.now() - start).total_seconds())
+        return connection
+
+    def run_sequential(self) -> None:
+        connection = self.connect()
+        try:
+            if self.transaction:
+                self.run_transaction(connection)
+            else:
+                for i, query in self.selected_steps():
+                    self.run_step(connection, i, query)
+        finally:
+            release_connection(connection)
+
+    def run_transaction(self, connection: Connection) -> None:
+        """
+        Run the selected steps in a single transaction, committed once all of
+        them succeeded. On failure, the transaction is rolled back and nothing
+        is recorded as completed, so the next run starts over.
+        """
+        self.uncommitted.clear()
+        with begin_transaction(connection) as transaction:
+            try:
+                for i, query in self.selected_steps():
+                    if self.savepoints:
+                        self.run_savepoint_step(connection, i, query)
+                    else:
+                        self.run_step(connection, i, query)
+            except Exception:
+                logger.error('Rolling back the transaction, nothing '
+                             'committed.')
+                transaction.rollback()
+                self.uncommitted.clear()
+                raise
+
+            start = datetime.now()
+            with span('commit'):
+                transaction.commit()
+        logger.info(f'Transaction committed in {datetime.now() - start}.')
+
+        for method, kwargs in self.uncommitted:
+            method(**kwargs)
+        self.uncommitted.clear()
+
+    def run_savepoint_step(self, connection: Connection, i: int,
+                           query: str) -> None:
+        """
+        Run a step within its own savepoint, retrying it up to `retries`
+        times when it fails on a transient error, see `is_transient`. Other
+        errors, like a syntax error, fail the step right away.
+        """
+        for attempt in range(self.retries + 1):
+            savepoint = connection.begin_nested()
+            try:
+                self.run_step(connection, i, query)
+            except SQLAlchemyError as e:
+                # the transaction as a whole is rolled back by the caller,
+                # raising the original error
+                if attempt == self.retries or not is_transient(e, connection):
+                    raise
+                savepoint.rollback()
+                logger.warning(f"Query '{query}' failed, rolled back to its "
+                               f"savepoint. Retrying ({attempt + 1}/"
+                               f"{self.retries}): {e}")
+            else:
+                savepoint.commit()
+                return
+
+    def save_state(self, method, **kwargs) -> None:
+        """
+        Call a method of the state store, after the commit in transaction
+        mode, so steps rolled back are never recorded as completed.
+        """
+        if self.transaction:
+            self.uncommitted.append((method, kwargs))
+        else:
+            method(**kwargs)
+
+    def run_parallel(self) -> None:
+        """
+        Run the selected steps on at most `workers` threads, each of them with
+        its own connection. A step is submitted as soon as all the steps it
+        depends on are done.
+        Dependencies on steps outside the selected range are considered
+        already satisfied. On failure, steps already running are allowed to
+        finish but no new step is started.
+        """
+        steps = self.selected_steps()
+        graph = dependency_graph(
+            order=[query for _, query in steps],
+            dependencies=self.configuration.get("dependencies"),
+            steps=self.configuration.get(
+                "project_order", self.configuration["order"]
+            )
         )
+        index = {query: i for i, query in steps}
 
-        for i, query in enumerate(self.configuration["order"]):
+        # each worker thread keeps its own connection for all its steps
+        local = threading.local()
+        connections = list()
 
-            # we skip the queries out of index
-            if i < self.from_step_index or i > self.to_step_index:
-                continue
+        def execute(i, query):
+            if not hasattr(local, 'connection'):
+                local.connection = self.connect()
+                connections.append(local.connection)
+            self.run_step(local.connection, i, query)
+
+        pending = dict(graph)
+        running = dict()
+        done = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while pending or running:
+                    ready = [q for q, deps in pending.items() if deps <= done]
+                    for query in ready:
+                        del pending[query]
+                        future = executor.submit(
+                            profile_thread(in_current_context(execute)),
+                            index[query], query
+                        )
+                        running[future] = query
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        query = running.pop(future)
+                        future.result()
+                        done.add(query)
+        finally:
+            for connection in connections:
+                release_connection(connection)
+
+    def run_step(self, connection: Connection, i: int, query: str) -> None:
+        with span('step', {'sqlbucket.step': query,
+                           'sqlbucket.index': i + 1}) as step_span:
+            queries = self.configuration["queries"]
+            rendered_query = queries[query]
+            render_seconds = getattr(
+                queries, 'render_seconds', dict()
+            ).get(query)
+
+            if self.completed_steps.get(query) == sql_hash(rendered_query):
+                logger.info(f"Skipping query {str(i + 1)}: '{query}', already "
+                            f"completed in a previous run.")
+                self.metrics.record_step(query, 'skipped', render_seconds)
+                step_span.set_attribute('sqlbucket.skipped', 'resumed')
+                return
+
+            watermark = None
+            if self.incremental and self.state is not None:
+                watermark = self.get_watermark(connection, query)
+                if self.is_unchanged(query, rendered_query, watermark):
+                    logger.info(f"Skipping query {str(i + 1)}: '{query}', "
+                                f"query and watermark '{watermark}' unchanged "
+                                f"since last successful run.")
+                    self.metrics.record_step(query, 'skipped', render_seconds)
+                    step_span.set_attribute('sqlbucket.skipped', 'unchanged')
+                    return
 
             # we run the query and monitor the time it takes
             query_start = datetime.now()
             logger.info(f"Now running query {str(i + 1)}: '{query}'...")
-            rendered_query = self.configuration["queries"][query]
             if self.verbose:
                 logger.info(f'\n\n{rendered_query}\n')
-            connection.execute(text(rendered_query))
+            try:
+                result = connection.execute(text(rendered_query))
+            except Exception:
+                self.metrics.record_step(
+                    query, 'failed', render_seconds,
+                    (datetime.now() - query_start).total_seconds()
+                )
+                raise
 
             query_end = datetime.now()
             timing = str(query_end - query_start)
             logger.info(f"Query '{query}' successfully executed in {timing}.")
+            self.metrics.record_step(
+                query, 'success', render_seconds,
+                (query_end - query_start).total_seconds(), result.rowcount
+            )
+            step_span.set_attribute('sqlbucket.rowcount', result.rowcount)
 
-        end = datetime.now()
-        self.ending_logs(start, end)
+            if watermark is not None:
+                self.save_state(
+                    self.state.set_fingerprint,
+                    project=self.configuration['project_name'],
+                    connection=self.configuration['connection_name'],
+                    group=self.configuration.get('group'),
+                    step=query,
+                    sql=rendered_query,
+                    watermark=watermark
+                )
+
+            if self.state is not None and self.resume:
+                self.save_state(
+                    self.state.complete_step,
+                    run_key=self.run_key(),
+                    project=self.configuration['project_name'],
+                    connection=self.configuration['connection_name'],
+                    group=self.configuration.get('group'),
+                    variables=self.run_variables(),
+                    step=query,
+                    sql=rendered_query
+                )
+
+    def get_watermark(self, connection: Connection, query: str):
+        """
+        Run the watermark query declared for the step, if any.
+        :return: the watermark as a string, None if no watermark is declared.
+        """
+        watermark_query = (self.configuration.get("watermarks") or dict()).get(
+            query
+        )
+        if watermark_query is None:
+            logger.info(f"No watermark declared for '{query}', it will run.")
+            return None
+        return str(connection.execute(text(watermark_query)).scalar())
+
+    def is_unchanged(self, query: str, rendered_query: str,
+                     watermark: str) -> bool:
+        if watermark is None:
+            return False
+        fingerprint = self.state.get_fingerprint(
+            project=self.configuration['project_name'],
+            connection=self.configuration['connection_name'],
+            group=self.configuration.get('group'),
+            step=query
+        )
+        if fingerprint is None:
+            logger.info(f"No previous run recorded for '{query}', it will run.")
+            return False
+        if fingerprint[0] != sql_hash(rendered_query):
+            logger.info(f"Query '{query}' changed since last run, it will run.")
+            return False
+        if fingerprint[1] != watermark:
+            logger.info(f"Watermark of '{query}' moved from '{fingerprint[1]}' "
+                        f"to '{watermark}', it will run.")
+            return False
+        return True
+
+    def run_variables(self) -> dict:
+        """
+        Variables identifying a run, as stored in the state store. Registered
+        functions are excluded, and so are the connection and environment
+        variables, which may hold credentials, the connection being part of
+        the key of the run anyway. Variables of resume_exclude, typically
+        dates relative to today, are left out too, so a run can be resumed
+        the next day.
+        """
+        context = self.configuration['context']
+        if hasattr(context, 'to_dict'):
+            context = context.to_dict()
+        return {
+            key: value for key, value in context.items()
+            if key not in ('f', 'c', 'e') and key not in self.resume_exclude
+        }
+
+    def run_key(self) -> str:
+        if self._run_key is None:
+            self._run_key = run_key(
+                project=self.configuration['project_name'],
+                connection=self.configuration['connection_name'],
+                group=self.configuration.get('group'),
+                variables=self.run_variables()
+            )
+        return self._run_key
 
     def starting_logs(self):
         logger.info(sqlbucket_logo)
@@ -73,11 +434,7 @@ class ProjectRunner:
         )
         logger.info(f"Variables: {self.configuration['context']}")
 
-        queries = list()
-        for i, query in enumerate(self.configuration["order"]):
-            if i < self.from_step_index or i > self.to_step_index:
-                continue
-            queries.append(query)
+        queries = [query for _, query in self.selected_steps()]
 
         logger.info("\n\nRunning the following queries:"
                     "\n\t" + "\n\t".join(queries) + '\n')
@@ -89,33 +446,259 @@ class ProjectRunner:
         logger.info(f"Project completed in {end - start}")
 
 
-def create_connection(
-        configuration: dict, isolation_level: str = None) -> Connection:
-    # todo: a user may prefer to run a session that commits data only at the
-    #  very end of the ETL instead of an auto commit execution at engine level.
+def dependency_graph(order: list, dependencies: dict = None,
+                     steps: list = None) -> dict:
+    """
+    Build the dependency graph of the steps in `order`. If the project does not
+    declare any dependencies, every step depends on the previous one, which
+    gives the usual sequential execution. Otherwise, a step only depends on the
+    steps declared for it in the `dependencies` attribute of config.yaml.
+    Dependencies on steps of the project that are not part of `order` (outside
+    the selected range) are ignored, but unknown steps are an error, as a typo
+    would silently drop an ordering constraint.
+    :param order: list of queries to run
+    :param dependencies: dict of query -> list of queries it depends on
+    :param steps: all the queries of the project, `order` if not indicated.
+    :return: dict of query -> set of queries it depends on
+    """
+    if dependencies is None:
+        return {
+            query: {order[i - 1]} if i else set()
+            for i, query in enumerate(order)
+        }
 
-    # if no isolation level is indicated, we just create an engine without the
-    # isolation level parameter. This means it will use the default one.
-    # Check your backend DB documentation to know which one is the default as
-    # it varies between databases.
-    if not isolation_level:
-        engine = create_engine(
-            configuration['connection_url'], poolclass=NullPool
-        )
-    else:
-        engine = create_engine(
+    known = set(steps if steps is not None else order)
+    for query, upstream in dependencies.items():
+        unknown = [name for name in [query] + list(upstream or list())
+                   if name not in known]
+        if unknown:
+            raise DependencyNotFound(
+                f'Unknown queries in the dependencies of "{query}": '
+                f'{", ".join(unknown)}'
+            )
+
+    graph = {
+        query: set(dependencies.get(query) or list()) & set(order)
+        for query in order
+    }
+
+    # making sure the graph can be fully resolved
+    resolved = set()
+    remaining = dict(graph)
+    while remaining:
+        ready = [q for q, deps in remaining.items() if deps <= resolved]
+        if not ready:
+            raise CircularDependency(
+                f'Circular dependency found between queries: '
+                f'{", ".join(remaining)}'
+            )
+        for query in ready:
+            del remaining[query]
+            resolved.add(query)
+
+    return graph
+
+
+# Engines are shared within the process, so connections (and the connection
+# query run on them) are reused between steps, runs and integrity checks.
+DEFAULT_POOL_OPTIONS = {'pool_pre_ping': True}
+DEFAULT_POOL_SIZE = 5
+_engines = dict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(connection_url: str, isolation_level: str = None,
+               pool_options: dict = None, concurrency: int = 1) -> Engine:
+    """
+    Return the engine registered for the connection url and isolation level,
+    creating it on first call.
+    :param connection_url
+    :param isolation_level: if not indicated, the engine is created without the
+    isolation level parameter. This means it will use the default one. Check
+    your backend DB documentation to know which one is the default as it
+    varies between databases.
+    :param pool_options: keyword arguments for the engine pool, such as
+    pool_size, max_overflow, pool_pre_ping, pool_recycle or poolclass.
+    :param concurrency: number of connections used at the same time. Unless
+    pool_size is given in pool_options, the pool keeps at least that many
+    connections, and the engine is replaced by a larger one if needed.
+    :return: Engine instance
+    """
+    options = dict(DEFAULT_POOL_OPTIONS)
+    options.update(pool_options or dict())
+    key = (connection_url, isolation_level, tuple(sorted(
+        (name, repr(value)) for name, value in options.items()
+    )))
+
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None and (
+                'pool_size' in options or pool_size(engine) >= concurrency):
+            return engine
+
+        if isolation_level:
+            options['isolation_level'] = isolation_level
+        if 'pool_size' not in options and is_queue_pool(
+                connection_url, options.get('poolclass')):
+            options['pool_size'] = max(DEFAULT_POOL_SIZE, concurrency)
+        _engines[key] = create_engine(connection_url, **options)
+        if engine is not None:
+            # connections checked out keep working, and are closed on checkin
+            engine.dispose()
+        return _engines[key]
+
+
+def is_queue_pool(connection_url: str, poolclass: type = None) -> bool:
+    """
+    Whether the engine pool takes a pool_size, the in memory and file SQLite
+    databases use pools of a fixed size for instance.
+    """
+    if poolclass is None:
+        url = make_url(connection_url)
+        poolclass = url.get_dialect().get_pool_class(url)
+    return issubclass(poolclass, QueuePool)
+
+
+def pool_size(engine: Engine) -> float:
+    """
+    :return: number of connections the engine pool can keep, infinite for the
+    pools without size.
+    """
+    if isinstance(engine.pool, QueuePool):
+        return engine.pool.size()
+    return float('inf')
+
+
+def dispose_engines() -> None:
+    """
+    Close all the pooled connections and empty the engine registry.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def create_connection(configuration: dict, isolation_level: str = None,
+                      concurrency: int = 1) -> Connection:
+    """
+    Connections run in auto commit mode, unless a transaction is begun on
+    them, see `begin_transaction`.
+    :param configuration
+    :param isolation_level
+    :param concurrency: number of connections the caller uses at the same
+    time, to size the pool.
+    """
+    with span('connect', {
+        'sqlbucket.connection': configuration.get('connection_name'),
+        'sqlbucket.isolation_level': isolation_level
+    }):
+        engine = get_engine(
             configuration['connection_url'],
-            poolclass=NullPool,
-            isolation_level=isolation_level
+            isolation_level=isolation_level,
+            pool_options=configuration.get('pool_options'),
+            concurrency=concurrency
         )
-    connection = engine.connect()
-    connection_query(configuration, connection)
+        connection = engine.connect()
+        connection_query(configuration, connection)
 
     return connection
 
 
-def connection_query(configuration: dict, connection: Connection):
-    if configuration.get('connection_query') is not None:
-        logger.info(f'Running connection query: '
-                    f'{configuration["connection_query"]}')
-        connection.execute(text(configuration['connection_query']))
+def release_connection(connection: Connection) -> None:
+    """
+    Close a connection steps ran on. Steps may leave session state behind,
+    like temporary tables or settings changed with SET, so the DBAPI
+    connection is closed instead of being returned to the pool, and the next
+    run starts from a fresh session.
+    """
+    if not connection.closed and not connection.invalidated:
+        connection.detach()
+    connection.close()
+
+
+def check_transaction_options(transaction: bool, savepoints: bool,
+                              retries: int, workers: int,
+                              isolation_level: str = None) -> None:
+    """
+    :raise ValueError: when the options of the transaction mode cannot be
+    used together.
+    """
+    if transaction and workers > 1:
+        raise ValueError('Transaction mode runs the steps on a single '
+                         'connection, it cannot be used with workers')
+    if transaction and (isolation_level or '').upper() == 'AUTOCOMMIT':
+        raise ValueError('Transaction mode cannot be used with the '
+                         'AUTOCOMMIT isolation level')
+    if savepoints and not transaction:
+        raise ValueError('Savepoints are only used in transaction mode')
+    if retries and not savepoints:
+        raise ValueError('Steps can only be retried with savepoints')
+
+
+def is_transient(error: SQLAlchemyError, connection: Connection) -> bool:
+    """
+    Errors worth retrying from a savepoint: operational errors, like a lock
+    timeout or a deadlock, on a connection which is still valid. A lost
+    connection loses the transaction with it, savepoints included, and
+    programming errors never succeed on retry.
+    """
+    return isinstance(error, OperationalError) \
+        and not error.connection_invalidated and not connection.invalidated
+
+
+@contextmanager
+def begin_transaction(connection: Connection) -> Iterator[Transaction]:
+    """
+    Begin a transaction, in which statements are not auto committed anymore.
+    The SQLite driver only begins a transaction before DML statements, so for
+    DDL statements to be part of it, it is begun explicitly. The driver is
+    set back as it was when leaving the block, so the pooled connection
+    behaves as usual for its next checkout.
+    """
+    transaction = connection.begin()
+    if connection.dialect.name != 'sqlite':
+        yield transaction
+        return
+
+    # the driver leaves transactions to us until the end of the block
+    dbapi_connection = connection.connection.dbapi_connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    try:
+        connection.exec_driver_sql('begin')
+        yield transaction
+    finally:
+        if not connection.invalidated:
+            dbapi_connection.isolation_level = isolation_level
+
+
+def connection_query(configuration: dict, connection: Connection,
+                     force: bool = False):
+    """
+    Run the connection query of the project. It is committed, so it is kept
+    for the whole session, and the pooled connection remembers it to avoid
+    running it again on next checkout. A pooled connection on which another
+    project ran a different connection query is replaced by a new one, so
+    the session state of a project never leaks into another.
+    :param configuration
+    :param connection
+    :param force: run the query even if the connection remembers it, to
+    restore the session after an error.
+    """
+    query = configuration.get('connection_query')
+    info = connection.connection.info
+    previous = info.get('connection_query')
+    if previous is not None and previous != query:
+        logger.info('Discarding a pooled connection set up by another '
+                    'connection query.')
+        connection.invalidate()
+        info = connection.connection.info
+
+    if query is None or (query == info.get('connection_query') and not force):
+        return
+
+    logger.info(f'Running connection query: {query}')
+    with span('connection_query'):
+        connection.execute(text(query).execution_options(autocommit=True))
+    info['connection_query'] = query
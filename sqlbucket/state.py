@@ -0,0 +1,338 @@
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+# runs kept in the history of the steps, per project, connection and group
+METRICS_RETENTION = 100
+
+SCHEMA = [
+    """
+    create table if not exists partitions (
+        project text not null,
+        connection text not null,
+        grp text not null,
+        steps text not null,
+        variables text not null,
+        from_date text not null,
+        to_date text not null,
+        completed_at text not null,
+        primary key (project, connection, grp, steps, variables, from_date,
+                     to_date)
+    )
+    """,
+    """
+    create table if not exists steps (
+        run_key text not null,
+        project text not null,
+        connection text not null,
+        grp text not null,
+        variables text not null,
+        step text not null,
+        sql_hash text not null,
+        completed_at text not null,
+        primary key (run_key, step)
+    )
+    """,
+    """
+    create table if not exists fingerprints (
+        project text not null,
+        connection text not null,
+        grp text not null,
+        step text not null,
+        sql_hash text not null,
+        watermark text,
+        completed_at text not null,
+        primary key (project, connection, grp, step)
+    )
+    """,
+    """
+    create table if not exists integrity_watermarks (
+        project text not null,
+        connection text not null,
+        check_name text not null,
+        sql_hash text not null,
+        watermark text not null,
+        validated_at text not null,
+        primary key (project, connection, check_name)
+    )
+    """,
+    """
+    create table if not exists check_durations (
+        project text not null,
+        connection text not null,
+        check_name text not null,
+        duration real not null,
+        recorded_at text not null,
+        primary key (project, connection, check_name)
+    )
+    """,
+    """
+    create table if not exists step_metrics (
+        run_id text not null,
+        project text not null,
+        connection text not null,
+        grp text not null,
+        started_at text not null,
+        step text not null,
+        status text not null,
+        render_seconds real,
+        execute_seconds real,
+        rowcount integer,
+        primary key (run_id, step)
+    )
+    """,
+    """
+    create table if not exists plans (
+        project text not null,
+        connection text not null,
+        grp text not null,
+        step text not null,
+        sql_hash text not null,
+        plan text not null,
+        cost real,
+        estimated_rows real,
+        full_scans text not null,
+        explained_at text not null,
+        primary key (project, connection, grp, step)
+    )
+    """,
+]
+
+
+class StateStore:
+    """
+    Local store of the state of the runs, in a SQLite database within the
+    state folder of SQLBucket. The database is only created on first use.
+    Every method opens its own connection, so the store can be used from
+    several threads and processes.
+    """
+    def __init__(self, folder: str):
+        self.folder = Path(folder)
+        self.path = self.folder / 'state.db'
+        self._created = False
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        with self._lock:
+            if not self._created:
+                self.folder.mkdir(parents=True, exist_ok=True)
+                with closing(sqlite3.connect(str(self.path), timeout=60)) \
+                        as connection, connection:
+                    for statement in SCHEMA:
+                        connection.execute(statement)
+                self._created = True
+        return sqlite3.connect(str(self.path), timeout=60)
+
+    def exists(self) -> bool:
+        """
+        Whether the database was created, by this store or a previous one.
+        """
+        return self._created or self.path.exists()
+
+    def execute(self, query: str, parameters: tuple = ()) -> list:
+        with closing(self.connect()) as connection, connection:
+            return connection.execute(query, parameters).fetchall()
+
+    def is_partition_completed(self, project: str, connection: str,
+                               group: str, steps: dict, variables: dict,
+                               from_date: str, to_date: str) -> bool:
+        """
+        :param steps: selection of the steps run, as from_step, to_step and
+        select, a partition being only completed for the steps it ran.
+        """
+        rows = self.execute(
+            'select 1 from partitions where project = ? and connection = ? '
+            'and grp = ? and steps = ? and variables = ? and from_date = ? '
+            'and to_date = ?',
+            (project, connection, group or '', serialize(steps),
+             serialize(variables), from_date, to_date)
+        )
+        return bool(rows)
+
+    def complete_partition(self, project: str, connection: str, group: str,
+                           steps: dict, variables: dict, from_date: str,
+                           to_date: str) -> None:
+        self.execute(
+            'insert or replace into partitions '
+            'values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (project, connection, group or '', serialize(steps),
+             serialize(variables), from_date, to_date,
+             datetime.now().isoformat())
+        )
+
+    def completed_steps(self, run_key: str) -> dict:
+        """
+        :return: dict of step -> hash of the rendered query it completed with.
+        """
+        rows = self.execute(
+            'select step, sql_hash from steps where run_key = ?', (run_key,)
+        )
+        return dict(rows)
+
+    def complete_step(self, run_key: str, project: str, connection: str,
+                      group: str, variables: dict, step: str,
+                      sql: str) -> None:
+        self.execute(
+            'insert or replace into steps values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (run_key, project, connection, group or '', serialize(variables),
+             step, sql_hash(sql), datetime.now().isoformat())
+        )
+
+    def clear_steps(self, run_key: str) -> None:
+        self.execute('delete from steps where run_key = ?', (run_key,))
+
+    def get_fingerprint(self, project: str, connection: str, group: str,
+                        step: str) -> tuple:
+        """
+        :return: (sql hash, watermark) of the last successful run of the step,
+        or None.
+        """
+        rows = self.execute(
+            'select sql_hash, watermark from fingerprints where project = ? '
+            'and connection = ? and grp = ? and step = ?',
+            (project, connection, group or '', step)
+        )
+        return rows[0] if rows else None
+
+    def set_fingerprint(self, project: str, connection: str, group: str,
+                        step: str, sql: str, watermark: str) -> None:
+        self.execute(
+            'insert or replace into fingerprints values (?, ?, ?, ?, ?, ?, ?)',
+            (project, connection, group or '', step, sql_hash(sql), watermark,
+             datetime.now().isoformat())
+        )
+
+    def get_integrity_watermark(self, project: str, connection: str,
+                                check: str) -> tuple:
+        """
+        :return: (hash of the query, watermark) of the last time the check
+        passed, or None.
+        """
+        rows = self.execute(
+            'select sql_hash, watermark from integrity_watermarks '
+            'where project = ? and connection = ? and check_name = ?',
+            (project, connection, check)
+        )
+        return rows[0] if rows else None
+
+    def set_integrity_watermark(self, project: str, connection: str,
+                                check: str, sql: str, watermark: str) -> None:
+        self.execute(
+            'insert or replace into integrity_watermarks '
+            'values (?, ?, ?, ?, ?, ?)',
+            (project, connection, check, sql_hash(sql), watermark,
+             datetime.now().isoformat())
+        )
+
+    def check_durations(self, project: str, connection: str) -> dict:
+        """
+        :return: dict of check -> duration in seconds of its last run.
+        """
+        rows = self.execute(
+            'select check_name, duration from check_durations '
+            'where project = ? and connection = ?', (project, connection)
+        )
+        return dict(rows)
+
+    def set_check_durations(self, project: str, connection: str,
+                            durations: dict) -> None:
+        recorded_at = datetime.now().isoformat()
+        with closing(self.connect()) as db, db:
+            db.executemany(
+                'insert or replace into check_durations '
+                'values (?, ?, ?, ?, ?)',
+                [(project, connection, check, duration, recorded_at)
+                 for check, duration in durations.items()]
+            )
+
+    def record_run_metrics(self, record: dict,
+                           retention: int = METRICS_RETENTION) -> None:
+        """
+        Add the steps of a run to the history. Only the last `retention` runs
+        of the project, connection and group are kept.
+        :param record: record of the run, see RunMetrics.to_record.
+        :param retention
+        """
+        key = (record['project'], record['connection'], record['group'])
+        with closing(self.connect()) as db, db:
+            db.executemany(
+                'insert or replace into step_metrics '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(record['run_id'], *key, record['started_at'], step['step'],
+                  step['status'], step['render_seconds'],
+                  step['execute_seconds'], step['rowcount'])
+                 for step in record['steps']]
+            )
+            db.execute(
+                'delete from step_metrics '
+                'where project = ? and connection = ? and grp = ? '
+                'and run_id not in ('
+                '    select run_id from step_metrics '
+                '    where project = ? and connection = ? and grp = ? '
+                '    group by run_id order by max(started_at) desc limit ?'
+                ')',
+                key + key + (retention,)
+            )
+
+    def step_history(self, project: str, connection: str = None,
+                     group: str = None) -> list:
+        """
+        :return: list of (connection, step, execute seconds) of the successful
+        steps of a project, from the oldest run to the latest.
+        """
+        query = 'select connection, step, execute_seconds from step_metrics ' \
+                'where project = ? and status = ?'
+        parameters = [project, 'success']
+        if connection is not None:
+            query += ' and connection = ?'
+            parameters.append(connection)
+        if group is not None:
+            query += ' and grp = ?'
+            parameters.append(group)
+        return self.execute(query + ' order by started_at', tuple(parameters))
+
+    def get_plan(self, project: str, connection: str, group: str,
+                 step: str) -> dict:
+        """
+        :return: dict with plan, cost, rows and full_scans of the last explain
+        of the step, or None.
+        """
+        rows = self.execute(
+            'select plan, cost, estimated_rows, full_scans from plans '
+            'where project = ? and connection = ? and grp = ? and step = ?',
+            (project, connection, group or '', step)
+        )
+        if not rows:
+            return None
+        plan, cost, estimated_rows, full_scans = rows[0]
+        return {'plan': plan, 'cost': cost, 'rows': estimated_rows,
+                'full_scans': json.loads(full_scans)}
+
+    def set_plan(self, project: str, connection: str, group: str, step: str,
+                 sql: str, plan: dict) -> None:
+        self.execute(
+            'insert or replace into plans '
+            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (project, connection, group or '', step, sql_hash(sql),
+             plan['plan'], plan['cost'], plan['rows'],
+             json.dumps(plan['full_scans']), datetime.now().isoformat())
+        )
+
+
+def run_key(project: str, connection: str, group: str,
+            variables: dict) -> str:
+    key = serialize([project, connection, group or '', variables])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def sql_hash(sql: str) -> str:
+    return hashlib.sha256(sql.encode()).hexdigest()
+
+
+def serialize(variables: dict) -> str:
+    return json.dumps(variables or dict(), sort_keys=True, default=str)
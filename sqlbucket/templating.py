@@ -0,0 +1,293 @@
+from jinja2 import Environment, FileSystemLoader, BytecodeCache, \
+    FileSystemBytecodeCache, meta, nodes
+from jinja2.bccache import Bucket
+from jinja2.defaults import DEFAULT_NAMESPACE
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import threading
+
+
+macro_folder_from_lib = Path(__file__).parent / 'macros'
+
+_jinja_envs = dict()
+_bytecode_caches = dict()
+_lock = threading.Lock()
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """
+    Bytecode cache kept in memory and shared by all the environments of the
+    process, so templates found in several search paths (typically the macro
+    library) are compiled only once. When a folder is given, bytecode is also
+    stored on disk to be reused by the next processes.
+    """
+    def __init__(self, folder: str = None):
+        self.buckets = dict()
+        self.file_cache = None
+        if folder is not None:
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            self.file_cache = FileSystemBytecodeCache(directory=str(folder))
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        code = self.buckets.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+        elif self.file_cache is not None:
+            self.file_cache.load_bytecode(bucket)
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        self.buckets[bucket.key] = bucket.bytecode_to_string()
+        if self.file_cache is not None:
+            self.file_cache.dump_bytecode(bucket)
+
+    def clear(self) -> None:
+        self.buckets.clear()
+        if self.file_cache is not None:
+            self.file_cache.clear()
+
+
+def get_jinja_env(folder: str, macros_path: str = None,
+                  bytecode_cache_path: str = None,
+                  env_globals: dict = None) -> Environment:
+    """
+    Return the jinja environment for a project folder, creating it on first
+    call. Environments are shared within the process, so compiled templates
+    are reused between projects loaded for different connections.
+    :param folder: path of the templates folder (queries, integrity).
+    :param macros_path: optional path of user macros.
+    :param bytecode_cache_path: optional folder to store compiled templates.
+    :param env_globals: optional variables visible to all the templates,
+    including the imported macros. An environment is shared per set of globals.
+    :return: Environment instance
+    """
+    search_path = [str(folder), str(macro_folder_from_lib)]
+    if macros_path:
+        search_path.append(str(macros_path))
+
+    key = (
+        tuple(search_path), bytecode_cache_path,
+        json.dumps(env_globals, sort_keys=True) if env_globals else None
+    )
+    with _lock:
+        if key not in _jinja_envs:
+            if bytecode_cache_path not in _bytecode_caches:
+                _bytecode_caches[bytecode_cache_path] = MemoryBytecodeCache(
+                    folder=bytecode_cache_path
+                )
+            _jinja_envs[key] = Environment(
+                loader=FileSystemLoader(searchpath=search_path),
+                bytecode_cache=_bytecode_caches[bytecode_cache_path]
+            )
+            _jinja_envs[key].globals.update(env_globals or dict())
+        return _jinja_envs[key]
+
+
+def clear_jinja_envs() -> None:
+    """
+    Forget all the environments and in memory bytecode of the process.
+    Bytecode stored on disk is kept.
+    """
+    with _lock:
+        _jinja_envs.clear()
+        for cache in _bytecode_caches.values():
+            cache.buckets.clear()
+        _bytecode_caches.clear()
+
+
+MISSING = '<undefined>'
+
+
+class RenderCache:
+    """
+    Cache of rendered templates, keyed only by the values of the variables a
+    template actually uses. The variables are found statically from the
+    template syntax tree, including the templates it includes or extends, and
+    as precisely as `c.foo` for attributes of the context namespaces. A
+    template that does not use any connection variable therefore renders only
+    once for all the connections.
+
+    Templates whose referenced templates cannot be known statically (dynamic
+    includes) are never cached.
+    """
+    def __init__(self, folder: str = None):
+        """
+        :param folder: optional folder to also keep rendered templates on disk.
+        """
+        self.folder = Path(folder) if folder is not None else None
+        if self.folder is not None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+        self.rendered = dict()
+        self.analysis = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, jinja_env: Environment, name: str, context: dict) -> str:
+        key = self.key(jinja_env, name, context)
+        if key is None:
+            return jinja_env.get_template(name).render(**context)
+
+        rendered = self.rendered.get(key)
+        if rendered is None and self.folder is not None:
+            path = self.folder / f'{key}.sql'
+            if path.exists():
+                rendered = path.read_text()
+        if rendered is not None:
+            self.hits += 1
+            self.rendered[key] = rendered
+            return rendered
+
+        self.misses += 1
+        rendered = jinja_env.get_template(name).render(**context)
+        self.rendered[key] = rendered
+        if self.folder is not None:
+            (self.folder / f'{key}.sql').write_text(rendered)
+        return rendered
+
+    def key(self, jinja_env: Environment, name: str,
+            context: dict) -> Optional[str]:
+        analysis = self.analyse(jinja_env, name)
+        if analysis is None:
+            return None
+        paths, digest = analysis
+
+        values = [
+            [list(path), lookup(context, path)] for path in sorted(paths)
+        ]
+        # globals are visible to the macros, rendering differs with them
+        env_globals = {
+            key: value for key, value in jinja_env.globals.items()
+            if key not in DEFAULT_NAMESPACE
+        }
+        serialized = json.dumps(
+            [name, digest, values, env_globals], sort_keys=True,
+            default=json_default
+        )
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def analyse(self, jinja_env: Environment, name: str) -> Optional[tuple]:
+        """
+        :return: tuple of the variable paths used by the template, and a digest
+        of its source and the sources of its referenced templates. None if the
+        template cannot be analysed statically.
+        """
+        cached = self.analysis.get((jinja_env, name))
+        if cached is not None:
+            result, uptodates = cached
+            if all(uptodate() for uptodate in uptodates if uptodate):
+                return result
+
+        uptodates = list()
+        result = template_variables(jinja_env, name, uptodates)
+        self.analysis[(jinja_env, name)] = (result, uptodates)
+        return result
+
+    def clear(self) -> None:
+        self.rendered.clear()
+        self.analysis.clear()
+
+
+def template_variables(jinja_env: Environment, name: str,
+                       uptodates: list = None,
+                       seen: set = None) -> Optional[tuple]:
+    """
+    Find statically the variables used by a template.
+    :param jinja_env
+    :param name: template name
+    :param uptodates: list filled with the loader uptodate functions of every
+    template visited.
+    :param seen: names of the templates already visited.
+    :return: tuple of the set of variable paths, such as ('foo',) or
+    ('c', 'foo'), and a digest of the sources. None if a referenced template is
+    dynamic.
+    """
+    uptodates = uptodates if uptodates is not None else list()
+    seen = seen if seen is not None else set()
+    seen.add(name)
+
+    source, filename, uptodate = jinja_env.loader.get_source(jinja_env, name)
+    uptodates.append(uptodate)
+    ast = jinja_env.parse(source, name, filename)
+    digest = hashlib.sha256(source.encode())
+
+    undeclared = meta.find_undeclared_variables(ast)
+    paths = set()
+    collect_paths(ast, undeclared, paths)
+
+    for node in ast.find_all((nodes.Extends, nodes.Include, nodes.Import,
+                              nodes.FromImport)):
+        if not isinstance(node.template, nodes.Const):
+            return None
+        referenced = node.template.value
+        if referenced in seen:
+            continue
+        result = template_variables(jinja_env, referenced, uptodates, seen)
+        if result is None:
+            return None
+        referenced_paths, referenced_digest = result
+        digest.update(referenced_digest.encode())
+
+        # macros imported without context cannot see the variables
+        with_context = getattr(node, 'with_context', True)
+        if with_context:
+            paths |= referenced_paths
+
+    return paths, digest.hexdigest()
+
+
+def collect_paths(node: nodes.Node, undeclared: set, paths: set) -> None:
+    # a method called on a variable, like c.get('schema'), may read any key
+    if isinstance(node, nodes.Call) and isinstance(node.node, nodes.Getattr) \
+            and isinstance(node.node.node, nodes.Name) \
+            and node.node.node.name in undeclared:
+        paths.add((node.node.node.name,))
+        for child in node.iter_child_nodes():
+            if child is not node.node:
+                collect_paths(child, undeclared, paths)
+        return
+
+    if isinstance(node, (nodes.Getattr, nodes.Getitem)) \
+            and isinstance(node.node, nodes.Name) \
+            and node.node.name in undeclared:
+        if isinstance(node, nodes.Getattr):
+            paths.add((node.node.name, node.attr))
+            return
+        if isinstance(node.arg, nodes.Const):
+            paths.add((node.node.name, node.arg.value))
+            return
+    elif isinstance(node, nodes.Name) and node.ctx == 'load' \
+            and node.name in undeclared:
+        paths.add((node.name,))
+
+    for child in node.iter_child_nodes():
+        collect_paths(child, undeclared, paths)
+
+
+def lookup(context: Mapping, path: tuple):
+    """
+    :return: value of the variable path in the context. When a key is not in
+    a mapping of the path, like `get` for `c.get`, the template sees an
+    attribute of the mapping instead, so the whole mapping is returned.
+    """
+    value = context
+    for depth, key in enumerate(path):
+        if isinstance(value, Mapping):
+            if key not in value:
+                return value if depth else MISSING
+            value = value[key]
+        else:
+            value = getattr(value, str(key), MISSING)
+        if value is MISSING:
+            break
+    return value
+
+
+def json_default(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    if callable(value):
+        return f'{getattr(value, "__module__", "")}.' \
+               f'{getattr(value, "__qualname__", repr(value))}'
+    return repr(value)
@@ -0,0 +1,254 @@
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from pathlib import Path
+from queue import Queue
+from typing import Callable, Optional
+from urllib.request import Request, urlopen
+from sqlbucket.utils import logger
+import atexit
+import json
+import secrets
+import threading
+import time
+
+
+_current_span = ContextVar('sqlbucket_span', default=None)
+_hooks = list()
+_hooks_lock = threading.Lock()
+
+
+class Span:
+    """
+    A timed phase of a run, like loading a project, connecting or running a
+    step. Spans opened within a span are its children.
+    """
+    def __init__(self, name: str, parent: 'Span' = None,
+                 attributes: dict = None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or dict())
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        :return: duration in seconds, None if the span is not ended.
+        """
+        if self.end_time is None:
+            return None
+        return (self.end_time - self.start_time) / 1e9
+
+    def __repr__(self) -> str:
+        return f'Span({self.name!r}, duration={self.duration})'
+
+
+class SpanHook:
+    """
+    Interface to attach a tracer to SQLBucket: hooks are called when a span
+    starts and when it ends, from the thread running the span. An exception
+    raised by a hook is logged, and never fails the run.
+    """
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        pass
+
+
+def register_hook(hook: SpanHook) -> SpanHook:
+    with _hooks_lock:
+        _hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook: SpanHook) -> None:
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+@contextmanager
+def span(name: str, attributes: dict = None):
+    """
+    Open a span, child of the current span if any. An exception raised within
+    the span is recorded on it, and raised again.
+    :param name
+    :param attributes: attributes of the span, like the step it runs.
+    """
+    current = Span(name, parent=_current_span.get(), attributes=attributes)
+    hooks = list(_hooks)
+    call_hooks(hooks, 'on_start', current)
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_time = time.time_ns()
+        call_hooks(hooks, 'on_end', current)
+
+
+def call_hooks(hooks: list, method: str, current: Span) -> None:
+    for hook in hooks:
+        try:
+            getattr(hook, method)(current)
+        except Exception as e:
+            logger.warning(f'Tracing hook {type(hook).__name__}.{method} '
+                           f'failed on span {current.name}: {e}')
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def in_current_context(func: Callable) -> Callable:
+    """
+    Wrap a function submitted to a thread pool, so the spans it opens are
+    children of the current span instead of new traces.
+    """
+    return partial(copy_context().run, func)
+
+
+class InMemoryExporter(SpanHook):
+    """
+    Keep the ended spans in memory, typically for tests.
+    """
+    def __init__(self):
+        self.spans = list()
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def names(self) -> list:
+        return [span.name for span in self.spans]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+
+class OTLPJsonExporter(SpanHook):
+    """
+    Export the spans in the OpenTelemetry protocol JSON format, once a trace
+    is complete, to a file (one export request per line) and/or to the HTTP
+    endpoint of a collector, like http://localhost:4318/v1/traces. Traces are
+    exported from a background thread, so a slow or unreachable collector
+    does not slow down nor fail the run: export errors are only logged.
+    Pending exports are flushed when the process exits.
+    """
+    def __init__(self, path: str = None, endpoint: str = None,
+                 service_name: str = 'sqlbucket', timeout: float = 10):
+        if path is None and endpoint is None:
+            raise ValueError('Indicate the path or the endpoint to export to')
+        self.path = path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.pending = dict()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._thread = None
+
+    def on_end(self, span: Span) -> None:
+        with self._lock:
+            self.pending.setdefault(span.trace_id, list()).append(span)
+            if span.parent is not None:
+                return
+            spans = self.pending.pop(span.trace_id)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._export_queued, name='sqlbucket-otlp',
+                    daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+        self._queue.put(spans)
+
+    def flush(self) -> None:
+        """
+        Wait for the traces completed so far to be exported.
+        """
+        self._queue.join()
+
+    def _export_queued(self) -> None:
+        while True:
+            spans = self._queue.get()
+            try:
+                self.export(spans)
+            except Exception as e:
+                logger.warning(f'Traces could not be exported: {e}')
+            finally:
+                self._queue.task_done()
+
+    def export(self, spans: list) -> None:
+        payload = json.dumps(self.to_otlp(spans), default=str)
+        if self.path is not None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(payload + '\n')
+        if self.endpoint is not None:
+            request = Request(
+                self.endpoint, data=payload.encode(), method='POST',
+                headers={'Content-Type': 'application/json'}
+            )
+            with urlopen(request, timeout=self.timeout):
+                pass
+
+    def to_otlp(self, spans: list) -> dict:
+        return {'resourceSpans': [{
+            'resource': {'attributes': otlp_attributes(
+                {'service.name': self.service_name}
+            )},
+            'scopeSpans': [{
+                'scope': {'name': 'sqlbucket'},
+                'spans': [otlp_span(span) for span in spans],
+            }],
+        }]}
+
+
+def otlp_span(span: Span) -> dict:
+    exported = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 1,
+        'startTimeUnixNano': str(span.start_time),
+        'endTimeUnixNano': str(span.end_time),
+        'attributes': otlp_attributes(span.attributes),
+        'status': {'code': 2, 'message': span.error} if span.error
+        else {'code': 1},
+    }
+    if span.parent_id is not None:
+        exported['parentSpanId'] = span.parent_id
+    return exported
+
+
+def otlp_attributes(attributes: dict) -> list:
+    exported = list()
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': str(value)}
+        exported.append({'key': key, 'value': typed})
+    return exported
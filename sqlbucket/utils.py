@@ -1,5 +1,7 @@
 import logging
 import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 
 
@@ -11,10 +13,74 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 
+class LogPrefixFilter(logging.Filter):
+    """
+    Prefix the log messages with the tag set for the current context, if any.
+    Used to tell apart the logs of connections running in parallel. The tag is
+    a context variable, so it follows the functions submitted to thread pools
+    with `in_current_context`, like the steps run with workers.
+    """
+    prefix = ContextVar('sqlbucket_log_prefix', default=None)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        prefix = self.prefix.get()
+        if prefix:
+            record.msg = f'[{prefix}] {record.msg}'
+        return True
+
+
+logger.addFilter(LogPrefixFilter())
+
+
+@contextmanager
+def log_prefix(prefix: str):
+    token = LogPrefixFilter.prefix.set(prefix)
+    try:
+        yield
+    finally:
+        LogPrefixFilter.prefix.reset(token)
+
+
 def n_days_ago(n):
     return (datetime.today() - timedelta(days=n)).strftime('%Y-%m-%d')
 
 
+def date_partitions(from_date: str, to_date: str, split: str) -> list:
+    """
+    Split a date range in contiguous partitions. Each partition ends where the
+    next one starts, and the last one ends on `to_date`. Day and week
+    partitions start on `from_date`, month partitions follow calendar months.
+    :param from_date: as YYYY-MM-DD
+    :param to_date: as YYYY-MM-DD
+    :param split: day, week or month
+    :return: list of (from, to) tuples of dates as YYYY-MM-DD
+    """
+    start = datetime.strptime(from_date, '%Y-%m-%d')
+    end = datetime.strptime(to_date, '%Y-%m-%d')
+    if start >= end:
+        raise ValueError(f'Cannot split range {from_date} to {to_date}, '
+                         f'"from" must be before "to"')
+
+    partitions = list()
+    while start < end:
+        if split == 'day':
+            next_start = start + timedelta(days=1)
+        elif split == 'week':
+            next_start = start + timedelta(weeks=1)
+        elif split == 'month':
+            next_start = (start.replace(day=1) + timedelta(days=32)).replace(
+                day=1
+            )
+        else:
+            raise ValueError(f'Unknown split "{split}"')
+        next_start = min(next_start, end)
+        partitions.append(
+            (start.strftime('%Y-%m-%d'), next_start.strftime('%Y-%m-%d'))
+        )
+        start = next_start
+    return partitions
+
+
 def cli_variables_parser(cli_variables: list = None) -> dict:
     variables = dict()
 
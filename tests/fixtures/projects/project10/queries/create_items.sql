@@ -0,0 +1 @@
+create table items as select 1 as id, 'a' as name union all select 2, 'b'
@@ -0,0 +1 @@
+create table names as select name from items where id = 1
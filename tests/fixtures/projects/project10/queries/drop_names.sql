@@ -0,0 +1 @@
+drop table if exists names
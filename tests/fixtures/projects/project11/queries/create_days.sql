@@ -0,0 +1 @@
+create table if not exists days (day text)
@@ -0,0 +1 @@
+insert into days select day from staging
@@ -0,0 +1 @@
+create temp table staging as select '{{ from }}' as day
@@ -0,0 +1 @@
+create table table_a as select {{ value }} as id
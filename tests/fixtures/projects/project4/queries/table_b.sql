@@ -0,0 +1 @@
+create table table_b as select {{ value }} as id
@@ -0,0 +1 @@
+create table table_c as select a.id from table_a a join table_b b on a.id = b.id
@@ -0,0 +1 @@
+create table if not exists runs_log (from_date text, to_date text, step text)
@@ -0,0 +1 @@
+insert into runs_log values ('{{ from }}', '{{ to }}', 'insert_log')
@@ -0,0 +1 @@
+insert into b select id from a
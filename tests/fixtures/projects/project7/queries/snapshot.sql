@@ -0,0 +1 @@
+insert into snapshot select count(1) from {{ source }}
@@ -0,0 +1 @@
+select count(1) = 0 as passed from items where id is null
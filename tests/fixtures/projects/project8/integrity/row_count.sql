@@ -0,0 +1,2 @@
+{% import 'common.jinja2' as common %}
+{{ common.has_row_count('items', row_count) }}
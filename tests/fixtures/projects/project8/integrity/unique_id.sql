@@ -0,0 +1,2 @@
+{% import 'common.jinja2' as common %}
+{{ common.is_unique('items', 'id') }}
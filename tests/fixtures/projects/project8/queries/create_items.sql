@@ -0,0 +1 @@
+create table items as select 1 as id, 10 as amount union all select 2, 20 union all select 3, null
@@ -0,0 +1 @@
+select count(1) = 0 as passed from events where id is null
@@ -0,0 +1,4 @@
+{% import 'profile.jinja2' as profile %}
+{{ profile.table_profile('events', checks=[
+    {'check': 'is_non_negative', 'column': 'amount'}
+], partition_column='day', watermark=watermark) }}
@@ -0,0 +1,2 @@
+{% import 'common.jinja2' as common %}
+{{ common.is_unique('events', 'id', partition_column='day', watermark=watermark) }}
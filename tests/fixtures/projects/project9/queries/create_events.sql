@@ -0,0 +1 @@
+create table events as select 1 as id, '2024-01-01' as day, 10 as amount union all select 2, '2024-01-02', 20
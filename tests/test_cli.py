@@ -0,0 +1,254 @@
+from sqlbucket import SQLBucket
+from sqlbucket.cli import load_cli
+from sqlbucket.metrics import RunMetrics
+from sqlbucket.utils import n_days_ago
+from click.testing import CliRunner
+from pathlib import Path
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+import json
+import logging
+
+
+class TestRunJobParallel:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_parallel_connections(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={
+                'db_1': f'sqlite:///{tmp_path / "db_1.sqlite"}',
+                'db_2': f'sqlite:///{tmp_path / "db_2.sqlite"}',
+            },
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-job', '-n', 'project4', '--all', '-P', '2', '-s']
+        )
+        assert result.exit_code == 0
+        assert (tmp_path / "db_1.sqlite").exists()
+        assert (tmp_path / "db_2.sqlite").exists()
+
+    def test_parallel_connection_failure(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={
+                'db_1': f'sqlite:///{tmp_path / "db_1.sqlite"}',
+                'db_2': f'sqlite:///{tmp_path / "missing" / "db_2.sqlite"}',
+            },
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-job', '-n', 'project4', '--all', '-P', '2', '-s']
+        )
+        assert result.exit_code == 1
+        assert (tmp_path / "db_1.sqlite").exists()
+
+
+class TestRunJobBackfill:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_split_partitions_skipped_on_rerun(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': url},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        arguments = ['run-job', '-n', 'project5', '-b', 'db', '-s',
+                     '-f', '2019-11-01', '-t', '2019-11-04', '--split', 'day',
+                     '-P', '2']
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 0
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 0
+
+        rows = create_engine(url).execute(
+            'select from_date, to_date from runs_log order by from_date'
+        ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ('2019-11-01', '2019-11-02'),
+            ('2019-11-02', '2019-11-03'),
+            ('2019-11-03', '2019-11-04'),
+        ]
+
+    def sqlbucket(self, tmp_path):
+        return SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+
+    def logged_partitions(self, tmp_path):
+        rows = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}').execute(
+            'select from_date, to_date from runs_log order by from_date'
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def test_partitions_per_step_selection(self, tmp_path):
+        sqlbucket = self.sqlbucket(tmp_path)
+        arguments = ['run-job', '-n', 'project5', '-b', 'db', '-s',
+                     '-f', '2019-11-01', '-t', '2019-11-03', '--split', 'day']
+        result = CliRunner().invoke(
+            load_cli(sqlbucket), arguments + ['-ts', '1']
+        )
+        assert result.exit_code == 0
+        assert self.logged_partitions(tmp_path) == []
+
+        # partitions only ran the first step, so they are not skipped
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 0
+        assert self.logged_partitions(tmp_path) == [
+            ('2019-11-01', '2019-11-02'), ('2019-11-02', '2019-11-03'),
+        ]
+
+    def test_open_partition_not_recorded(self, tmp_path):
+        sqlbucket = self.sqlbucket(tmp_path)
+        arguments = ['run-job', '-n', 'project5', '-b', 'db', '-s',
+                     '-f', n_days_ago(2), '--split', 'day']
+        for _ in range(2):
+            result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+            assert result.exit_code == 0
+
+        # the partition ending today is run again, the other one is not
+        assert self.logged_partitions(tmp_path) == [
+            (n_days_ago(2), n_days_ago(1)),
+            (n_days_ago(1), n_days_ago(0)),
+            (n_days_ago(1), n_days_ago(0)),
+        ]
+
+    def test_session_not_reused_across_partitions(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': url},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state'),
+            pool_options={'poolclass': QueuePool}
+        )
+        # each partition creates the same temporary table
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-job', '-n', 'project11', '-b', 'db', '-s',
+             '-f', '2019-11-01', '-t', '2019-11-03', '--split', 'day']
+        )
+        assert result.exit_code == 0
+        engine = create_engine(url)
+        assert engine.execute(
+            'select day from days order by day'
+        ).fetchall() == [('2019-11-01',), ('2019-11-02',)]
+
+    def test_invalid_range(self, tmp_path):
+        result = CliRunner().invoke(
+            load_cli(self.sqlbucket(tmp_path)),
+            ['run-job', '-n', 'project5', '-b', 'db', '-s',
+             '-f', '2019-11-03', '-t', '2019-11-01', '--split', 'day']
+        )
+        assert result.exit_code == 2
+        assert '"from" must be before "to"' in result.output
+
+
+class TestRunJobResume:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_default_dates_not_in_run_key(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-job', '-n', 'project6', '-b', 'db', '-s', '--resume',
+             '-f', '2019-11-01', 'foo=bar']
+        )
+        # insert_b fails, create_a is recorded for the next run
+        assert result.exit_code == 1
+        [(variables,)] = sqlbucket.state.execute('select variables from steps')
+        assert json.loads(variables) == {'from': '2019-11-01', 'foo': 'bar'}
+
+
+class TestRunJobTransaction:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_invalid_options(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        arguments = ['run-job', '-n', 'project4', '-b', 'db', '-s', '-P', '2']
+        for options, message in (
+            (['-T', '-w', '2'], 'cannot be used with workers'),
+            (['-T', '-rt', '1'], 'can only be retried with savepoints'),
+        ):
+            result = CliRunner().invoke(
+                load_cli(sqlbucket), arguments + options
+            )
+            assert result.exit_code == 2
+            assert message in result.output
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        assert engine.table_names() == []
+
+
+class TestStats:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_stats(self, tmp_path, caplog):
+        caplog.set_level(logging.INFO)
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        result = CliRunner().invoke(load_cli(sqlbucket),
+                                    ['stats', '-n', 'project4'])
+        assert result.exit_code == 0
+        assert 'No run recorded for project "project4".' in caplog.text
+
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-job', '-n', 'project4', '-b', 'db', '-s',
+             '-M', str(tmp_path / 'runs.jsonl')]
+        )
+        assert result.exit_code == 0
+        caplog.clear()
+        result = CliRunner().invoke(load_cli(sqlbucket),
+                                    ['stats', '-n', 'project4', '-b', 'db'])
+        assert result.exit_code == 0
+        rows = [line for line in caplog.text.splitlines()
+                if line.startswith('| db')]
+        assert [row.split('|')[2].strip() for row in rows] == [
+            'table_a.sql', 'table_b.sql', 'table_c.sql'
+        ]
+        assert 'REGRESSED' not in caplog.text
+
+        for seconds in (1.0, 1.0, 1.0, 5.0):
+            metrics = RunMetrics(project='project4', connection='db')
+            metrics.record_step('slow.sql', 'success', 0.1, seconds)
+            sqlbucket.state.record_run_metrics(metrics.to_record())
+        caplog.clear()
+        result = CliRunner().invoke(load_cli(sqlbucket),
+                                    ['stats', '-n', 'project4', '-b', 'db'])
+        assert result.exit_code == 0
+        [row] = [line for line in caplog.text.splitlines()
+                 if 'slow.sql' in line and line.startswith('|')]
+        assert [cell.strip() for cell in row.split('|')[1:-1]] == [
+            'db', 'slow.sql', '4', '1.000s', '5.000s', '5.000s', 'REGRESSED'
+        ]
+        assert '1 step(s) regressed: slow.sql' in caplog.text
+
@@ -0,0 +1,174 @@
+from sqlbucket import SQLBucket
+from sqlbucket.cli import load_cli
+from sqlbucket.explain import explainable_statements, parse_text_plan, \
+    parse_sqlite_plan, parse_mysql_plan, compare_plans
+from click.testing import CliRunner
+from pathlib import Path
+from sqlalchemy import create_engine
+
+
+POSTGRES_PLAN = [
+    ('Hash Join  (cost=35.50..102.15 rows=1000 width=8)',),
+    ('  Hash Cond: (a.id = b.id)',),
+    ('  ->  Seq Scan on table_a a  (cost=0.00..22.70 rows=1270 width=4)',),
+    ('  ->  Hash  (cost=22.70..22.70 rows=1270 width=4)',),
+    ('        ->  Index Scan using table_b_pkey on table_b b  '
+     '(cost=0.15..22.70 rows=1270 width=4)',),
+]
+
+
+class TestPlans:
+
+    def test_explainable_statements(self):
+        query = """
+            drop table if exists names;
+            create table names distkey(id) as (
+                select id, name from items
+            );
+            insert into names select 3, 'c'
+        """
+        assert explainable_statements(query) == [
+            'select id, name from items', "insert into names select 3, 'c'"
+        ]
+
+    def test_semicolons_in_literals(self):
+        query = """
+            -- drop names; then fill it
+            select 'a;b' as name, "c;d" from items;
+            /* ; */ insert into names select 'it''s;'
+        """
+        assert explainable_statements(query) == [
+            "select 'a;b' as name, \"c;d\" from items",
+            "insert into names select 'it''s;'"
+        ]
+
+    def test_postgres(self):
+        plan = parse_text_plan(POSTGRES_PLAN)
+        assert plan['cost'] == 102.15
+        assert plan['rows'] == 1000
+        assert plan['full_scans'] == ['table_a']
+        assert plan['plan'].startswith('Hash Join')
+
+    def test_redshift(self):
+        plan = parse_text_plan([
+            ('XN Seq Scan on events  (cost=0.00..0.03 rows=3 width=4)',),
+        ])
+        assert plan['cost'] == 0.03
+        assert plan['full_scans'] == ['events']
+
+    def test_sqlite(self):
+        plan = parse_sqlite_plan([
+            (2, 0, 0, 'SCAN items'),
+            (5, 0, 0, 'SEARCH names USING INDEX names_id (id=?)'),
+            (7, 0, 0, 'SCAN events USING COVERING INDEX events_day'),
+            (9, 0, 0, 'SCAN CONSTANT ROW'),
+        ])
+        assert plan['full_scans'] == ['items']
+        assert plan['cost'] is None
+
+    def test_mysql(self):
+        plan = parse_mysql_plan([
+            {'table': 'a', 'type': 'ALL', 'key': None, 'rows': 100,
+             'Extra': 'Using where'},
+            {'table': 'b', 'type': 'ref', 'key': 'b_id', 'rows': 1,
+             'Extra': None},
+        ])
+        assert plan['full_scans'] == ['a']
+        assert plan['rows'] == 101
+
+    def test_regressions(self):
+        previous = {'cost': 10.0, 'full_scans': ['a']}
+        assert compare_plans(
+            previous, {'cost': 15.0, 'full_scans': ['a']}
+        ) == []
+        assert compare_plans(
+            previous, {'cost': 30.0, 'full_scans': ['a', 'b']}
+        ) == ['new full scan of b', 'cost x3.0 (10 -> 30)']
+        assert compare_plans(
+            {'cost': None, 'full_scans': []}, {'cost': 5.0, 'full_scans': []}
+        ) == []
+
+
+class TestExplainProject:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def sqlbucket(self, tmp_path):
+        return SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+
+    def test_full_scan_regression(self, tmp_path):
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        project = self.sqlbucket(tmp_path).load_project(
+            project_name='project10', connection_name='db'
+        )
+        project.run(silent=True)
+        engine.execute('create index items_id on items (id)')
+
+        plans = {plan['step']: plan for plan in project.explain(from_step=2)}
+        assert plans['drop_names.sql']['plan'] == ''
+        assert plans['create_names.sql']['full_scans'] == []
+        assert plans['create_names.sql']['regressions'] == []
+
+        engine.execute('drop index items_id')
+        plans = {plan['step']: plan for plan in project.explain(from_step=2)}
+        names = plans['create_names.sql']
+        assert names['full_scans'] == ['items']
+        assert names['previous']['full_scans'] == []
+        assert names['regressions'] == ['new full scan of items']
+
+        # the regressed plan does not become the baseline
+        plans = {plan['step']: plan for plan in project.explain(from_step=2)}
+        assert plans['create_names.sql']['regressions'] == [
+            'new full scan of items'
+        ]
+
+        project.explain(from_step=2, update_plans=True)
+        plans = {plan['step']: plan for plan in project.explain(from_step=2)}
+        assert plans['create_names.sql']['previous']['full_scans'] == [
+            'items'
+        ]
+        assert plans['create_names.sql']['regressions'] == []
+
+    def test_queries_not_run(self, tmp_path):
+        result = CliRunner().invoke(
+            load_cli(self.sqlbucket(tmp_path)),
+            ['run-job', '-n', 'project10', '-b', 'db', '--explain']
+        )
+        assert result.exit_code == 0
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        assert engine.table_names() == []
+
+    def test_regression_exit_code(self, tmp_path):
+        sqlbucket = self.sqlbucket(tmp_path)
+        sqlbucket.load_project(
+            project_name='project10', connection_name='db'
+        ).run(silent=True)
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        engine.execute('create index items_id on items (id)')
+        arguments = ['run-job', '-n', 'project10', '-b', 'db', '--explain',
+                     '-fs', '2']
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 0
+
+        engine.execute('drop index items_id')
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 3
+        result = CliRunner().invoke(
+            load_cli(sqlbucket), arguments + ['--update-plans']
+        )
+        assert result.exit_code == 3
+        result = CliRunner().invoke(load_cli(sqlbucket), arguments)
+        assert result.exit_code == 0
+
+    def test_step_not_explained(self, tmp_path):
+        plans = self.sqlbucket(tmp_path).load_project(
+            project_name='project10', connection_name='db'
+        ).explain()
+        # items is not created, as queries are only explained
+        assert plans[2]['error'].startswith('OperationalError')
+        assert plans[0]['error'] is None
@@ -1,7 +1,15 @@
 from sqlbucket import SQLBucket
-from sqlbucket.integrity import IntegrityCheck
+from sqlbucket.integrity import IntegrityCheck, is_batchable, run_batch, \
+    approximate_globals, schedule
+from sqlbucket.cli import load_cli
+from sqlbucket.runners import create_connection
+from sqlbucket.templating import get_jinja_env
 from sqlbucket.exceptions import PassedFieldNotInQuery
+from sqlalchemy import create_engine, text
+from click.testing import CliRunner
 from pathlib import Path
+import csv
+import logging
 import pytest
 
 
@@ -64,3 +72,502 @@ class TestIntegrityCheck:
         integrity = IntegrityCheck(rows=rows, query_name='foo.sql')
         assert integrity.has_passed() is False
         assert integrity.log_summary('whatever') == 'FAILED'
+
+
+class TestStreamedIntegrityCheck:
+
+    @staticmethod
+    def stream(count):
+        for i in range(count):
+            yield {"id": i, "passed": i % 10 != 0}
+
+    def test_single_pass(self):
+        integrity = IntegrityCheck(
+            rows=self.stream(1000), query_name='foo.sql', sample_size=5
+        )
+        assert integrity.count == 1000
+        assert integrity.succeeded == 900
+        assert integrity.failed == 100
+        assert integrity.has_passed() is False
+        assert len(integrity.rows) == 5
+        assert [row["id"] for row in integrity.failed_rows] == [
+            0, 10, 20, 30, 40
+        ]
+
+    def test_no_rows(self):
+        integrity = IntegrityCheck(rows=iter([]), query_name='foo.sql')
+        assert integrity.has_passed() is True
+        assert integrity.is_passed_field_missing() is False
+        assert integrity.log_summary('whatever') == 'success'
+
+    def test_spill(self, tmp_path):
+        spill_path = tmp_path / 'spill' / 'foo.sql.csv'
+        integrity = IntegrityCheck(
+            rows=self.stream(1000), query_name='foo.sql', sample_size=5,
+            spill_path=str(spill_path)
+        )
+        with open(spill_path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == integrity.failed == 100
+        assert rows[-1] == {'id': '990', 'passed': 'False'}
+
+    def test_nothing_spilled_when_passed(self, tmp_path):
+        spill_path = tmp_path / 'foo.sql.csv'
+        IntegrityCheck(
+            rows=[{"passed": True}], query_name='foo.sql',
+            spill_path=str(spill_path)
+        )
+        assert not spill_path.exists()
+
+
+class TestTableProfile:
+
+    template = """
+    {% import 'profile.jinja2' as profile %}
+    {{ profile.table_profile('items', checks=checks) }}
+    """
+
+    def run_profile(self, tmp_path, checks):
+        query = get_jinja_env(str(tmp_path)).from_string(
+            self.template
+        ).render(checks=checks)
+        engine = create_engine('sqlite://')
+        engine.execute(
+            'create table items as select 1 as id, 10 as amount '
+            'union all select 2, 20 union all select 3, null'
+        )
+        return query, [dict(row) for row in engine.execute(text(query))]
+
+    def test_single_scan(self, tmp_path):
+        query, rows = self.run_profile(tmp_path, [
+            {'check': 'is_unique', 'column': 'id'},
+            {'check': 'is_complete', 'column': 'amount'},
+        ])
+        assert query.count('from items') == 1
+        assert len(rows) == 2
+
+    def test_parameters_with_braces(self, tmp_path):
+        _, rows = self.run_profile(tmp_path, [
+            {'check': 'column_max_to_be_between', 'column': 'amount',
+             'lower_value': "length('{}')", 'higher_value': 25},
+        ])
+        assert [(row['expected'], row['calculated'], bool(row['passed']))
+                for row in rows] == [(2, 20, True)]
+
+    def test_checks(self, tmp_path):
+        _, rows = self.run_profile(tmp_path, [
+            {'check': 'is_unique', 'column': 'id'},
+            {'check': 'has_row_count', 'target_size': 3},
+            {'check': 'has_row_count_between', 'min_size': 4, 'max_size': 6},
+            {'check': 'is_complete', 'column': 'amount', 'threshold': 0.5},
+            {'check': 'is_non_negative', 'column': 'amount'},
+            {'check': 'is_contained_in', 'column': 'id', 'values': [1, 2]},
+            {'check': 'column_max_to_be_between', 'column': 'amount',
+             'lower_value': 0, 'higher_value': 15},
+            {'check': 'column_mean_to_be_between', 'column': 'amount',
+             'lower_value': 0, 'higher_value': 15},
+        ])
+        assert [(row['integrity_check'], row['expected'], row['calculated'],
+                 bool(row['passed'])) for row in rows] == [
+            ('items:id_is_unique', 3, 3, True),
+            ('items_has_row_count_3', 3, 3, True),
+            ('items_has_row_count_between_4_and_6', 4, 3, False),
+            ('items:amount_is_complete_threshold_0.5', 3, 2, True),
+            ('items:amount_is_non_negative', 3, 3, True),
+            ('items:id_is_contained_in', 3, 2, False),
+            ('items:amount_max_between_0_and_15', 0, 20, False),
+            ('items:amount_mean_between_0_and_15', 0, 15, True),
+        ]
+
+    def test_unknown_check_fails(self, tmp_path):
+        _, rows = self.run_profile(tmp_path, [{'check': 'is_sorted'}])
+        assert rows[0]['integrity_check'] == 'items:unknown_check_is_sorted'
+        assert not rows[0]['passed']
+
+    def test_is_batchable(self, tmp_path):
+        query, _ = self.run_profile(
+            tmp_path, [{'check': 'is_unique', 'column': 'id'}]
+        )
+        assert is_batchable(query)
+
+
+class TestApproximateMacros:
+
+    template = """
+    {% import 'common.jinja2' as common %}
+    {{ common.is_unique('items', 'id') }}
+    union all
+    {{ common.is_non_negative('items', 'amount') }}
+    """
+
+    def render(self, tmp_path, dialect, rate=0.01):
+        return get_jinja_env(
+            str(tmp_path),
+            env_globals={'approximate': approximate_globals(dialect, rate)}
+        ).from_string(self.template).render()
+
+    def test_tablesample(self, tmp_path):
+        query = self.render(tmp_path, 'postgresql')
+        assert query.count('from items tablesample system (1)') == 2
+        assert "'items:id_is_unique_sampled_1pct'" in query
+
+    def test_approximate_count_distinct(self, tmp_path):
+        query = self.render(tmp_path, 'snowflake', rate=0.05)
+        assert "'items:id_is_unique_approx'" in query
+        assert 'approx_count_distinct(id) >= count(1) * 0.9514' in query
+        assert 'from items sample system (5)' in query
+
+    def test_random_filter(self, tmp_path):
+        query = self.render(tmp_path, 'mysql', rate=0.1)
+        assert '(select * from items where rand() < 0.1) as sqlbucket_sample' \
+            in query
+
+    def test_exact_without_approximation(self, tmp_path):
+        query = get_jinja_env(str(tmp_path)).from_string(
+            self.template
+        ).render()
+        assert 'sample' not in query
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            approximate_globals('postgresql', 2)
+
+    def test_unsupported_dialect(self):
+        with pytest.raises(ValueError):
+            approximate_globals('teradata', 0.1)
+
+
+class TestExactMacros:
+
+    template = """
+    {% import 'common.jinja2' as common %}
+    {{ common.is_non_negative('items', 'amount') }}
+    union all
+    {{ common.is_contained_in('items', 'id', [1, 2]) }}
+    """
+
+    def run_checks(self, tmp_path, rows):
+        engine = create_engine('sqlite://')
+        engine.execute('create table items (id integer, amount integer)')
+        for row in rows:
+            engine.execute(
+                text('insert into items values (:id, :amount)'), row
+            )
+        query = get_jinja_env(str(tmp_path)).from_string(
+            self.template
+        ).render()
+        return [(row['integrity_check'], row['expected'], row['calculated'],
+                 bool(row['passed'])) for row in engine.execute(text(query))]
+
+    def test_nulls_pass(self, tmp_path):
+        assert self.run_checks(tmp_path, [
+            {'id': 1, 'amount': 0}, {'id': None, 'amount': None}
+        ]) == [
+            ('items:amount_is_non_negative', 2, 2, True),
+            ('items:id_is_contained_in', 2, 2, True),
+        ]
+
+    def test_failures(self, tmp_path):
+        assert self.run_checks(tmp_path, [
+            {'id': 1, 'amount': -1}, {'id': 3, 'amount': None}
+        ]) == [
+            ('items:amount_is_non_negative', 2, 1, False),
+            ('items:id_is_contained_in', 2, 1, False),
+        ]
+
+
+class IntegrityProject:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def load_project(self, tmp_path, row_count):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project8', connection_name='db',
+            variables={'row_count': row_count}
+        )
+        project.run(silent=True)
+        return project
+
+
+class TestBatchedIntegrity(IntegrityProject):
+
+    def test_is_batchable(self):
+        assert is_batchable(
+            "select 'x' as integrity_check, 1 as expected, 1 as calculated, "
+            "true as passed;"
+        )
+        assert not is_batchable("select count(1) = 0 as passed from items")
+        assert not is_batchable(
+            "select 'x' as integrity_check, 1 as expected, 1 as calculated, "
+            "true as passed; select 1"
+        )
+
+    def test_extra_columns_not_batchable(self):
+        assert not is_batchable(
+            "select 'x' as integrity_check, 1 as expected, 1 as calculated, "
+            "true as passed, id as failing_id from items"
+        )
+        assert not is_batchable(
+            "select 'x' as integrity_check, 1 as expected, 1 as calculated, "
+            "true as passed from items union all "
+            "select 'y' as integrity_check, 1 as expected, 1 as calculated, "
+            "true as passed, 2 as extra from items"
+        )
+
+    def test_nested_selects_batchable(self):
+        assert is_batchable(
+            "with counts as (select id, count(1) as n, 0 as expected "
+            "from items group by id) "
+            "select 'a, 1 as b' as integrity_check, 0 as expected, "
+            "(select max(n) from counts) as calculated, "
+            "coalesce(max(n), 0) <= 1 as passed -- as other\n"
+            "from counts"
+        )
+
+    def test_run_batch(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        configuration = project.configure_integrity()
+        connection = create_connection(configuration)
+        checks = run_batch(configuration, connection, configuration["order"])
+        connection.close()
+
+        assert set(checks) == {'row_count.sql', 'unique_id.sql'}
+        assert checks['unique_id.sql'].rows == [{
+            'integrity_check': 'items:id_is_unique',
+            'expected': 3, 'calculated': 3, 'passed': 1
+        }]
+
+    def test_batch_passed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        assert project.run_integrity(batch=True) == 0
+
+    def test_batch_failed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(batch=True) == 1
+
+
+class TestApproximateIntegrity(IntegrityProject):
+
+    def test_approximate_passed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        assert project.run_integrity(approximate=1) == 0
+        configuration = project.configure_integrity(approximate=1)
+        assert configuration["approximate"]["dialect"] == 'sqlite'
+        assert 'sqlbucket_sample' in configuration["queries"]["unique_id.sql"]
+        assert 'sqlbucket_sample' not in \
+            project.configure_integrity()["queries"]["unique_id.sql"]
+
+    def test_approximate_failed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(approximate=1, batch=True) == 1
+
+    def test_cli_variables_not_taken_as_rate(self, tmp_path):
+        self.load_project(tmp_path, row_count=3)
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        arguments = ['run-integrity', '-n', 'project8', '-b', 'db', '-A']
+        result = CliRunner().invoke(
+            load_cli(sqlbucket), arguments + ['-ar', '1', 'row_count=5']
+        )
+        assert result.exit_code == 3
+        result = CliRunner().invoke(
+            load_cli(sqlbucket), arguments + ['-ar', '2', 'row_count=3']
+        )
+        assert result.exit_code == 2
+
+
+class TestScheduledIntegrity(IntegrityProject):
+
+    order = ['a.sql', 'b.sql', 'c.sql', 'd.sql']
+    durations = {'a.sql': 3, 'c.sql': 1, 'd.sql': 2}
+
+    def test_cheapest_first(self):
+        assert schedule(self.order, self.durations) == [
+            'c.sql', 'd.sql', 'a.sql', 'b.sql'
+        ]
+
+    def test_longest_first(self):
+        assert schedule(self.order, self.durations, longest_first=True) == [
+            'b.sql', 'a.sql', 'd.sql', 'c.sql'
+        ]
+
+    def test_durations_recorded(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        project.run_integrity(scheduled=True)
+        assert set(project.state.check_durations('project8', 'db')) == {
+            'no_null_id.sql', 'row_count.sql', 'unique_id.sql'
+        }
+
+    def test_durations_not_recorded(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        project.run_integrity()
+        assert not (tmp_path / 'state').exists()
+
+    def test_batch_durations_recorded(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        project.run_integrity(batch=True, scheduled=True)
+        durations = project.state.check_durations('project8', 'db')
+        assert set(durations) == {
+            'no_null_id.sql', 'row_count.sql', 'unique_id.sql'
+        }
+        assert all(duration >= 0 for duration in durations.values())
+
+    def test_fail_fast(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        project.state.set_check_durations(
+            'project8', 'db', {'row_count.sql': 0.1, 'unique_id.sql': 0.2}
+        )
+        assert project.run_integrity(fail_fast=True, scheduled=True) == 1
+        # the cheapest check failed, the other ones did not run
+        durations = project.state.check_durations('project8', 'db')
+        assert durations['unique_id.sql'] == 0.2
+        assert 'no_null_id.sql' not in durations
+
+    def test_fail_fast_parallel(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(fail_fast=True, workers=2) == 1
+
+    def test_fail_fast_batch(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(
+            fail_fast=True, batch=True, workers=2, scheduled=True
+        ) == 1
+        assert 'no_null_id.sql' not in \
+            project.state.check_durations('project8', 'db')
+
+
+class TestParallelIntegrity(IntegrityProject):
+
+    def test_parallel_passed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=3)
+        assert project.run_integrity(workers=3) == 0
+
+    def test_parallel_failed(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(workers=3) == 1
+
+    def test_parallel_error_isolated(self, tmp_path):
+        project = self.load_project(tmp_path, row_count='missing_column')
+        assert project.run_integrity(workers=3) == 1
+
+    def test_parallel_with_batch(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        assert project.run_integrity(workers=3, batch=True) == 1
+
+
+class TestSpilledIntegrity(IntegrityProject):
+
+    def test_spill_folder(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        spill_folder = tmp_path / 'spill'
+        assert project.run_integrity(spill_folder=str(spill_folder)) == 1
+        assert [path.name for path in (spill_folder / 'db').iterdir()] == [
+            'row_count.sql.csv'
+        ]
+
+    def test_spill_folder_with_batch(self, tmp_path):
+        project = self.load_project(tmp_path, row_count=5)
+        spill_folder = tmp_path / 'spill'
+        assert project.run_integrity(
+            batch=True, spill_folder=str(spill_folder)
+        ) == 1
+        with open(spill_folder / 'db' / 'row_count.sql.csv', newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert [row['calculated'] for row in rows] == ['3']
+
+
+class TestIncrementalIntegrity:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def load_project(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        return sqlbucket.load_project(project_name='project9',
+                                      connection_name='db')
+
+    @staticmethod
+    def insert(project, rows):
+        connection = create_connection(project.configure_integrity())
+        for row in rows:
+            connection.execute(
+                text('insert into events values (:id, :day, :amount)'), row
+            )
+        connection.close()
+
+    def test_first_run_checks_all_rows(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        self.insert(project, [{'id': 1, 'day': '2024-01-01', 'amount': 1}])
+        assert project.run_integrity(incremental=True) == 1
+
+    def test_only_new_rows_checked(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        assert project.run_integrity(incremental=True) == 0
+
+        # duplicate of a row of an older partition, not checked again
+        self.insert(project, [{'id': 1, 'day': '2024-01-02', 'amount': 1}])
+        assert project.run_integrity(incremental=True) == 0
+
+        self.insert(project, [{'id': 3, 'day': '2024-01-03', 'amount': 1}])
+        assert project.run_integrity(incremental=True) == 0
+        assert project.run_integrity() == 1
+
+    def test_late_rows_of_watermark_partition_checked(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        assert project.run_integrity(incremental=True) == 0
+
+        self.insert(project, [
+            {'id': 2, 'day': '2024-01-02', 'amount': 1},
+            {'id': 3, 'day': '2024-01-03', 'amount': 1}
+        ])
+        assert project.run_integrity(incremental=True) == 1
+
+    def test_unchanged_checks_skipped(self, tmp_path, caplog):
+        caplog.set_level(logging.INFO)
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        assert project.run_integrity(incremental=True) == 0
+        caplog.clear()
+        assert project.run_integrity(incremental=True) == 0
+        assert 'ALL PASSED - (1/1), 2 skipped' in caplog.text
+
+    def test_watermark_not_moved_on_failure(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        assert project.run_integrity(incremental=True) == 0
+
+        self.insert(project, [
+            {'id': 3, 'day': '2024-01-03', 'amount': -1},
+            {'id': 3, 'day': '2024-01-03', 'amount': 1}
+        ])
+        assert project.run_integrity(incremental=True) == 2
+        self.insert(project, [{'id': 4, 'day': '2024-01-04', 'amount': 1}])
+        assert project.run_integrity(incremental=True) == 2
+        assert project.state.get_integrity_watermark(
+            'project9', 'db', 'unique_id.sql'
+        )[1] == '"2024-01-02"'
+
+    def test_incremental_batch(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        assert project.run_integrity(incremental=True, batch=True) == 0
+        self.insert(project, [{'id': 3, 'day': '2024-01-03', 'amount': -1}])
+        assert project.run_integrity(incremental=True, batch=True) == 1
+
@@ -0,0 +1,97 @@
+from sqlbucket.lineage import query_tables, LineageIndex
+from sqlbucket.exceptions import TableNotFound
+from sqlbucket.project import Project
+from pathlib import Path
+import pytest
+
+
+class TestQueryTables:
+
+    def test_insert_select(self):
+        assert query_tables(
+            'insert into schema.target select * from source s '
+            'join "Other".lookup l using (id)'
+        ) == ({'source', 'other.lookup'}, {'schema.target'})
+
+    def test_ctes_not_read(self):
+        assert query_tables(
+            'create table target as with x as (select * from source) '
+            'select * from x'
+        ) == ({'source'}, {'target'})
+
+    def test_delete(self):
+        assert query_tables(
+            'delete from target where id in (select id from source)'
+        ) == ({'source'}, {'target'})
+
+    def test_comments_and_strings(self):
+        assert query_tables(
+            "select 'from fake' from source -- join other\n/* from x */"
+        ) == ({'source'}, set())
+
+
+    def test_from_in_function_calls(self):
+        assert query_tables(
+            'insert into target select extract(day from created_at), '
+            'substring(name from 2), coalesce((select max(id) from ids), 0) '
+            'from events'
+        ) == ({'events', 'ids'}, {'target'})
+
+
+class TestLineageIndex:
+
+    configuration = {
+        "order": ["raw.sql", "summary.sql", "report.sql", "other.sql"],
+        "queries": {
+            "raw.sql": "insert into raw select * from source",
+            "summary.sql": "insert into summary select * from raw",
+            "report.sql": "insert into report select * from summary "
+                          "join dim using (id)",
+            "other.sql": "insert into other select * from dim",
+        }
+    }
+    lineage = LineageIndex(configuration)
+
+    def test_downstream(self):
+        assert self.lineage.select('raw+') == [
+            "raw.sql", "summary.sql", "report.sql"
+        ]
+
+    def test_downstream_of_source(self):
+        assert self.lineage.select('dim+') == ["report.sql", "other.sql"]
+
+    def test_upstream(self):
+        assert self.lineage.select('+summary') == ["raw.sql", "summary.sql"]
+
+    def test_both(self):
+        assert self.lineage.select('+summary+') == [
+            "raw.sql", "summary.sql", "report.sql"
+        ]
+
+    def test_many_selectors(self):
+        assert self.lineage.select('summary, other') == [
+            "summary.sql", "other.sql"
+        ]
+
+    def test_table_not_found(self):
+        with pytest.raises(TableNotFound):
+            self.lineage.select('unknown+')
+
+
+class TestProjectSelection:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects/project4')))
+    project = Project(
+        project_path=path,
+        connection_url='something://database',
+        context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+    )
+
+    def test_select(self):
+        configuration = self.project.configure()
+        assert self.project.select(configuration, 'table_a+') == [
+            "table_a.sql", "table_c.sql"
+        ]
+        assert self.project.select(configuration, '+table_c') == [
+            "table_a.sql", "table_b.sql", "table_c.sql"
+        ]
@@ -0,0 +1,129 @@
+from sqlbucket import SQLBucket
+from sqlbucket.metrics import RunMetrics, percentile, step_statistics
+from datetime import datetime
+from pathlib import Path
+import json
+import pytest
+
+
+class TestStatistics:
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        assert percentile(values, 50) == 3
+        assert percentile(values, 95) == 5
+        assert percentile([], 50) is None
+
+    def test_regression(self):
+        history = [('db', 'a.sql', 1.0)] * 4 + [('db', 'a.sql', 2.0)] + \
+                  [('db', 'b.sql', 1.0)] * 4 + [('db', 'b.sql', 1.2)]
+        statistics = {
+            item['step']: item for item in step_statistics(history)
+        }
+        assert statistics['a.sql']['regressed'] is True
+        assert statistics['a.sql']['runs'] == 5
+        assert statistics['a.sql']['last'] == 2.0
+        assert statistics['b.sql']['regressed'] is False
+
+    def test_no_regression_without_history(self):
+        history = [('db', 'a.sql', 1.0), ('db', 'a.sql', 10.0)]
+        assert step_statistics(history)[0]['regressed'] is False
+
+
+class TestRunMetrics:
+
+    def metrics(self):
+        metrics = RunMetrics(project='etl', connection='db')
+        metrics.record_connect(0.5)
+        metrics.record_step('a.sql', 'success', 0.1, 2.0, 10)
+        metrics.record_step('b.sql', 'skipped', 0.1)
+        metrics.finish('success')
+        return metrics
+
+    def test_jsonl(self, tmp_path):
+        path = tmp_path / 'metrics' / 'runs.jsonl'
+        self.metrics().write_jsonl(str(path))
+        self.metrics().write_jsonl(str(path))
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert len(records) == 2
+        assert records[0]['connect_seconds'] == 0.5
+        assert records[0]['steps'][0] == {
+            'step': 'a.sql', 'status': 'success', 'render_seconds': 0.1,
+            'execute_seconds': 2.0, 'rowcount': 10
+        }
+
+    def test_prometheus(self, tmp_path):
+        path = self.metrics().write_prometheus(str(tmp_path))
+        text = Path(path).read_text()
+        assert Path(path).name == 'sqlbucket_etl_db.prom'
+        assert '# TYPE sqlbucket_step_execute_seconds gauge' in text
+        assert 'sqlbucket_step_execute_seconds{project="etl",connection="db",' \
+               'group="",step="a.sql"} 2.0' in text
+        assert 'step="b.sql"} ' not in text.split('step_execute_seconds')[-1]
+        assert 'sqlbucket_run_success{project="etl",connection="db",' \
+               'group=""} 1' in text
+
+    def test_prometheus_per_group(self, tmp_path):
+        paths = set()
+        for group in ('hourly', 'daily'):
+            metrics = RunMetrics(project='etl', connection='db', group=group)
+            metrics.finish('success')
+            paths.add(Path(metrics.write_prometheus(str(tmp_path))).name)
+        assert paths == {'sqlbucket_etl_db_hourly.prom',
+                         'sqlbucket_etl_db_daily.prom'}
+
+
+class TestRunnerMetrics:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def load_project(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        return sqlbucket.load_project(project_name='project4',
+                                      connection_name='db')
+
+    def test_run_recorded(self, tmp_path):
+        project = self.load_project(tmp_path)
+        metrics_file = tmp_path / 'runs.jsonl'
+        project.run(silent=True, metrics_file=str(metrics_file),
+                    prometheus_folder=str(tmp_path / 'prometheus'))
+
+        record = json.loads(metrics_file.read_text())
+        assert record['status'] == 'success'
+        assert record['total_seconds'] >= record['connect_seconds'] > 0
+        assert [step['step'] for step in record['steps']] == [
+            'table_a.sql', 'table_b.sql', 'table_c.sql'
+        ]
+        assert all(step['render_seconds'] > 0 for step in record['steps'])
+        assert (tmp_path / 'prometheus' / 'sqlbucket_project4_db.prom').exists()
+        assert [step for _, step, _ in project.state.step_history(
+            'project4'
+        )] == ['table_a.sql', 'table_b.sql', 'table_c.sql']
+
+    def test_failed_run_recorded(self, tmp_path):
+        project = self.load_project(tmp_path)
+        project.run(silent=True)
+        metrics_file = tmp_path / 'runs.jsonl'
+        with pytest.raises(Exception):
+            project.run(silent=True, metrics_file=str(metrics_file))
+
+        record = json.loads(metrics_file.read_text())
+        assert record['status'] == 'failed'
+        assert record['steps'][0]['status'] == 'failed'
+
+    def test_retention(self, tmp_path):
+        project = self.load_project(tmp_path)
+        for started_at in range(5):
+            record = RunMetrics(project='project4', connection='db')
+            record.started_at = datetime(2020, 1, 1 + started_at)
+            record.record_step('table_a.sql', 'success', 0.1, started_at, 1)
+            project.state.record_run_metrics(record.to_record(), retention=3)
+        assert project.state.step_history('project4') == [
+            ('db', 'table_a.sql', 2.0), ('db', 'table_a.sql', 3.0),
+            ('db', 'table_a.sql', 4.0)
+        ]
@@ -0,0 +1,103 @@
+from sqlbucket import SQLBucket
+from sqlbucket.cli import load_cli
+from sqlbucket.profiling import profiled, profile_thread, template_statistics
+from click.testing import CliRunner
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import Environment, FileSystemLoader
+from pathlib import Path
+import logging
+import pstats
+
+
+def slow_function(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiled:
+
+    def render(self, folder):
+        for name, source in {
+            'macros.jinja2': '{% macro square(i) %}{{ i * i }}{% endmacro %}',
+            'heavy.sql': "{% from 'macros.jinja2' import square %}"
+                         "{% for i in range(2000) %}{{ square(i) }}"
+                         "{% endfor %}",
+            'light.sql': 'select 1',
+        }.items():
+            (folder / name).write_text(source)
+        env = Environment(loader=FileSystemLoader(str(folder)))
+        env.get_template('heavy.sql').render()
+        env.get_template('light.sql').render()
+
+    def test_pstats_file(self, tmp_path):
+        path = tmp_path / 'profile' / 'run.pstats'
+        with profiled(str(path)):
+            slow_function(1000)
+        functions = [function for _, _, function in
+                     pstats.Stats(str(path)).stats]
+        assert 'slow_function' in functions
+
+    def test_no_profile(self, tmp_path):
+        with profiled(None) as session:
+            assert session is None
+            assert profile_thread(slow_function) is slow_function
+
+    def test_per_template(self, tmp_path):
+        path = tmp_path / 'run.pstats'
+        with profiled(str(path)):
+            self.render(tmp_path)
+
+        templates = template_statistics(pstats.Stats(str(path)))
+        names = [Path(item['template']).name for item in templates]
+        assert names == ['heavy.sql', 'macros.jinja2', 'light.sql']
+        heavy = templates[0]
+        assert heavy['total_seconds'] >= heavy['own_seconds'] > 0
+        assert templates[1]['own_seconds'] > 0
+
+    def test_threads(self, tmp_path):
+        path = tmp_path / 'run.pstats'
+        with profiled(str(path)):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                executor.submit(profile_thread(slow_function), 1000).result()
+        functions = [function for _, _, function in
+                     pstats.Stats(str(path)).stats]
+        assert 'slow_function' in functions
+
+
+class TestProfileCli:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def sqlbucket(self, tmp_path):
+        return SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+
+    def test_run_job(self, tmp_path, caplog):
+        caplog.set_level(logging.INFO)
+        path = tmp_path / 'run_job.pstats'
+        result = CliRunner().invoke(
+            load_cli(self.sqlbucket(tmp_path)),
+            ['run-job', '-n', 'project4', '-b', 'db', '-s', '-w', '2',
+             '--profile', str(path), '--profile-top', '5']
+        )
+        assert result.exit_code == 0
+        assert path.exists()
+        assert 'Time spent per template' in caplog.text
+        assert 'table_a.sql' in caplog.text
+
+    def test_failed_integrity(self, tmp_path):
+        sqlbucket = self.sqlbucket(tmp_path)
+        sqlbucket.load_project(
+            project_name='project8', connection_name='db'
+        ).run(silent=True)
+        path = tmp_path / 'integrity.pstats'
+        result = CliRunner().invoke(
+            load_cli(sqlbucket),
+            ['run-integrity', '-n', 'project8', '-b', 'db', '-P', '2',
+             '--profile', str(path), 'row_count=5']
+        )
+        assert result.exit_code == 3
+        assert path.exists()
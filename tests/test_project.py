@@ -1,4 +1,4 @@
-from sqlbucket.project import Project
+from sqlbucket.project import Project, load_project_config
 from sqlbucket.exceptions import GroupNotFound, OrderNotInRightFormat
 from pathlib import Path
 import pytest
@@ -217,3 +217,45 @@ class TestConnectScript:
         assert self.integrity_configuration['connection_query'] == self.expected_query
 
 
+
+
+class TestLazyConfiguration:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects/project1')))
+
+    def test_configuration_memoized(self):
+        project = Project(
+            project_path=self.path,
+            connection_url='something://database',
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+        )
+        assert project.configure() is project.configure()
+
+    def test_render_only_selected_steps(self):
+        project = Project(
+            project_path=self.path,
+            connection_url='something://database',
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+        )
+        project.render(from_step=2, to_step=2)
+        queries = project.configure()["queries"]
+        assert list(queries.rendered) == ["query_two.sql"]
+
+
+class TestProjectConfigCache:
+
+    def test_config_parsed_once(self):
+        path = Path(__file__).parent / Path('fixtures/projects/project1')
+        config_path = (path / 'config.yaml').resolve()
+        assert load_project_config(config_path) is \
+               load_project_config(config_path)
+
+    def test_config_modified(self, tmp_path):
+        config_path = tmp_path / 'config.yaml'
+        config_path.write_text('order:\n  - query_one.sql\n')
+        assert load_project_config(config_path)["order"] == ["query_one.sql"]
+
+        config_path.write_text('order:\n  - query_one.sql\n  - query_two.sql\n')
+        assert load_project_config(config_path)["order"] == [
+            "query_one.sql", "query_two.sql"
+        ]
@@ -1,5 +1,15 @@
-from sqlbucket.runners import ProjectRunner
+from sqlbucket.runners import ProjectRunner, dependency_graph, \
+    get_engine, dispose_engines, create_connection, connection_query, \
+    begin_transaction
+from sqlbucket.exceptions import CircularDependency, DependencyNotFound
+from sqlbucket.project import Project
+from sqlbucket import SQLBucket
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.pool import QueuePool
+from pathlib import Path
 import pytest
+import time
 
 
 class TestRunnerProject:
@@ -41,3 +51,456 @@ class TestRunnerProject:
                           from_step=4,
                           to_step=2)
 
+
+class TestDependencyGraph:
+
+    order = ["1.sql", "2.sql", "3.sql"]
+
+    def test_sequential_without_dependencies(self):
+        assert dependency_graph(self.order) == {
+            "1.sql": set(), "2.sql": {"1.sql"}, "3.sql": {"2.sql"}
+        }
+
+    def test_declared_dependencies(self):
+        graph = dependency_graph(
+            self.order, dependencies={"3.sql": ["1.sql", "2.sql"]}
+        )
+        assert graph == {"1.sql": set(), "2.sql": set(),
+                         "3.sql": {"1.sql", "2.sql"}}
+
+    def test_dependencies_out_of_order_ignored(self):
+        graph = dependency_graph(
+            ["3.sql"], dependencies={"3.sql": ["1.sql", "2.sql"]},
+            steps=self.order
+        )
+        assert graph == {"3.sql": set()}
+
+    def test_unknown_dependency(self):
+        with pytest.raises(DependencyNotFound):
+            dependency_graph(
+                self.order, dependencies={"3.sql": ["1.sql", "2.sq"]}
+            )
+        with pytest.raises(DependencyNotFound):
+            dependency_graph(
+                ["3.sql"], dependencies={"3.sql": ["4.sql"]},
+                steps=self.order
+            )
+
+    def test_circular_dependencies(self):
+        with pytest.raises(CircularDependency):
+            dependency_graph(
+                self.order,
+                dependencies={"1.sql": ["3.sql"], "3.sql": ["1.sql"]}
+            )
+
+
+class TestParallelRunner:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects/project4')))
+
+    def test_run_parallel(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        project = Project(
+            project_path=self.path,
+            connection_url=url,
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+        )
+        project.run(workers=2, silent=True)
+
+        engine = create_engine(url)
+        rows = engine.execute('select id from table_c').fetchall()
+        assert [tuple(row) for row in rows] == [(1,)]
+
+    def test_dependencies_waited_for(self, tmp_path, monkeypatch):
+        project = Project(
+            project_path=self.path,
+            connection_url=f'sqlite:///{tmp_path / "db.sqlite"}',
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+        )
+        run_step = ProjectRunner.run_step
+        events = list()
+
+        def slow_step(runner, connection, i, query):
+            events.append(('start', query))
+            if query != 'table_c.sql':
+                time.sleep(0.1)
+            run_step(runner, connection, i, query)
+            events.append(('end', query))
+
+        monkeypatch.setattr(ProjectRunner, 'run_step', slow_step)
+        project.run(workers=3, silent=True)
+
+        # table_a and table_b run concurrently, table_c waits for both
+        assert events.index(('start', 'table_b.sql')) < \
+            events.index(('end', 'table_a.sql'))
+        assert events.index(('start', 'table_c.sql')) > max(
+            events.index(('end', 'table_a.sql')),
+            events.index(('end', 'table_b.sql'))
+        )
+
+    def test_run_parallel_from_step(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        project = Project(
+            project_path=self.path,
+            connection_url=url,
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}}
+        )
+        project.run(workers=2, to_step=2, silent=True)
+
+        engine = create_engine(url)
+        tables = engine.table_names()
+        assert tables == ['table_a', 'table_b']
+
+
+class TestEngineRegistry:
+
+    def teardown_method(self):
+        dispose_engines()
+
+    def test_same_engine(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        assert get_engine(url) is get_engine(url)
+
+    def test_engine_per_isolation_level(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        assert get_engine(url) is not get_engine(url, 'SERIALIZABLE')
+
+    def test_engine_pool_options(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        engine = get_engine(url, pool_options={'poolclass': QueuePool})
+        assert isinstance(engine.pool, QueuePool)
+        assert engine is not get_engine(url)
+
+    def test_connection_query_once_per_pooled_connection(self, tmp_path):
+        configuration = {
+            'connection_url': f'sqlite:///{tmp_path / "db.sqlite"}',
+            'connection_query': 'create table once as select 1 as id',
+            'pool_options': {'poolclass': QueuePool}
+        }
+        create_connection(configuration).close()
+        # would fail with "table once already exists" if run again
+        create_connection(configuration).close()
+
+    def test_connection_query_not_inherited(self, tmp_path):
+        configuration = {
+            'connection_url': f'sqlite:///{tmp_path / "db.sqlite"}',
+            'connection_query': 'create temp table session as select 1 as id',
+            'pool_options': {'poolclass': QueuePool}
+        }
+        connection = create_connection(configuration)
+        connection.close()
+
+        # another project, without connection query, on the same pool
+        connection = create_connection(
+            dict(configuration, connection_query=None)
+        )
+        with pytest.raises(OperationalError):
+            connection.execute('select id from session')
+        connection.close()
+
+    def test_connection_query_forced(self, tmp_path):
+        configuration = {
+            'connection_url': f'sqlite:///{tmp_path / "db.sqlite"}',
+            'connection_query': 'create temp table if not exists session '
+                                'as select 1 as id',
+            'pool_options': {'poolclass': QueuePool}
+        }
+        connection = create_connection(configuration)
+        connection.execute('drop table session')
+        connection_query(configuration, connection)
+        with pytest.raises(OperationalError):
+            connection.execute('select id from session')
+        connection_query(configuration, connection, force=True)
+        assert connection.execute('select id from session').scalar() == 1
+        connection.close()
+
+    def test_pool_sized_from_concurrency(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        options = {'poolclass': QueuePool}
+        engine = get_engine(url, pool_options=options, concurrency=8)
+        assert engine.pool.size() == 8
+        assert get_engine(url, pool_options=options, concurrency=2) is engine
+        larger = get_engine(url, pool_options=options, concurrency=12)
+        assert larger.pool.size() == 12
+        assert get_engine(url, pool_options=options) is larger
+
+        # an explicit pool size is kept
+        options = {'poolclass': QueuePool, 'pool_size': 2}
+        engine = get_engine(url, pool_options=options, concurrency=8)
+        assert engine.pool.size() == 2
+        assert get_engine(url, pool_options=options, concurrency=8) is engine
+
+
+class TestResumeRunner:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_resume_failed_run(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': url},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project6', connection_name='db'
+        )
+        with pytest.raises(OperationalError):
+            project.run(resume=True, silent=True)
+
+        run_key = ProjectRunner(
+            configuration=project.configure(), state=sqlbucket.state
+        ).run_key()
+        assert list(sqlbucket.state.completed_steps(run_key)) == [
+            'create_a.sql'
+        ]
+
+        engine = create_engine(url)
+        engine.execute('create table b (id integer)')
+
+        # would fail on "table a already exists" if not skipped
+        project.run(resume=True, silent=True)
+        assert engine.execute('select count(1) from b').scalar() == 1
+        assert sqlbucket.state.completed_steps(run_key) == dict()
+
+    def test_completed_run_without_resume(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': url},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project6', connection_name='db'
+        )
+        with pytest.raises(OperationalError):
+            project.run(resume=True, silent=True)
+
+        engine = create_engine(url)
+        engine.execute('drop table a')
+        engine.execute('create table b (id integer)')
+        project.run(silent=True)
+        run_key = ProjectRunner(
+            configuration=project.configure(), state=sqlbucket.state
+        ).run_key()
+        assert sqlbucket.state.completed_steps(run_key) == dict()
+
+        # create_a runs again, insert_b would fail without table a
+        engine.execute('drop table a')
+        project.run(resume=True, silent=True)
+        assert engine.execute('select count(1) from b').scalar() == 2
+
+    def test_state_only_used_when_asked(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project4', connection_name='db'
+        )
+        project.run(silent=True)
+        assert not (tmp_path / 'state').exists()
+
+    def test_run_variables(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            connection_variables={'db': {'password': 'secret'}},
+            environment_variables={'token': 'secret'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project6', connection_name='db',
+            variables={'from': '2019-11-01', 'to': '2019-11-02', 'foo': 1}
+        )
+        runner = ProjectRunner(
+            configuration=project.configure(), resume_exclude=['to']
+        )
+        assert runner.run_variables() == {'from': '2019-11-01', 'foo': 1}
+
+
+class TestIncrementalRunner:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_skip_unchanged_steps(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "db.sqlite"}'
+        engine = create_engine(url)
+        engine.execute('create table source (id integer)')
+        engine.execute('create table snapshot (n integer)')
+        engine.execute('insert into source values (1)')
+
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': url},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project7', connection_name='db'
+        )
+        project.run(incremental=True, silent=True)
+        project.run(incremental=True, silent=True)
+        assert engine.execute('select count(1) from snapshot').scalar() == 1
+
+        engine.execute('insert into source values (2)')
+        project.run(incremental=True, silent=True)
+        assert engine.execute('select count(1) from snapshot').scalar() == 2
+
+        # without incremental mode, steps always run
+        project.run(silent=True)
+        assert engine.execute('select count(1) from snapshot').scalar() == 3
+
+
+class TestTransactionRunner:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def load_project(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project6', connection_name='db'
+        )
+        return sqlbucket, project
+
+    def test_rolled_back_on_failure(self, tmp_path):
+        sqlbucket, project = self.load_project(tmp_path)
+        with pytest.raises(OperationalError):
+            project.run(transaction=True, silent=True)
+
+        # table a was created by the first step, then rolled back
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        assert engine.table_names() == []
+        run_key = ProjectRunner(
+            configuration=project.configure(), state=sqlbucket.state
+        ).run_key()
+        assert sqlbucket.state.completed_steps(run_key) == dict()
+
+    def test_state_only_used_when_asked(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project4', connection_name='db'
+        )
+        project.run(silent=True)
+        assert not (tmp_path / 'state').exists()
+
+    def test_run_variables(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            connection_variables={'db': {'password': 'secret'}},
+            environment_variables={'token': 'secret'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='project6', connection_name='db',
+            variables={'from': '2019-11-01', 'to': '2019-11-02', 'foo': 1}
+        )
+        runner = ProjectRunner(
+            configuration=project.configure(), resume_exclude=['to']
+        )
+        assert runner.run_variables() == {'from': '2019-11-01', 'foo': 1}
+
+    def test_committed(self, tmp_path):
+        _, project = self.load_project(tmp_path)
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        engine.execute('create table b (id integer)')
+        project.run(transaction=True, silent=True)
+        assert engine.execute('select count(1) from b').scalar() == 1
+
+    def test_retry_from_savepoint(self, tmp_path, monkeypatch):
+        _, project = self.load_project(tmp_path)
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        engine.execute('create table b (id integer)')
+
+        run_step = ProjectRunner.run_step
+        failures = list()
+
+        def failing_once(runner, connection, i, query):
+            if query == 'insert_b.sql' and not failures:
+                failures.append(query)
+                connection.execute('insert into a values (2)')
+                raise OperationalError('insert', None, Exception('locked'))
+            run_step(runner, connection, i, query)
+
+        monkeypatch.setattr(ProjectRunner, 'run_step', failing_once)
+        project.run(transaction=True, savepoints=True, retries=1, silent=True)
+
+        # the failed attempt was rolled back, the first step was not run again
+        assert failures == ['insert_b.sql']
+        assert engine.execute('select id from a').fetchall() == [(1,)]
+        assert engine.execute('select count(1) from b').scalar() == 1
+
+    def test_error_not_retried(self, tmp_path, monkeypatch):
+        _, project = self.load_project(tmp_path)
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        engine.execute('create table b (id integer)')
+        failures = list()
+
+        def failing(runner, connection, i, query):
+            failures.append(query)
+            raise ProgrammingError('insert', None, Exception('syntax'))
+
+        monkeypatch.setattr(ProjectRunner, 'run_step', failing)
+        with pytest.raises(ProgrammingError):
+            project.run(transaction=True, savepoints=True, retries=2,
+                        silent=True)
+        assert failures == ['create_a.sql']
+
+    def test_lost_connection_not_retried(self, tmp_path, monkeypatch):
+        _, project = self.load_project(tmp_path)
+        run_step = ProjectRunner.run_step
+        failures = list()
+
+        def losing_connection(runner, connection, i, query):
+            if query == 'insert_b.sql':
+                failures.append(query)
+                connection.invalidate()
+                raise OperationalError('insert', None, Exception('gone'),
+                                       connection_invalidated=True)
+            run_step(runner, connection, i, query)
+
+        monkeypatch.setattr(ProjectRunner, 'run_step', losing_connection)
+        with pytest.raises(OperationalError, match='gone'):
+            project.run(transaction=True, savepoints=True, retries=2,
+                        silent=True)
+        assert failures == ['insert_b.sql']
+
+    def test_driver_restored(self, tmp_path):
+        engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite"}')
+        with engine.connect() as connection:
+            dbapi_connection = connection.connection.dbapi_connection
+            isolation_level = dbapi_connection.isolation_level
+            with begin_transaction(connection) as transaction:
+                assert dbapi_connection.isolation_level is None
+                connection.execute('create table a (id integer)')
+                transaction.commit()
+            assert dbapi_connection.isolation_level == isolation_level
+
+    def test_invalid_options(self):
+        configuration = {"order": ["1.sql"]}
+        with pytest.raises(ValueError):
+            ProjectRunner(configuration, transaction=True, workers=2)
+        with pytest.raises(ValueError):
+            ProjectRunner(configuration, transaction=True,
+                          isolation_level='AUTOCOMMIT')
+        with pytest.raises(ValueError):
+            ProjectRunner(configuration, savepoints=True)
+        with pytest.raises(ValueError):
+            ProjectRunner(configuration, transaction=True, retries=1)
@@ -1,6 +1,7 @@
-from sqlbucket import SQLBucket, Project
+from sqlbucket import SQLBucket, Project, CompiledProject
 from sqlbucket.exceptions import ProjectNotFound, ConnectionNotFound
 from pathlib import Path
+from jinja2 import TemplateSyntaxError
 import pytest
 import yaml
 import os
@@ -70,3 +71,69 @@ class TestConnections:
     def test_get_connection(self):
         assert self.sqlbucket.connections['database_1'] == 'psycopg2://database'
 
+
+class TestLoadProjects:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+    sqlbucket = SQLBucket(
+        projects_folder=path,
+        connections={'db': 'db_url', 'db_name': 'db_name_url'},
+        env_name='dev'
+    )
+
+    def test_load_projects(self):
+        projects = self.sqlbucket.load_projects(
+            project_name='project1',
+            connection_names=['db', 'db_name']
+        )
+        assert [p.connection_name for p in projects] == ['db', 'db_name']
+        assert [p.connection_url for p in projects] == ['db_url', 'db_name_url']
+        assert projects[0].project_config is projects[1].project_config
+
+    def test_connection_variables_per_binding(self):
+        compiled = self.sqlbucket.compile_project(
+            project_name='project1', variables={'foo': 'submitted'}
+        )
+        assert isinstance(compiled, CompiledProject)
+
+        project_db = self.sqlbucket.bind_project(compiled, 'db')
+        project_db_name = self.sqlbucket.bind_project(compiled, 'db_name')
+        assert project_db.context['c'] == {'name': 'db', 'foo': 'bar'}
+        assert project_db_name.context['c'] == {
+            'name': 'db_name', 'foo': 'barbar'
+        }
+
+    def test_bind_unknown_connection(self):
+        compiled = self.sqlbucket.compile_project(project_name='project1')
+        with pytest.raises(ConnectionNotFound):
+            self.sqlbucket.bind_project(compiled, 'wrong_db_name')
+
+    def test_templates_compiled_when_needed(self, tmp_path):
+        project_path = tmp_path / 'projects' / 'broken'
+        (project_path / 'queries').mkdir(parents=True)
+        (project_path / 'integrity').mkdir()
+        (project_path / 'config.yaml').write_text(
+            'order:\n  main:\n    - good.sql\n  other:\n    - broken.sql\n'
+        )
+        (project_path / 'queries' / 'good.sql').write_text(
+            'create table good as select 1 as id'
+        )
+        (project_path / 'queries' / 'broken.sql').write_text('{% if %}')
+        (project_path / 'integrity' / 'broken.sql').write_text('{{ }}')
+
+        sqlbucket = SQLBucket(
+            projects_folder=str(tmp_path / 'projects'),
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            state_folder=str(tmp_path / 'state')
+        )
+        project = sqlbucket.load_project(
+            project_name='broken', connection_name='db'
+        )
+        project.run(group='main', silent=True)
+
+        compiled = sqlbucket.compile_project(project_name='broken')
+        compiled.compile(group='main')
+        with pytest.raises(TemplateSyntaxError):
+            compiled.compile(group='other')
+        with pytest.raises(TemplateSyntaxError):
+            compiled.compile(group='main', integrity=True)
@@ -0,0 +1,143 @@
+from sqlbucket import SQLBucket
+from sqlbucket.project import Project
+from sqlbucket.templating import get_jinja_env, clear_jinja_envs, \
+    template_variables
+from pathlib import Path
+import os
+
+
+class TestSharedEnvironment:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects/project1')))
+
+    def teardown_method(self):
+        clear_jinja_envs()
+
+    def test_same_environment(self):
+        assert get_jinja_env(self.path) is get_jinja_env(self.path)
+
+    def test_environment_shared_between_projects(self):
+        projects = [
+            Project(
+                project_path=self.path,
+                connection_url='something://database',
+                context={'c': {'name': name}, 'e': {'name': 'dev'}}
+            )
+            for name in ('db_1', 'db_2')
+        ]
+        assert projects[0].create_jinja_env('queries') is \
+               projects[1].create_jinja_env('queries')
+
+    def test_environment_per_globals(self):
+        approximate = get_jinja_env(
+            self.path, env_globals={'approximate': {'rate': 0.1}}
+        )
+        assert approximate is not get_jinja_env(self.path)
+        assert approximate is get_jinja_env(
+            self.path, env_globals={'approximate': {'rate': 0.1}}
+        )
+        assert approximate.globals['approximate'] == {'rate': 0.1}
+        assert 'approximate' not in get_jinja_env(self.path).globals
+
+    def test_bytecode_cache_on_disk(self, tmp_path):
+        project = Project(
+            project_path=self.path,
+            connection_url='something://database',
+            context={'c': {'name': 'db'}, 'e': {'name': 'dev'}},
+            bytecode_cache_path=str(tmp_path)
+        )
+        assert project.configure()["queries"]["query_one.sql"] == "bar"
+        assert len(os.listdir(tmp_path)) == 1
+
+
+class TestRenderCache:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def test_template_variables(self):
+        jinja_env = get_jinja_env(
+            str(Path(self.path) / 'project2' / 'queries')
+        )
+        paths, _ = template_variables(jinja_env, 'connect_query.sql')
+        assert paths == {('c', 'destination_schema'), ('c', 'source_schema')}
+
+    def test_render_once_for_all_connections(self):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': 'db_url', 'db_name': 'db_url'},
+            env_name='dev',
+            render_cache=True
+        )
+        projects = sqlbucket.load_projects(
+            project_name='project1', connection_names=['db', 'db_name']
+        )
+        for project in projects:
+            assert dict(project.configure()["queries"]) == {
+                "query_one.sql": "bar",
+                "query_two.sql": "foobar",
+                "folder1/query_three.sql": "bar"
+            }
+        assert sqlbucket.render_cache.misses == 3
+        assert sqlbucket.render_cache.hits == 3
+
+    def test_render_per_connection_variables(self):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db_1': 'db_url', 'db_2': 'db_url'},
+            connection_variables={
+                'db_1': {'destination_schema': 'a', 'source_schema': 'b'},
+                'db_2': {'destination_schema': 'c', 'source_schema': 'b'},
+            },
+            env_name='dev',
+            render_cache=True
+        )
+        projects = sqlbucket.load_projects(
+            project_name='project2', connection_names=['db_1', 'db_2']
+        )
+        assert [p.get_connection_query() for p in projects] == [
+            'set search_path to a, b;', 'set search_path to c, b;'
+        ]
+        assert sqlbucket.render_cache.misses == 2
+
+    def test_render_cache_on_disk(self, tmp_path):
+        sqlbucket = SQLBucket(
+            projects_folder=self.path,
+            connections={'db': 'db_url'},
+            env_name='dev',
+            render_cache_folder=str(tmp_path)
+        )
+        project = sqlbucket.load_project(
+            project_name='project1', connection_name='db'
+        )
+        assert project.configure()["queries"]["query_one.sql"] == "bar"
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_render_per_connection_method_call(self, tmp_path):
+        queries = tmp_path / 'projects' / 'methods' / 'queries'
+        queries.mkdir(parents=True)
+        (queries.parent / 'config.yaml').write_text(
+            'order:\n  - schema.sql\n'
+        )
+        (queries / 'schema.sql').write_text(
+            "select * from {{ c.get('schema') }}.t_{{ e.get('name') }}"
+        )
+        paths, _ = template_variables(get_jinja_env(str(queries)),
+                                      'schema.sql')
+        assert paths == {('c',), ('e',)}
+
+        sqlbucket = SQLBucket(
+            projects_folder=str(tmp_path / 'projects'),
+            connections={'db_1': 'db_url', 'db_2': 'db_url'},
+            connection_variables={
+                'db_1': {'schema': 'sa'}, 'db_2': {'schema': 'sb'}
+            },
+            env_name='dev',
+            render_cache=True
+        )
+        projects = sqlbucket.load_projects(
+            project_name='methods', connection_names=['db_1', 'db_2']
+        )
+        assert [p.configure()["queries"]["schema.sql"] for p in projects] == [
+            'select * from sa.t_dev', 'select * from sb.t_dev'
+        ]
+        assert sqlbucket.render_cache.misses == 2
@@ -0,0 +1,213 @@
+from sqlbucket import SQLBucket
+from sqlbucket.cli import load_cli
+from sqlbucket.tracing import InMemoryExporter, OTLPJsonExporter, SpanHook, \
+    span, register_hook, unregister_hook, current_span, in_current_context
+from click.testing import CliRunner
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+import pytest
+
+
+@pytest.fixture
+def exporter():
+    exporter = register_hook(InMemoryExporter())
+    yield exporter
+    unregister_hook(exporter)
+
+
+class TestSpans:
+
+    def test_nesting(self, exporter):
+        with span('parent', {'key': 'value'}) as parent:
+            with span('child') as child:
+                assert current_span() is child
+            assert current_span() is parent
+        assert current_span() is None
+
+        assert exporter.names() == ['child', 'parent']
+        assert child.parent_id == parent.span_id
+        assert child.trace_id == parent.trace_id
+        assert parent.parent_id is None
+        assert parent.attributes == {'key': 'value'}
+        assert parent.duration >= child.duration >= 0
+
+    def test_error_recorded(self, exporter):
+        with pytest.raises(ValueError):
+            with span('failing'):
+                raise ValueError('boom')
+        assert exporter.spans[0].error == 'ValueError: boom'
+
+    def test_thread_propagation(self, exporter):
+        def child():
+            with span('child') as child_span:
+                return child_span
+
+        with span('parent') as parent:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                propagated = [
+                    executor.submit(in_current_context(child)).result()
+                    for _ in range(2)
+                ]
+                orphan = executor.submit(child).result()
+
+        assert all(item.parent_id == parent.span_id for item in propagated)
+        assert orphan.parent_id is None
+        assert orphan.trace_id != parent.trace_id
+
+    def test_unregistered_hook(self, exporter):
+        unregister_hook(exporter)
+        with span('ignored'):
+            pass
+        assert exporter.spans == []
+
+    def test_failing_hook(self, exporter, caplog):
+        class FailingHook(SpanHook):
+            def on_end(self, span):
+                raise RuntimeError('tracer down')
+
+        hook = register_hook(FailingHook())
+        try:
+            with pytest.raises(ValueError):
+                with span('failing'):
+                    raise ValueError('boom')
+            with span('passing'):
+                pass
+        finally:
+            unregister_hook(hook)
+        assert exporter.names() == ['failing', 'passing']
+        assert 'FailingHook.on_end failed on span passing: tracer down' in \
+            caplog.text
+
+
+class TestOTLPJsonExporter:
+
+    def test_export_on_root_end(self, tmp_path):
+        path = tmp_path / 'traces' / 'spans.jsonl'
+        exporter = register_hook(OTLPJsonExporter(path=str(path)))
+        try:
+            with span('run', {'sqlbucket.workers': 2}):
+                with span('step'):
+                    assert not path.exists()
+                with pytest.raises(KeyError):
+                    with span('failing'):
+                        raise KeyError('a')
+        finally:
+            unregister_hook(exporter)
+
+        exporter.flush()
+        [payload] = [json.loads(line) for line in path.read_text().splitlines()]
+        resource_spans = payload['resourceSpans'][0]
+        assert resource_spans['resource']['attributes'] == [
+            {'key': 'service.name', 'value': {'stringValue': 'sqlbucket'}}
+        ]
+        spans = {
+            item['name']: item
+            for item in resource_spans['scopeSpans'][0]['spans']
+        }
+        assert set(spans) == {'run', 'step', 'failing'}
+        assert spans['step']['parentSpanId'] == spans['run']['spanId']
+        assert 'parentSpanId' not in spans['run']
+        assert spans['run']['attributes'] == [
+            {'key': 'sqlbucket.workers', 'value': {'intValue': '2'}}
+        ]
+        assert spans['failing']['status']['code'] == 2
+        assert spans['step']['status'] == {'code': 1}
+
+    def test_collector_down(self, tmp_path, caplog):
+        # nothing listens on port 9 (discard)
+        exporter = register_hook(OTLPJsonExporter(
+            endpoint='http://127.0.0.1:9/v1/traces', timeout=1
+        ))
+        try:
+            with span('run'):
+                pass
+        finally:
+            unregister_hook(exporter)
+        exporter.flush()
+        assert 'Traces could not be exported' in caplog.text
+
+    def test_destination_required(self):
+        with pytest.raises(ValueError):
+            OTLPJsonExporter()
+
+
+class TestRunnerTracing:
+
+    path = str((Path(__file__).parent / Path('fixtures/projects')))
+
+    def sqlbucket(self, tmp_path):
+        return SQLBucket(
+            projects_folder=self.path,
+            connections={'db': f'sqlite:///{tmp_path / "db.sqlite"}'},
+            env_name='dev',
+            state_folder=str(tmp_path / 'state')
+        )
+
+    def test_run_spans(self, tmp_path, exporter):
+        project = self.sqlbucket(tmp_path).load_project(
+            project_name='project4', connection_name='db'
+        )
+        project.run(silent=True, workers=2)
+
+        spans = {item.span_id: item for item in exporter.spans}
+        [run] = [item for item in exporter.spans if item.name == 'run']
+        steps = [item for item in exporter.spans if item.name == 'step']
+        assert sorted(item.attributes['sqlbucket.step'] for item in steps) == [
+            'table_a.sql', 'table_b.sql', 'table_c.sql'
+        ]
+        assert all(item.parent_id == run.span_id for item in steps)
+        assert 'connect' in exporter.names()
+
+        # the run is a single trace, configuring it included
+        [configure] = [
+            item for item in exporter.spans if item.name == 'configure'
+        ]
+        assert configure.parent_id == run.span_id
+        [load_project] = [
+            item for item in exporter.spans if item.parent is None
+            and item.name == 'load_project'
+        ]
+        assert {item.trace_id for item in exporter.spans} == {
+            run.trace_id, load_project.trace_id
+        }
+        assert run.attributes['sqlbucket.group'] is None
+        assert run.attributes['sqlbucket.workers'] == 2
+
+        # renders are children of the step they are rendered for
+        renders = [item for item in exporter.spans if item.name == 'render']
+        assert renders
+        assert all(spans[item.parent_id].name == 'step' for item in renders)
+
+    def test_command_trace(self, tmp_path, exporter):
+        result = CliRunner().invoke(
+            load_cli(self.sqlbucket(tmp_path)),
+            ['run-job', '-n', 'project4', '-b', 'db', '-s', '-w', '2']
+        )
+        assert result.exit_code == 0
+        [command] = [item for item in exporter.spans if item.parent is None]
+        assert command.name == 'command'
+        assert command.attributes == {'sqlbucket.command': 'run-job'}
+        assert {item.trace_id for item in exporter.spans} == {
+            command.trace_id
+        }
+        assert {'load_project', 'run', 'step'} <= set(exporter.names())
+
+    def test_integrity_spans(self, tmp_path, exporter):
+        project = self.sqlbucket(tmp_path).load_project(
+            project_name='project8', connection_name='db',
+            variables={'row_count': 3}
+        )
+        project.run(silent=True)
+        exporter.clear()
+        project.run_integrity(workers=2)
+
+        [integrity] = [
+            item for item in exporter.spans if item.name == 'integrity'
+        ]
+        checks = [
+            item for item in exporter.spans if item.name == 'integrity_check'
+        ]
+        assert checks
+        assert all(item.parent_id == integrity.span_id for item in checks)
+        assert integrity.attributes['sqlbucket.errors'] == 0
@@ -0,0 +1,46 @@
+from sqlbucket.tracing import in_current_context
+from sqlbucket.utils import date_partitions, log_prefix, logger
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import pytest
+
+
+class TestDatePartitions:
+
+    def test_day(self):
+        assert date_partitions('2019-11-01', '2019-11-03', 'day') == [
+            ('2019-11-01', '2019-11-02'),
+            ('2019-11-02', '2019-11-03'),
+        ]
+
+    def test_week(self):
+        assert date_partitions('2019-01-01', '2019-01-10', 'week') == [
+            ('2019-01-01', '2019-01-08'),
+            ('2019-01-08', '2019-01-10'),
+        ]
+
+    def test_month(self):
+        assert date_partitions('2019-01-15', '2019-03-02', 'month') == [
+            ('2019-01-15', '2019-02-01'),
+            ('2019-02-01', '2019-03-01'),
+            ('2019-03-01', '2019-03-02'),
+        ]
+
+    def test_wrong_range(self):
+        with pytest.raises(ValueError):
+            date_partitions('2019-11-03', '2019-11-01', 'day')
+
+
+class TestLogPrefix:
+
+    def test_prefix_in_worker_threads(self, caplog):
+        caplog.set_level(logging.INFO)
+        with log_prefix('db_1'):
+            logger.info('main')
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(in_current_context(logger.info), 'step')
+        logger.info('after')
+
+        assert [record.getMessage() for record in caplog.records] == [
+            '[db_1] main', '[db_1] step', 'after'
+        ]
@@ -1,4 +1,7 @@
-from sqlbucket.project import ContextMerger
+from sqlbucket import SQLBucket
+from sqlbucket.project import ContextMerger, LayeredContext
+from pathlib import Path
+import pytest
 
 
 class TestVariablesConfiguration:
@@ -114,3 +117,74 @@ class TestVariablesConfiguration:
             'e': {'name': 'env1', 'foofoo': 'barbar'},
         }
 
+
+
+class TestLayeredContext:
+
+    def test_merge_does_not_modify_contexts(self):
+        project_config = {
+            'connection_variables': {'conn1': {'foo': 'bar'}},
+            'environment_variables': {'env1': {'foofoo': 'barbar'}},
+            'project_variables': {'foo': 'bar'}
+        }
+        context = {'c': {'name': 'conn1'}, 'e': {'name': 'env1'}}
+
+        merged = ContextMerger(
+            context=context,
+            context_from_config=project_config
+        ).merge()
+
+        assert merged['c']['foo'] == 'bar'
+        assert merged['e']['foofoo'] == 'barbar'
+        assert context == {'c': {'name': 'conn1'}, 'e': {'name': 'env1'}}
+        assert project_config['connection_variables'] == {
+            'conn1': {'foo': 'bar'}
+        }
+
+    def test_read_only(self):
+        context = LayeredContext({'foo': 'bar'})
+        with pytest.raises(TypeError):
+            context['foo'] = 'barbar'
+        with pytest.raises(TypeError):
+            del context['foo']
+
+    def test_first_layer_not_modified(self):
+        layer = {'foo': 'bar'}
+        context = LayeredContext(layer, {'bar': 'foo'})
+        for mutate in (
+            lambda: context.pop('foo'),
+            lambda: context.pop('missing', None),
+            context.popitem,
+            context.clear,
+            lambda: context.update(foo='barbar'),
+            lambda: context.setdefault('new', 1),
+        ):
+            with pytest.raises(TypeError):
+                mutate()
+        with pytest.raises(TypeError):
+            context |= {'foo': 'barbar'}
+        assert layer == {'foo': 'bar'}
+        assert context.to_dict() == {'foo': 'bar', 'bar': 'foo'}
+
+    def test_registry_not_modified_by_loading(self):
+        path = str((Path(__file__).parent / Path('fixtures/projects')))
+        connection_variables = {'db_name': {'bar': 'foo'}}
+        environment_variables = {'foo': 'registry'}
+        sqlbucket = SQLBucket(
+            projects_folder=path,
+            connections={'db_name': 'db_url', 'db': 'db_url'},
+            connection_variables=connection_variables,
+            environment_variables=environment_variables,
+            env_name='dev'
+        )
+        project = sqlbucket.load_project(
+            project_name='project1', connection_name='db_name'
+        )
+        sqlbucket.load_project(project_name='project1', connection_name='db')
+
+        assert project.context['c'] == {
+            'name': 'db_name', 'foo': 'barbar', 'bar': 'foo'
+        }
+        assert project.context['e'] == {'name': 'dev', 'foo': 'foobar'}
+        assert connection_variables == {'db_name': {'bar': 'foo'}}
+        assert environment_variables == {'foo': 'registry'}